@@ -0,0 +1,125 @@
+"""
+Short-term conversation memory for the Telegram bot.
+
+The last few (question, answer) turns of every chat are kept in process, in
+a bounded deque per chat inside an LRU of chats, so answering a follow-up in
+an active chat costs no network round trip. Chats idle for longer than the
+TTL are dropped; chats pushed out of the LRU are spilled to Redis (when
+configured) with the same TTL and loaded back on their next message.
+"""
+
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+try:
+	import redis.asyncio as aioredis
+except ImportError:  # Redis spillover is optional, memory-only without it
+	aioredis = None
+
+REDIS_RETRY_AFTER = 30.0  # seconds the Redis tier is skipped after an error
+
+
+class ConversationStore:
+	def __init__(self, max_turns: int, max_chats: int, ttl: float, answer_chars: int,
+			redis_client=None):
+		self.max_turns = max_turns
+		self.max_chats = max_chats
+		self.ttl = ttl
+		self.answer_chars = answer_chars
+		self.redis_client = redis_client
+		# chat id -> (last activity, deque of (question, answer)), least recent first
+		self._chats: "OrderedDict[int, tuple[float, deque]]" = OrderedDict()
+		self._redis_down_until = 0.0
+		self.spilled = 0
+		self.restored = 0
+		self.expired = 0
+
+	@staticmethod
+	def _key(chat_id: int) -> str:
+		return f"bot:conversation:{chat_id}"
+
+	async def history(self, chat_id: int) -> list[dict]:
+		"""Previous turns of a chat, oldest first, in the shape the RAG API expects"""
+		turns = self._chats.get(chat_id)
+		if turns is not None and time.monotonic() - turns[0] > self.ttl:
+			del self._chats[chat_id]
+			self.expired += 1
+			turns = None
+		if turns is None:
+			turns = await self._restore(chat_id)
+		if turns is None:
+			return []
+		return [{"question": q, "answer": a} for q, a in turns[1]]
+
+	async def append(self, chat_id: int, question: str, answer: str):
+		entry = self._chats.pop(chat_id, None)
+		turns = entry[1] if entry is not None else deque(maxlen=self.max_turns)
+		turns.append((question, answer[:self.answer_chars]))
+		self._chats[chat_id] = (time.monotonic(), turns)
+		await self._evict()
+
+	def clear(self, chat_id: int):
+		self._chats.pop(chat_id, None)
+
+	async def _evict(self):
+		now = time.monotonic()
+		# Least recently active chats come first, so expired ones are at the front
+		while self._chats:
+			chat_id, (last_active, turns) = next(iter(self._chats.items()))
+			if now - last_active > self.ttl:
+				del self._chats[chat_id]
+				self.expired += 1
+			elif len(self._chats) > self.max_chats:
+				del self._chats[chat_id]
+				await self._spill(chat_id, last_active, turns)
+			else:
+				break
+
+	def _redis_available(self) -> bool:
+		return self.redis_client is not None and time.monotonic() >= self._redis_down_until
+
+	def _redis_failed(self, e: Exception):
+		logging.warning(f"Conversation spillover unavailable, skipping Redis for {REDIS_RETRY_AFTER:.0f}s: {e}")
+		self._redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+
+	async def _spill(self, chat_id: int, last_active: float, turns: deque):
+		if not self._redis_available():
+			return
+		remaining = self.ttl - (time.monotonic() - last_active)
+		try:
+			await self.redis_client.set(
+				self._key(chat_id),
+				json.dumps(list(turns), ensure_ascii=False),
+				ex=max(1, int(remaining))
+			)
+			self.spilled += 1
+		except aioredis.RedisError as e:
+			self._redis_failed(e)
+
+	async def _restore(self, chat_id: int) -> Optional[tuple[float, deque]]:
+		if not self._redis_available():
+			return None
+		try:
+			raw = await self.redis_client.getdel(self._key(chat_id))
+		except aioredis.RedisError as e:
+			self._redis_failed(e)
+			return None
+		if raw is None:
+			return None
+		turns = deque((tuple(turn) for turn in json.loads(raw)), maxlen=self.max_turns)
+		self._chats[chat_id] = (time.monotonic(), turns)
+		self.restored += 1
+		await self._evict()
+		return self._chats.get(chat_id)
+
+	def stats(self) -> dict:
+		return {
+			"chats": len(self._chats),
+			"max_chats": self.max_chats,
+			"spilled": self.spilled,
+			"restored": self.restored,
+			"expired": self.expired,
+		}
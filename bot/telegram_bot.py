@@ -1,82 +1,334 @@
-import os
+import asyncio
+import json
 import logging
-import requests
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+import httpx
 from fastapi import FastAPI, Request
 from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
-from telegram.ext import CallbackContext
-from telegram.ext import MessageHandler, filters
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import (
+	ApplicationBuilder,
+	CallbackContext,
+	CommandHandler,
+	ContextTypes,
+	MessageHandler,
+	filters,
+)
+
+from conversation import ConversationStore, aioredis
+
+# Correlation id of the update being handled; sent to the RAG API as X-Request-ID
+REQUEST_ID_HEADER = "X-Request-ID"
+# Telegram user the question comes from, for the RAG API's per-user rate limit
+USER_ID_HEADER = "X-User-ID"
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+class RequestIdFilter(logging.Filter):
+	def filter(self, record: logging.LogRecord) -> bool:
+		record.request_id = request_id_var.get()
+		return True
 
 # Configure logging
 logging.basicConfig(
-	format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+	format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
 	level=logging.INFO
 )
+for handler in logging.getLogger().handlers:
+	handler.addFilter(RequestIdFilter())
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "false").lower() == "true"
 RAG_API_URL = "http://rag_api:8000"  # Using Docker service name
+STREAMING_MODE = os.getenv("STREAMING_MODE", "true").lower() == "true"
+# Telegram throttles edits of a single message to roughly one per second
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+RAG_TIMEOUT = float(os.getenv("RAG_TIMEOUT", "60"))
+RAG_CONNECT_TIMEOUT = float(os.getenv("RAG_CONNECT_TIMEOUT", "5"))
+RAG_MAX_CONNECTIONS = int(os.getenv("RAG_MAX_CONNECTIONS", "20"))
+# Upper bound on RAG calls in flight; further messages wait for a free slot
+RAG_MAX_INFLIGHT = int(os.getenv("RAG_MAX_INFLIGHT", "8"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Conversation memory sent with every question so follow-ups can be resolved
+CONVERSATION_TURNS = int(os.getenv("CONVERSATION_TURNS", "4"))
+CONVERSATION_MAX_CHATS = int(os.getenv("CONVERSATION_MAX_CHATS", "10000"))
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", "1800"))
+CONVERSATION_ANSWER_CHARS = int(os.getenv("CONVERSATION_ANSWER_CHARS", "600"))
+CONVERSATION_REDIS = os.getenv("CONVERSATION_REDIS", "false").lower() == "true"
+# Only what format_answer shows is requested: a short snippet instead of each source's full content
+SOURCE_SNIPPET_CHARS = int(os.getenv("SOURCE_SNIPPET_CHARS", "200"))
+SOURCE_OPTIONS = {"fields": ["title", "url", "snippet"], "snippet_chars": SOURCE_SNIPPET_CHARS}
+
+NO_RESULTS_TEXT = (
+	"I couldn't find any relevant information in our knowledge base. "
+	"Please try rephrasing your question."
+)
+API_ERROR_TEXT = (
+	"Sorry, I'm having trouble accessing our knowledge base right now. "
+	"Please try again later."
+)
+GENERIC_ERROR_TEXT = "Sorry, something went wrong. Please try again later."
+BUSY_TEXT = "I'm answering a lot of questions right now, yours is queued and I'll reply shortly."
+RATE_LIMITED_TEXT = "You're asking questions faster than I can answer. Please try again in {seconds} seconds."
+OVERLOADED_TEXT = "I'm getting too many questions right now. Please try again in a minute."
 
 if not TOKEN:
 	raise RuntimeError("Missing TELEGRAM_BOT_TOKEN in environment")
 
+def conversation_redis():
+	"""Async Redis client for spilling evicted conversations, if enabled"""
+	if not CONVERSATION_REDIS:
+		return None
+	if aioredis is None:
+		logging.warning("CONVERSATION_REDIS is set but redis is not installed, keeping conversations in memory only")
+		return None
+	return aioredis.Redis(
+		host=os.getenv("REDIS_HOST", "localhost"),
+		port=int(os.getenv("REDIS_PORT", 6379)),
+		socket_connect_timeout=0.5,
+		socket_timeout=0.5
+	)
+
+conversations = ConversationStore(
+	max_turns=CONVERSATION_TURNS,
+	max_chats=CONVERSATION_MAX_CHATS,
+	ttl=CONVERSATION_TTL,
+	answer_chars=CONVERSATION_ANSWER_CHARS,
+	redis_client=conversation_redis()
+)
+
+# Shared keep-alive client for the RAG API, opened once per process
+rag_client: Optional[httpx.AsyncClient] = None
+rag_slots = asyncio.Semaphore(RAG_MAX_INFLIGHT)
+
+async def add_request_id(request: httpx.Request):
+	request.headers[REQUEST_ID_HEADER] = request_id_var.get()
+
+async def open_rag_client(_application=None):
+	global rag_client
+	if rag_client is None:
+		rag_client = httpx.AsyncClient(
+			base_url=RAG_API_URL,
+			timeout=httpx.Timeout(RAG_TIMEOUT, connect=RAG_CONNECT_TIMEOUT),
+			limits=httpx.Limits(
+				max_connections=RAG_MAX_CONNECTIONS,
+				max_keepalive_connections=RAG_MAX_CONNECTIONS
+			),
+			event_hooks={"request": [add_request_id]}
+		)
+
+async def close_rag_client(_application=None):
+	global rag_client
+	if rag_client is not None:
+		await rag_client.aclose()
+		rag_client = None
+
 # Telegram app
-app_bot = ApplicationBuilder().token(TOKEN).build()
+app_bot = (
+	ApplicationBuilder()
+	.token(TOKEN)
+	.concurrent_updates(CONCURRENT_UPDATES)
+	.post_init(open_rag_client)
+	.post_shutdown(close_rag_client)
+	.build()
+)
+
+@contextmanager
+def timed(stage: str):
+	"""Log how long one stage of answering a message took"""
+	started = time.perf_counter()
+	try:
+		yield
+	finally:
+		logging.info(f"[TIMING] {stage} took {(time.perf_counter() - started) * 1000:.0f} ms")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	logging.info(f"Start command received from user {update.effective_user.id}")
+	conversations.clear(update.effective_chat.id)
 	await context.bot.send_message(
 		chat_id=update.effective_chat.id,
 		text="Hello! I'm your RAG-powered chatbot. Ask me anything and I'll search through our knowledge base to find relevant information."
 	)
 
+def format_answer(answer: str, sources: list) -> str:
+	message = f"{answer}\n\n"
+	if sources:
+		message += "Sources:\n"
+	for i, doc in enumerate(sources, 1):
+		message += f"{i}. {doc['title'] or 'Untitled'}\n"
+		if doc.get('snippet') is not None:
+			message += f"   {doc['snippet']}\n"
+		else:
+			message += f"   {doc['content'][:200]}...\n"
+		message += f"   Source: {doc['url']}\n\n"
+	return message[:MessageLimit.MAX_TEXT_LENGTH]
+
+def rejection_text(response: httpx.Response) -> Optional[str]:
+	"""Reply for a question the RAG API refused because of rate limits or load"""
+	if response.status_code == 429:
+		return RATE_LIMITED_TEXT.format(seconds=response.headers.get("Retry-After", "a few"))
+	if response.status_code == 503:
+		return OVERLOADED_TEXT
+	return None
+
+async def iter_sse(response: httpx.Response):
+	"""Yield (event, data) pairs from a Server-Sent Events response"""
+	event, data_lines = "message", []
+	async for line in response.aiter_lines():
+		if not line:
+			if data_lines:
+				yield event, json.loads("\n".join(data_lines))
+			event, data_lines = "message", []
+		elif line.startswith("event:"):
+			event = line[len("event:"):].strip()
+		elif line.startswith("data:"):
+			data_lines.append(line[len("data:"):].strip())
+
+async def edit_message(message, text: str, final: bool = False) -> bool:
+	"""Edit a streamed reply; intermediate edits are dropped when Telegram throttles us"""
+	text = text[:MessageLimit.MAX_TEXT_LENGTH]
+	try:
+		await message.edit_text(text)
+		return True
+	except RetryAfter as e:
+		if not final:
+			return False
+		await asyncio.sleep(e.retry_after)
+		await message.edit_text(text)
+		return True
+	except BadRequest as e:
+		if "not modified" in str(e).lower():
+			return True
+		raise
+
+async def stream_answer(update: Update, query: str, history: list) -> Optional[str]:
+	"""Reply with a placeholder and edit it as the RAG API streams the answer.
+
+	Returns the answer, or None when no answer could be produced.
+	"""
+	with timed("telegram_send"):
+		placeholder = await update.message.reply_text("Searching our knowledge base…")
+	try:
+		sources, answer = [], ""
+		started = last_edit = time.monotonic()
+		first_token = True
+		with timed("rag_stream"):
+			async with rag_client.stream(
+				"POST",
+				"/query/stream",
+				json={"query": query, "limit": 3, "history": history, **SOURCE_OPTIONS},
+				headers={USER_ID_HEADER: str(update.effective_user.id)}
+			) as response:
+				if (refusal := rejection_text(response)) is not None:
+					await edit_message(placeholder, refusal, final=True)
+					return None
+				response.raise_for_status()
+				async for event, data in iter_sse(response):
+					if event == "sources":
+						sources = data
+					elif event == "token":
+						if first_token:
+							logging.info(f"[TIMING] rag_first_token took {(time.monotonic() - started) * 1000:.0f} ms")
+							first_token = False
+						answer += data["text"]
+						if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+							await edit_message(placeholder, answer + " …")
+							last_edit = time.monotonic()
+					elif event == "done":
+						answer = data["answer"]
+					elif event == "error":
+						raise RuntimeError(data["detail"])
+
+		with timed("telegram_send"):
+			if not sources:
+				await edit_message(placeholder, NO_RESULTS_TEXT, final=True)
+			else:
+				await edit_message(placeholder, format_answer(answer, sources), final=True)
+		return answer
+
+	except httpx.HTTPError as e:
+		logging.error(f"Error streaming from RAG API: {e}")
+		await edit_message(placeholder, API_ERROR_TEXT, final=True)
+	except Exception as e:
+		logging.error(f"Error processing streamed answer: {e}")
+		await edit_message(placeholder, GENERIC_ERROR_TEXT, final=True)
+	return None
+
+@asynccontextmanager
+async def rag_slot(update: Update):
+	"""Hold one of the RAG_MAX_INFLIGHT slots, telling the user when they have to wait"""
+	if rag_slots.locked():
+		await update.message.reply_text(BUSY_TEXT)
+	async with rag_slots:
+		yield
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	# Each update is handled in its own task, so the id does not leak between messages
+	request_id_var.set(uuid.uuid4().hex)
 	try:
 		query = update.message.text
+		chat_id = update.effective_chat.id
 		logging.info(f"Query received from user {update.effective_user.id}: {query}")
+		history = await conversations.history(chat_id)
+
+		async with rag_slot(update):
+			if STREAMING_MODE:
+				answer = await stream_answer(update, query, history)
+				if answer is not None:
+					await conversations.append(chat_id, query, answer)
+				return
+
+			# Query the RAG API
+			with timed("rag_query"):
+				response = await rag_client.post(
+					"/query",
+					json={"query": query, "limit": 3, "history": history, **SOURCE_OPTIONS},
+					headers={USER_ID_HEADER: str(update.effective_user.id)}
+				)
+			if (refusal := rejection_text(response)) is not None:
+				await update.message.reply_text(refusal)
+				return
+			response.raise_for_status()
+			results = response.json()
+		await conversations.append(chat_id, query, results["answer"])
+
+		with timed("telegram_send"):
+			if not results.get("sources"):
+				await update.message.reply_text(NO_RESULTS_TEXT)
+				return
+
+			await update.message.reply_text(format_answer(results["answer"], results["sources"]))
 		
-		# Query the RAG API
-		response = requests.post(
-			f"{RAG_API_URL}/query",
-			json={"query": query, "limit": 3}
-		)
-		response.raise_for_status()
-		results = response.json()
-		
-		if not results:
-			await update.message.reply_text(
-				"I couldn't find any relevant information in our knowledge base. "
-				"Please try rephrasing your question."
-			)
-			return
-			
-		# Format the response
-		message = "Here's what I found:\n\n"
-		for i, doc in enumerate(results, 1):
-			message += f"{i}. {doc['title'] or 'Untitled'}\n"
-			message += f"   {doc['content'][:200]}...\n"
-			message += f"   Source: {doc['url']}\n\n"
-			
-		await update.message.reply_text(message)
-		
-	except requests.exceptions.RequestException as e:
+	except httpx.HTTPError as e:
 		logging.error(f"Error querying RAG API: {e}")
-		await update.message.reply_text(
-			"Sorry, I'm having trouble accessing our knowledge base right now. "
-			"Please try again later."
-		)
+		await update.message.reply_text(API_ERROR_TEXT)
 	except Exception as e:
 		logging.error(f"Error processing message: {e}")
-		await update.message.reply_text(
-			"Sorry, something went wrong. Please try again later."
-		)
+		await update.message.reply_text(GENERIC_ERROR_TEXT)
 
 # This catches any text that is NOT a /command
 app_bot.add_handler(CommandHandler("start", start))
 app_bot.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+	# In webhook mode nothing runs post_init/post_shutdown for us
+	await app_bot.initialize()
+	await open_rag_client()
+	try:
+		yield
+	finally:
+		await close_rag_client()
+		await app_bot.shutdown()
+
 # FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/")
 async def root():
@@ -90,7 +342,7 @@ async def health_check():
 async def telegram_webhook(req: Request):
 	try:
 		update = Update.de_json(await req.json(), app_bot.bot)
-		logging.info(f"Webhook update received: {update}")
+		logging.debug(f"Webhook update received: {update}")
 		await app_bot.process_update(update)
 		return {"ok": True}
 	except Exception as e:
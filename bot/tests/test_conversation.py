@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+import redis
+
+import conversation
+from conversation import ConversationStore
+
+
+class FakeClock:
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self) -> float:
+		return self.now
+
+
+class FakeRedis:
+	"""The async Redis calls the store makes, with expiry on the fake clock"""
+
+	def __init__(self, clock: FakeClock):
+		self.clock = clock
+		self.values: dict[str, tuple[str, float]] = {}
+		self.failing = False
+		self.calls = 0
+
+	def _check(self):
+		self.calls += 1
+		if self.failing:
+			raise redis.ConnectionError("connection refused")
+
+	async def set(self, key: str, value: str, ex: int):
+		self._check()
+		self.values[key] = (value, self.clock.now + ex)
+
+	async def getdel(self, key: str):
+		self._check()
+		value, expires = self.values.pop(key, (None, 0.0))
+		return value if self.clock.now < expires else None
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	fake = FakeClock()
+	monkeypatch.setattr(conversation.time, "monotonic", fake)
+	return fake
+
+
+def make_store(redis_client=None, **overrides) -> ConversationStore:
+	options = {"max_turns": 2, "max_chats": 2, "ttl": 60.0, "answer_chars": 10}
+	return ConversationStore(**{**options, **overrides}, redis_client=redis_client)
+
+
+def test_history_keeps_last_turns_with_trimmed_answers(clock):
+	async def scenario():
+		store = make_store()
+		for n in range(3):
+			await store.append(1, f"q{n}", f"answer number {n}")
+		assert await store.history(1) == [
+			{"question": "q1", "answer": "answer num"},
+			{"question": "q2", "answer": "answer num"},
+		]
+		assert await store.history(2) == []
+
+	asyncio.run(scenario())
+
+
+def test_idle_chat_expires_after_ttl(clock):
+	async def scenario():
+		store = make_store()
+		await store.append(1, "q", "a")
+		clock.now += 59
+		assert len(await store.history(1)) == 1
+
+		clock.now += 2
+		assert await store.history(1) == []
+		assert store.stats()["expired"] == 1
+
+	asyncio.run(scenario())
+
+
+def test_expired_chats_are_dropped_not_spilled(clock):
+	async def scenario():
+		fake = FakeRedis(clock)
+		store = make_store(fake)
+		await store.append(1, "q", "a")
+		clock.now += 61
+		await store.append(2, "q", "a")
+		assert store.stats()["chats"] == 1
+		assert fake.values == {}
+
+	asyncio.run(scenario())
+
+
+def test_least_recent_chat_spills_to_redis_and_is_restored(clock):
+	async def scenario():
+		fake = FakeRedis(clock)
+		store = make_store(fake)
+		await store.append(1, "q1", "a1")
+		clock.now += 10
+		await store.append(2, "q2", "a2")
+		await store.append(1, "q1b", "a1b")
+		await store.append(3, "q3", "a3")
+
+		# Chat 2 was the least recently active one
+		assert list(fake.values) == ["bot:conversation:2"]
+		# Spilled with what is left of its TTL
+		assert fake.values["bot:conversation:2"][1] == clock.now + 60
+
+		assert await store.history(2) == [{"question": "q2", "answer": "a2"}]
+		# GETDEL: the copy in Redis is gone once the chat is back in memory,
+		# and making room for it spilled the next least recent chat
+		assert list(fake.values) == ["bot:conversation:1"]
+		assert store.stats() == {
+			"chats": 2,
+			"max_chats": 2,
+			"spilled": 2,
+			"restored": 1,
+			"expired": 0,
+		}
+
+	asyncio.run(scenario())
+
+
+def test_spilled_chat_expires_in_redis(clock):
+	async def scenario():
+		fake = FakeRedis(clock)
+		store = make_store(fake)
+		for chat_id in (1, 2, 3):
+			await store.append(chat_id, "q", "a")
+		clock.now += 61
+		assert await store.history(1) == []
+		assert store.stats()["restored"] == 0
+
+	asyncio.run(scenario())
+
+
+def test_redis_errors_fall_back_to_memory_for_a_while(clock):
+	async def scenario():
+		fake = FakeRedis(clock)
+		fake.failing = True
+		store = make_store(fake)
+		for chat_id in (1, 2, 3):
+			await store.append(chat_id, "q", "a")
+		assert store.stats()["spilled"] == 0
+
+		# The failed spill marked Redis down, so the lookup skips it
+		calls = fake.calls
+		assert await store.history(1) == []
+		assert fake.calls == calls
+
+		clock.now += conversation.REDIS_RETRY_AFTER
+		fake.failing = False
+		assert await store.history(1) == []
+		assert fake.calls == calls + 1
+
+	asyncio.run(scenario())
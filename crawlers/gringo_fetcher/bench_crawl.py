@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Crawl benchmark against a local HTTP stand-in for gringo.co.il.
+
+Serves synthetic article pages (same h1 / section.text-body layout) with
+ETag support, configurable latency and error rate, then measures:
+  1. the old sequential requests.get loop,
+  2. a cold AsyncCrawler pass,
+  3. a warm AsyncCrawler pass that revalidates with If-None-Match (304s).
+
+    python bench_crawl.py --pages 500 --workers 32 --latency 0.05
+"""
+
+import argparse, asyncio, random, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from crawl_engine import AsyncCrawler, CrawlTarget
+
+PAGE = """<html><head><title>Article {n}</title></head><body>
+<nav>menu menu menu</nav>
+<h1>Article {n}</h1>
+<section class="text-body"><p>{body}</p><script>var x = {n};</script></section>
+</body></html>"""
+
+
+def make_handler(latency: float, error_rate: float):
+    class StandInHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            if self.path == "/robots.txt":
+                return self._send(200, b"User-agent: *\nDisallow: /private/\n")
+            if random.random() < error_rate:
+                return self._send(503, b"busy", {"Retry-After": "0"})
+            n    = self.path.rsplit("/", 1)[-1]
+            etag = f'"{n}-v1"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, b"", {"ETag": etag})
+            body = PAGE.format(n=n, body=f"Paragraph about topic {n}. " * 200).encode()
+            self._send(200, body, {"ETag": etag, "Content-Type": "text/html; charset=utf-8"})
+
+        def _send(self, status: int, body: bytes, headers: dict | None = None):
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return StandInHandler
+
+
+def sequential(urls: list[str]) -> float:
+    started = time.monotonic()
+    for url in urls:
+        requests.get(url, timeout=15).text
+    return len(urls) / (time.monotonic() - started)
+
+
+async def async_pass(targets: list[CrawlTarget], args) -> tuple[AsyncCrawler, dict]:
+    crawler = AsyncCrawler(
+        user_agent           = "bench-crawler",
+        workers              = args.workers,
+        per_host_concurrency = args.per_host_concurrency or args.workers,
+        per_host_delay       = args.per_host_delay,
+        backoff_base         = 0.05,
+    )
+    etags = {}
+    async for result in crawler.crawl(targets):
+        if result.ok or result.not_modified:
+            etags[result.target.url] = result.etag
+    return crawler, etags
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--pages",                type=int,   default=300)
+    ap.add_argument("--workers",              type=int,   default=16)
+    ap.add_argument("--per-host-concurrency", type=int,   default=0, help="default: same as --workers")
+    ap.add_argument("--per-host-delay",       type=float, default=0.0)
+    ap.add_argument("--latency",              type=float, default=0.05, help="server latency per request (s)")
+    ap.add_argument("--error-rate",           type=float, default=0.0,  help="fraction of 503 responses")
+    ap.add_argument("--sequential-pages",     type=int,   default=50,   help="pages for the sequential baseline")
+    args = ap.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args.latency, args.error_rate))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    urls = [f"{base}/lt/{n}" for n in range(args.pages)]
+
+    seq_rate = sequential(urls[:args.sequential_pages])
+    print(f"sequential requests.get : {seq_rate:8.1f} pages/s ({args.sequential_pages} pages)")
+
+    cold, etags = asyncio.run(async_pass([CrawlTarget(url) for url in urls], args))
+    print(f"async crawl, cold       : {cold.stats.pages_per_second:8.1f} pages/s ({cold.stats.summary()})")
+
+    warm_targets = [CrawlTarget(url, etag=etags.get(url)) for url in urls]
+    warm, _ = asyncio.run(async_pass(warm_targets, args))
+    print(f"async crawl, revalidate : {warm.stats.pages_per_second:8.1f} pages/s ({warm.stats.summary()})")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Extraction benchmark: BeautifulSoup html.parser (the old inline step) against
+extract.extract (lxml), on saved gringo pages or synthetic ones.
+
+Reports pages/s on one core for both, checks that they produce the same
+stored JSON, then runs extract.extract in a process pool to show how it
+scales with cores.
+
+    python bench_extract.py --save fixtures --pages 200   # download sitemap pages once
+    python bench_extract.py --fixtures fixtures --workers 4
+    python bench_extract.py                               # synthetic pages only
+"""
+
+import argparse, json, multiprocessing, os, time
+from concurrent.futures import ProcessPoolExecutor
+from itertools          import islice
+from pathlib            import Path
+
+import requests
+from bs4 import BeautifulSoup
+
+from bench_crawl import PAGE
+from extract     import extract
+from sitemap     import iter_sitemap_with_fallback
+
+SITEMAP_URL = "https://gringo.co.il/sitemap.xml"
+INDEX_FILE  = "index.json"                           # fixture file name → page URL
+
+
+def bs4_extract(url: str, html: str) -> str:
+    """The fetcher's previous extraction, kept as the baseline"""
+    bs      = BeautifulSoup(html, "html.parser")
+    h1      = bs.find('h1')
+    title   = " ".join(h1.stripped_strings) if h1 else ""
+    section = bs.find('section', class_='text-body')
+    content = " ".join(section.stripped_strings) if section else ""
+    return json.dumps({"title": title, "content": content}, ensure_ascii=False)
+
+
+def save_fixtures(directory: Path, pages: int, user_agent: str):
+    directory.mkdir(parents=True, exist_ok=True)
+    headers = {"User-Agent": user_agent}
+    cached  = Path(__file__).resolve().parent / "sitemap.xml"
+    entries = iter_sitemap_with_fallback(SITEMAP_URL, headers, str(cached) if cached.exists() else None)
+    index   = {}
+    for n, entry in enumerate(islice(entries, pages)):
+        response = requests.get(entry.loc, headers=headers, timeout=30)
+        if response.status_code != 200:
+            print(f"  skipped {entry.loc} ({response.status_code})")
+            continue
+        name = f"{n:05d}.html"
+        (directory / name).write_text(response.text, encoding="utf-8")
+        index[name] = entry.loc
+    (directory / INDEX_FILE).write_text(json.dumps(index, indent=2), encoding="utf-8")
+    print(f"Saved {len(index)} pages to {directory}")
+
+
+def load_fixtures(directory: Path) -> list[tuple[str, str]]:
+    index = json.loads((directory / INDEX_FILE).read_text(encoding="utf-8"))
+    return [(url, (directory / name).read_text(encoding="utf-8")) for name, url in index.items()]
+
+
+def synthetic_pages(pages: int) -> list[tuple[str, str]]:
+    return [
+        (f"https://gringo.co.il/lt/{n}", PAGE.format(n=n, body=f"Paragraph about topic {n}. " * 200))
+        for n in range(pages)
+    ]
+
+
+def rate(fn, pages: list[tuple[str, str]], repeat: int) -> tuple[float, list[str]]:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        results = [fn(url, html) for url, html in pages]
+    return len(pages) * repeat / (time.perf_counter() - started), results
+
+
+def pool_rate(pages: list[tuple[str, str]], repeat: int, workers: int) -> float:
+    urls, texts = zip(*pages)
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        list(pool.map(extract, urls[:workers], texts[:workers]))          # start the workers
+        started = time.perf_counter()
+        for _ in range(repeat):
+            list(pool.map(extract, urls, texts, chunksize=4))
+        return len(pages) * repeat / (time.perf_counter() - started)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fixtures",   type=Path, help="directory written by --save")
+    ap.add_argument("--save",       type=Path, help="download sitemap pages into this directory and exit")
+    ap.add_argument("--pages",      type=int,  default=200)
+    ap.add_argument("--repeat",     type=int,  default=3, help="passes over the pages per measurement")
+    ap.add_argument("--workers",    type=int,  default=os.cpu_count() or 1)
+    ap.add_argument("--user-agent", default=os.getenv("USER_AGENT", "bench-extract"))
+    args = ap.parse_args()
+
+    if args.save:
+        return save_fixtures(args.save, args.pages, args.user_agent)
+
+    pages = load_fixtures(args.fixtures) if args.fixtures else synthetic_pages(args.pages)
+    size  = sum(len(html) for _, html in pages) / len(pages) / 1024
+    print(f"{len(pages)} pages, {size:.0f} KiB on average")
+
+    before, expected = rate(bs4_extract, pages, args.repeat)
+    print(f"bs4 html.parser, 1 core : {before:8.1f} pages/s")
+    after, actual = rate(extract, pages, args.repeat)
+    print(f"lxml extract, 1 core    : {after:8.1f} pages/s ({after / before:.1f}x)")
+    mismatches = sum(a != b for a, b in zip(expected, actual))
+    print(f"identical output        : {len(pages) - mismatches}/{len(pages)} pages")
+
+    pooled = pool_rate(pages, args.repeat, args.workers)
+    label  = f"lxml extract, {args.workers} procs"
+    print(f"{label:<24}: {pooled:8.1f} pages/s ({pooled / args.workers:.1f} per core)")
+
+
+if __name__ == "__main__":
+    main()
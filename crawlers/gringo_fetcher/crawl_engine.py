@@ -0,0 +1,277 @@
+"""
+Async crawl engine used by the Gringo fetcher.
+
+A bounded pool of workers downloads targets concurrently while staying polite
+to every host: per-host concurrency and minimum delay between requests,
+robots.txt, retries with exponential backoff (honouring Retry-After) and
+conditional GETs (ETag / Last-Modified) so unchanged pages cost a 304.
+Targets whose sitemap <lastmod> is not newer than our copy are skipped
+without any request. The engine knows nothing about the database: callers
+feed CrawlTargets in and consume CrawlResults as they complete.
+"""
+
+import asyncio, logging, random, time
+from dataclasses import dataclass, field
+from datetime    import datetime
+from typing      import AsyncIterable, AsyncIterator, Iterable, Optional, Union
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+
+import httpx
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class CrawlTarget:
+    url:           str
+    lastmod:       Optional[datetime] = None   # from the sitemap
+    etag:          Optional[str]      = None   # validators from our previous fetch
+    last_modified: Optional[str]      = None
+    fetched_at:    Optional[datetime] = None
+
+
+@dataclass
+class CrawlResult:
+    target:        CrawlTarget
+    status:        Optional[int]      = None
+    text:          Optional[str]      = None
+    etag:          Optional[str]      = None
+    last_modified: Optional[str]      = None
+    not_modified:  bool               = False
+    skipped:       Optional[str]      = None   # "lastmod" | "robots"
+    error:         Optional[str]      = None
+    attempts:      int                = 0
+    elapsed:       float              = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.text is not None
+
+
+@dataclass
+class CrawlStats:
+    fetched:      int   = 0
+    not_modified: int   = 0
+    skipped:      int   = 0
+    failed:       int   = 0
+    retries:      int   = 0
+    bytes:        int   = 0
+    started:      float = field(default_factory=time.monotonic)
+
+    @property
+    def pages_per_second(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return (self.fetched + self.not_modified) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (f"{self.fetched} fetched, {self.not_modified} not modified, {self.skipped} skipped, "
+                f"{self.failed} failed, {self.retries} retries, {self.bytes / 1e6:.1f} MB, "
+                f"{self.pages_per_second:.1f} pages/s")
+
+
+class HostPolicy:
+    """Per-host politeness: bounded concurrency and a minimum gap between request starts"""
+
+    def __init__(self, concurrency: int, delay: float):
+        self.semaphore  = asyncio.Semaphore(concurrency)
+        self.delay      = delay
+        self._lock      = asyncio.Lock()
+        self._next_slot = 0.0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        async with self._lock:
+            now  = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.delay
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+
+
+class AsyncCrawler:
+    def __init__(
+        self,
+        user_agent:           str,
+        workers:              int   = 16,
+        per_host_concurrency: int   = 4,
+        per_host_delay:       float = 0.25,
+        max_retries:          int   = 3,
+        backoff_base:         float = 1.0,
+        timeout:              float = 15.0,
+        respect_robots:       bool  = True,
+        transport:            Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.user_agent           = user_agent
+        self.workers              = workers
+        self.per_host_concurrency = per_host_concurrency
+        self.per_host_delay       = per_host_delay
+        self.max_retries          = max_retries
+        self.backoff_base         = backoff_base
+        self.timeout              = timeout
+        self.respect_robots       = respect_robots
+        self.transport            = transport
+        self.stats                = CrawlStats()
+        self._hosts:  dict[str, HostPolicy]                 = {}
+        self._robots: dict[str, Optional[RobotFileParser]] = {}
+        self._robots_locks: dict[str, asyncio.Lock]         = {}
+
+    # ───────────────────────── public API ─────────────────────
+    async def crawl(
+        self, targets: Union[Iterable[CrawlTarget], AsyncIterable[CrawlTarget]]
+    ) -> AsyncIterator[CrawlResult]:
+        """Yield a CrawlResult per target, in completion order"""
+        self.stats = CrawlStats()
+        inbox:  asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        outbox: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        limits = httpx.Limits(max_connections=self.workers, max_keepalive_connections=self.workers)
+
+        async with httpx.AsyncClient(
+            headers          = {"User-Agent": self.user_agent},
+            timeout          = self.timeout,
+            limits           = limits,
+            follow_redirects = True,
+            transport        = self.transport,
+        ) as client:
+            feeder  = asyncio.create_task(self._feed(targets, inbox))
+            workers = [asyncio.create_task(self._work(client, inbox, outbox)) for _ in range(self.workers)]
+            closer  = asyncio.create_task(self._close(feeder, workers, outbox))
+            try:
+                while (result := await outbox.get()) is not None:
+                    yield result
+            finally:
+                for task in (feeder, closer, *workers):
+                    task.cancel()
+                await asyncio.gather(feeder, closer, *workers, return_exceptions=True)
+
+    # ───────────────────────── pipeline ───────────────────────
+    async def _feed(self, targets, inbox: asyncio.Queue):
+        if hasattr(targets, "__aiter__"):
+            async for target in targets:
+                await inbox.put(target)
+        else:
+            for target in targets:
+                await inbox.put(target)
+        for _ in range(self.workers):
+            await inbox.put(None)
+
+    async def _work(self, client: httpx.AsyncClient, inbox: asyncio.Queue, outbox: asyncio.Queue):
+        while (target := await inbox.get()) is not None:
+            result = await self._process(client, target)
+            self._count(result)
+            await outbox.put(result)
+
+    async def _close(self, feeder, workers, outbox: asyncio.Queue):
+        await feeder
+        await asyncio.gather(*workers)
+        await outbox.put(None)
+
+    def _count(self, result: CrawlResult):
+        self.stats.retries += max(0, result.attempts - 1)
+        if result.skipped:
+            self.stats.skipped += 1
+        elif result.not_modified:
+            self.stats.not_modified += 1
+        elif result.ok:
+            self.stats.fetched += 1
+            self.stats.bytes   += len(result.text)
+        else:
+            self.stats.failed += 1
+
+    # ───────────────────────── per target ─────────────────────
+    async def _process(self, client: httpx.AsyncClient, target: CrawlTarget) -> CrawlResult:
+        started = time.monotonic()
+        result  = CrawlResult(target=target)
+
+        if target.lastmod and target.fetched_at and target.lastmod <= target.fetched_at:
+            result.skipped = "lastmod"
+            return result
+        if self.respect_robots and not await self._allowed(client, target.url):
+            result.skipped = "robots"
+            return result
+
+        headers = {}
+        if target.etag:
+            headers["If-None-Match"] = target.etag
+        if target.last_modified:
+            headers["If-Modified-Since"] = target.last_modified
+
+        host = urlsplit(target.url).netloc
+        for attempt in range(self.max_retries + 1):
+            result.attempts = attempt + 1
+            retry_after = None
+            try:
+                async with self._host(host):
+                    resp = await client.get(target.url, headers=headers)
+                if resp.status_code == 304:
+                    result.status, result.not_modified = 304, True
+                    result.etag          = target.etag
+                    result.last_modified = target.last_modified
+                    break
+                if resp.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                    retry_after = resp.headers.get("Retry-After")
+                    raise httpx.HTTPStatusError(f"HTTP {resp.status_code}", request=resp.request, response=resp)
+                resp.raise_for_status()
+                result.status        = resp.status_code
+                result.text          = resp.text
+                result.etag          = resp.headers.get("ETag")
+                result.last_modified = resp.headers.get("Last-Modified")
+                result.error         = None
+                break
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                result.error  = f"{type(e).__name__}: {e}"
+                result.status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+                retryable = not isinstance(e, httpx.HTTPStatusError) or result.status in RETRY_STATUSES
+                if not retryable or attempt == self.max_retries:
+                    break
+                delay = self._backoff(attempt, retry_after)
+                logging.debug(f"[RETRY] {target.url} in {delay:.1f}s ({result.error})")
+                await asyncio.sleep(delay)
+
+        result.elapsed = time.monotonic() - started
+        return result
+
+    def _backoff(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff_base * (2 ** attempt) * (0.5 + random.random())
+
+    def _host(self, host: str) -> HostPolicy:
+        if host not in self._hosts:
+            self._hosts[host] = HostPolicy(self.per_host_concurrency, self.per_host_delay)
+        return self._hosts[host]
+
+    # ───────────────────────── robots.txt ─────────────────────
+    async def _allowed(self, client: httpx.AsyncClient, url: str) -> bool:
+        parts = urlsplit(url)
+        host  = parts.netloc
+        lock  = self._robots_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            if host not in self._robots:
+                self._robots[host] = await self._load_robots(client, f"{parts.scheme}://{host}/robots.txt")
+        robots = self._robots[host]
+        return robots is None or robots.can_fetch(self.user_agent, url)
+
+    async def _load_robots(self, client: httpx.AsyncClient, robots_url: str) -> Optional[RobotFileParser]:
+        """Parsed robots.txt, or None (allow everything) when there is none"""
+        try:
+            resp = await client.get(robots_url)
+        except httpx.TransportError as e:
+            logging.warning(f"[ROBOTS] {robots_url} unreachable ({e}); assuming allowed")
+            return None
+        if resp.status_code >= 400:
+            return None
+        parser = RobotFileParser(robots_url)
+        parser.parse(resp.text.splitlines())
+        delay = parser.crawl_delay(self.user_agent)
+        if delay:
+            host = urlsplit(robots_url).netloc
+            self._host(host).delay = max(self._host(host).delay, float(delay))
+        return parser
@@ -1,24 +1,50 @@
 #!/usr/bin/env python3
 """
 Gringo Fetcher – step 1
-Download first N URLs from Gringo sitemap and publish rows to gringo.raw_pages.
-Publishes "gringo:fetcher:done" on Redis when finished.
+Stream URLs from the Gringo sitemap (and any nested sitemap indexes) and publish
+rows to gringo.raw_pages.
+Every new or changed page is queued in gringo.parse_jobs for the parser;
+"gringo:parse_jobs" is published on Redis as a wake-up hint while pages land
+and "gringo:fetcher:done" when a pass is finished.
+
+Pages are downloaded concurrently by crawl_engine.AsyncCrawler; pages whose
+sitemap <lastmod> is older than our copy are skipped and the rest are
+revalidated with conditional GETs. Downloaded pages are handed to
+extract.extract in a process pool, so HTML parsing runs on other cores while
+the downloader keeps going.
 """
 
-import os, time, logging, requests, psycopg2, redis, json, warnings
+import os, time, logging, psycopg2, redis, hashlib, asyncio, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib        import ExitStack, closing, contextmanager
+from itertools         import islice
+from redis.backoff     import NoBackoff
+from redis.retry       import Retry
 from dotenv           import load_dotenv
-from xml.etree         import ElementTree as ET
-from bs4               import BeautifulSoup            # only for safe_parsing
 from pathlib           import Path
+from crawl_engine      import AsyncCrawler, CrawlResult, CrawlTarget
+from extract           import extract_timed
+from sitemap           import SitemapEntry, iter_sitemap_with_fallback
 
 # ───────────────────────── CONFIG ─────────────────────────
 SITEMAP_URL  = "https://gringo.co.il/sitemap.xml"
 SITEMAP_TTL  = 7 * 24 * 3600
-MAX_PAGES    = 10
+MAX_PAGES    = int(os.getenv("MAX_PAGES", "10"))                 # 0 → whole sitemap
+SITEMAP_BATCH = int(os.getenv("SITEMAP_BATCH", "500"))           # URLs looked up in the DB per round trip
+
+CRAWL_WORKERS        = int(os.getenv("CRAWL_WORKERS", "16"))
+PER_HOST_CONCURRENCY = int(os.getenv("PER_HOST_CONCURRENCY", "4"))
+PER_HOST_DELAY       = float(os.getenv("PER_HOST_DELAY", "0.25"))  # seconds between requests to one host
+MAX_RETRIES          = int(os.getenv("MAX_RETRIES", "3"))
+RESPECT_ROBOTS       = os.getenv("RESPECT_ROBOTS", "true").lower() == "true"
+EXTRACT_WORKERS      = int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 1)))  # 0 → extract in a thread
 
 UA = os.getenv("USER_AGENT") or \
      "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
 HEADERS = {"User-Agent": UA}
+
+JOBS_CHANNEL    = "gringo:parse_jobs"
+NOTIFY_INTERVAL = 1.0                                             # min seconds between wake-up hints
 # ──────────────────────────────────────────────────────────
 
 PROJECT_ROOT = Path(__file__).resolve().parent
@@ -37,6 +63,10 @@ def get_redis():
         port = int(os.getenv("REDIS_PORT", 6379)),
         db   = 0,
         decode_responses = True,
+        # only used for wake-up hints: fail fast instead of stalling the crawl
+        socket_connect_timeout = 2,
+        socket_timeout         = 2,
+        retry                  = Retry(NoBackoff(), 0),
     )
 
 def get_db(retries: int = 10, delay: int = 2):
@@ -56,91 +86,267 @@ def get_db(retries: int = 10, delay: int = 2):
             else:
                 raise
 
-def download_sitemap() -> bytes:
-    """Try live sitemap first, fallback to baked file inside image."""
-    try:
-        resp = requests.get(SITEMAP_URL, headers=HEADERS, timeout=15)
-        resp.raise_for_status()
-        return resp.content
-    except Exception as e:
-        cached = os.getenv("SITEMAP_CACHED", "")
-        if cached and Path(cached).exists():
-            warnings.warn(f"Remote sitemap failed ({e}); using cached copy")
-            return Path(cached).read_bytes()
-        raise
-
-def get_first_n_urls(n: int) -> list[str]:
-    logging.info(f"Downloading sitemap: {SITEMAP_URL}")
-    raw_xml = download_sitemap()
-    root = ET.fromstring(raw_xml)
-    ns = {"sm": "http://www.sitemaps.org/schemas/sitemap/0.9"}
-    locs = [
-        loc.text.strip()
-        for loc in (tag.find("sm:loc", ns) for tag in root.findall("sm:url", ns))
-        if loc is not None and loc.text
-    ]
-    logging.info(f"Loaded {len(locs)} URLs from sitemap")
-    return locs[:n]
-
-# ↓ unchanged helper
-def safe_parsing(bs: BeautifulSoup) -> str:
-    if bs is None:
-        return ""
-    try:
-        h1      = bs.find('h1')
-        title   = " ".join(h1.stripped_strings) if h1 else ""
-        section = bs.find('section', class_='text-body')
-        content = " ".join(section.stripped_strings) if section else ""
-        return json.dumps({"title": title, "content": content}, ensure_ascii=False)
-    except Exception as e:
-        logging.warning(f"[PARSE FAIL] {e}")
-        return ""
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-# ───────────────────────── main crawl ─────────────────────
-def crawl_once():
-    logging.info(f"Loading first {MAX_PAGES} pages via custom list…")
-    urls = get_first_n_urls(MAX_PAGES)
+class StageTimer:
+    """Seconds spent per stage (fetch, extract, upsert), summed over one crawl pass"""
+
+    def __init__(self):
+        self.totals: dict[str, float] = {}
+        self.counts: dict[str, int]   = {}
 
-    db  = get_db(); db.autocommit = True
-    cur = db.cursor()
+    def add(self, name: str, seconds: float):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
 
-    for url in urls:
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
         try:
-            html = safe_parsing(BeautifulSoup(requests.get(url, headers=HEADERS, timeout=15).text, "html.parser"))
-        except Exception as e:
-            logging.error(f"[FETCH FAIL] {url} → {e}")
-            continue
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
 
-        if not html.strip():
-            logging.warning(f"[SKIP] {url} → empty content")
-            continue
+    def summary(self) -> str:
+        return ", ".join(f"{name} {total:.2f}s/{self.counts[name]}" for name, total in self.totals.items())
 
-        preview = html[:100].replace("\n", " ")
-        logging.info(f"[INSERT] {url} ({len(html)} chars)")
-        logging.debug(f"[CONTENT PREVIEW] {preview}…")
-        try:
-            cur.execute(
-                """
-                INSERT INTO gringo.raw_pages(url, relevant_content)
-                VALUES (%s,%s)
+# ───────────────────────── main crawl ─────────────────────
+def load_targets(cur, entries: list[SitemapEntry]) -> list[CrawlTarget]:
+    """Attach the validators and fetch time of our stored copy to every URL"""
+    cur.execute(
+        "SELECT url, etag, last_modified, fetched_at FROM gringo.raw_pages WHERE url = ANY(%s)",
+        ([entry.loc for entry in entries],),
+    )
+    known = {url: rest for url, *rest in cur.fetchall()}
+    targets = []
+    for entry in entries:
+        etag, last_modified, fetched_at = known.get(entry.loc, (None, None, None))
+        targets.append(CrawlTarget(entry.loc, entry.lastmod, etag, last_modified, fetched_at))
+    return targets
+
+def next_targets(cur, entries) -> list[CrawlTarget]:
+    """Pull the next SITEMAP_BATCH entries off the sitemap stream and look them up"""
+    batch = list(islice(entries, SITEMAP_BATCH))
+    return load_targets(cur, batch) if batch else []
+
+async def iter_targets(cur, entries):
+    """Feed the crawler batch by batch so only SITEMAP_BATCH entries are held at a time"""
+    seen = 0
+    while targets := await asyncio.to_thread(next_targets, cur, entries):
+        seen += len(targets)
+        for target in targets:
+            yield target
+    logging.info(f"Loaded {seen} URLs from sitemap")
+
+def fetched(result: CrawlResult) -> bool:
+    """True when the result carries a page to extract; logs why not otherwise"""
+    url = result.target.url
+    if result.skipped:
+        logging.debug(f"[SKIP] {url} → {result.skipped}")
+        return False
+    if result.not_modified:
+        logging.info(f"[UNCHANGED] {url} (304)")
+        return False
+    if not result.ok:
+        logging.error(f"[FETCH FAIL] {url} → {result.error}")
+        return False
+    return True
+
+def store_result(cur, result: CrawlResult, html: str, timings: StageTimer) -> bool:
+    """Persist an extracted page; True when the page was queued for the parser"""
+    url = result.target.url
+    if not html.strip():
+        logging.warning(f"[SKIP] {url} → empty content")
+        return False
+
+    preview = html[:100].replace("\n", " ")
+    logging.debug(f"[CONTENT PREVIEW] {preview}…")
+    try:
+        # Validators and fetch time are always refreshed (servers may rotate ETags
+        # on every response), but only new pages or changed content are (re-)queued
+        # for the parser, so byte-identical pages are not re-embedded. All CTEs
+        # share one snapshot, so "old" still sees the hash from before the upsert.
+        started = time.perf_counter()
+        cur.execute(
+            """
+            WITH old AS (
+                SELECT content_hash FROM gringo.raw_pages WHERE url = %(url)s
+            ), page AS (
+                INSERT INTO gringo.raw_pages(url, relevant_content, content_hash, etag, last_modified)
+                VALUES (%(url)s, %(html)s, %(hash)s, %(etag)s, %(last_modified)s)
                 ON CONFLICT(url) DO UPDATE
                 SET relevant_content = excluded.relevant_content,
+                    content_hash    = excluded.content_hash,
+                    etag            = excluded.etag,
+                    last_modified   = excluded.last_modified,
                     fetched_at      = current_timestamp
-                """,
-                (url, html),
+                RETURNING id, content_hash
             )
-        except Exception as e:
-            logging.error(f"[DB FAIL] {url} → {e}")
+            INSERT INTO gringo.parse_jobs(raw_page_id)
+            SELECT id FROM page
+            WHERE NOT EXISTS (SELECT 1 FROM old)
+               OR page.content_hash IS DISTINCT FROM (SELECT content_hash FROM old)
+            ON CONFLICT(raw_page_id) DO UPDATE
+            SET enqueued_at  = current_timestamp,
+                available_at = current_timestamp,
+                attempts     = 0,
+                last_error   = NULL,
+                dead         = false
+            """,
+            {"url": url, "html": html, "hash": content_hash(html),
+             "etag": result.etag, "last_modified": result.last_modified},
+        )
+        timings.add("upsert", time.perf_counter() - started)
+        if cur.rowcount:
+            logging.info(f"[INSERT] {url} ({len(html)} chars)")
+            return True
+        logging.info(f"[UNCHANGED] {url}")
+    except Exception as e:
+        logging.error(f"[DB FAIL] {url} → {e}")
+    return False
+
+def touch_pages(cur, urls: list[str]):
+    """Bump fetched_at of pages that answered 304, so the sitemap <lastmod> skip
+    compares against this pass rather than the last time their content changed"""
+    try:
+        cur.execute(
+            "UPDATE gringo.raw_pages SET fetched_at = current_timestamp WHERE url = ANY(%s)",
+            (urls,),
+        )
+    except Exception as e:
+        logging.error(f"[DB FAIL] refreshing fetched_at of {len(urls)} unchanged pages → {e}")
+
+def notify_parser(r: redis.Redis, channel: str):
+    """Wake-up hint only: the parser also polls gringo.parse_jobs, so a lost message is harmless"""
+    try:
+        r.publish(channel, "1")
+    except redis.RedisError as e:
+        logging.debug(f"[NOTIFY] {channel} not published: {e}")
+
+async def crawl_async():
+    logging.info(f"Streaming sitemap: {SITEMAP_URL}")
+    entries = iter_sitemap_with_fallback(SITEMAP_URL, HEADERS, os.getenv("SITEMAP_CACHED"))
+    if MAX_PAGES > 0:
+        entries = islice(entries, MAX_PAGES)
+
+    # Everything opened here is released on the way out, also when the pass fails:
+    # the __main__ loop retries forever and would otherwise pile up connections
+    with ExitStack() as resources:
+        db  = resources.enter_context(closing(get_db())); db.autocommit = True
+        cur = resources.enter_context(closing(db.cursor()))
+        # store_result runs in worker threads while the sitemap is still being read,
+        # so lookups get a connection of their own
+        lookup_db  = resources.enter_context(closing(get_db())); lookup_db.autocommit = True
+        lookup_cur = resources.enter_context(closing(lookup_db.cursor()))
+        r = resources.enter_context(closing(get_redis()))
 
-    cur.close(); db.close()
-    logging.info("Fetch pass complete ✔")
+        crawler = AsyncCrawler(
+            user_agent           = UA,
+            workers              = CRAWL_WORKERS,
+            per_host_concurrency = PER_HOST_CONCURRENCY,
+            per_host_delay       = PER_HOST_DELAY,
+            max_retries          = MAX_RETRIES,
+            respect_robots       = RESPECT_ROBOTS,
+        )
+        timings = StageTimer()
+        queued, last_notify = 0, 0.0
+        loop = asyncio.get_running_loop()
+        # spawn: forking a process that already runs threads can deadlock the children
+        extract_pool = ProcessPoolExecutor(
+            EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        ) if EXTRACT_WORKERS > 0 else None
+        if extract_pool is not None:
+            resources.callback(extract_pool.shutdown, cancel_futures=True)
+        # Bounds the pages held between download and storage; a full pipeline pauses the downloader
+        in_flight  = asyncio.Semaphore(max(1, EXTRACT_WORKERS) * 2)
+        store_lock = asyncio.Lock()                               # one cursor, one writer
+        pending    = set()
+        writes     = set()
+        not_modified: list[str] = []
+
+        async def write(store, *args):
+            """Run a blocking write on the shared cursor in a worker thread.
+
+            The write is its own shielded task: cancelling the caller cannot stop
+            the thread, so the task keeps the lock until it is done and is awaited
+            before the cursor is closed.
+            """
+            async def locked():
+                async with store_lock:
+                    return await asyncio.to_thread(store, cur, *args)
+            task = asyncio.create_task(locked())
+            writes.add(task)
+            task.add_done_callback(writes.discard)
+            return await asyncio.shield(task)
+
+        async def flush_not_modified():
+            if not not_modified:
+                return
+            urls = not_modified.copy()
+            not_modified.clear()
+            await write(touch_pages, urls)
+
+        async def process(result: CrawlResult):
+            nonlocal queued, last_notify
+            try:
+                url = result.target.url
+                if extract_pool is not None:
+                    html, elapsed = await loop.run_in_executor(extract_pool, extract_timed, url, result.text)
+                else:
+                    html, elapsed = await asyncio.to_thread(extract_timed, url, result.text)
+                timings.add("extract", elapsed)
+                # The DB write is blocking; keep it off the event loop
+                stored = await write(store_result, result, html, timings)
+                if stored:
+                    queued += 1
+                    if time.monotonic() - last_notify >= NOTIFY_INTERVAL:
+                        last_notify = time.monotonic()
+                        await asyncio.to_thread(notify_parser, r, JOBS_CHANNEL)
+            except Exception as e:
+                logging.error(f"[EXTRACT FAIL] {result.target.url} → {e}")
+            finally:
+                in_flight.release()
+
+        try:
+            async for result in crawler.crawl(iter_targets(lookup_cur, entries)):
+                if result.not_modified:
+                    not_modified.append(result.target.url)
+                    if len(not_modified) >= SITEMAP_BATCH:
+                        await flush_not_modified()
+                if not fetched(result):
+                    continue
+                timings.add("fetch", result.elapsed)
+                await in_flight.acquire()
+                task = asyncio.create_task(process(result))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            await asyncio.gather(*pending)
+            await flush_not_modified()
+        finally:
+            # On failure, stop the page tasks and let writes already running
+            # finish before their cursor is closed
+            for task in list(pending):
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            await asyncio.gather(*writes, return_exceptions=True)
+        if queued:
+            notify_parser(r, JOBS_CHANNEL)
+
+    logging.info(f"Fetch pass complete ✔ ({queued} pages queued for parsing, {crawler.stats.summary()})")
+    logging.info(f"Stage times: {timings.summary()}")
+
+def crawl_once():
+    logging.info(f"Loading {MAX_PAGES or 'all'} pages with {CRAWL_WORKERS} workers…")
+    asyncio.run(crawl_async())
 
 # ───────────────────────── entrypoint loop ────────────────
 if __name__ == "__main__":
     while True:
         try:
             crawl_once()
-            get_redis().publish('gringo:fetcher:done', '1')
+            with closing(get_redis()) as r:
+                notify_parser(r, 'gringo:fetcher:done')
             logging.info("Sent completion signal to parser")
             time.sleep(SITEMAP_TTL)
         except Exception as e:
@@ -0,0 +1,115 @@
+"""
+Streaming sitemap reader.
+
+Sitemaps are parsed incrementally with iterparse straight off the HTTP
+response (or a local file), so memory stays flat no matter how many <url>
+entries a sitemap holds. Sitemap indexes are followed recursively and
+gzip-compressed sitemaps (*.xml.gz) are decompressed on the fly.
+"""
+
+import gzip, io, logging
+from dataclasses import dataclass
+from datetime    import datetime, timezone
+from pathlib     import Path
+from typing      import BinaryIO, Iterator, Optional
+from xml.etree   import ElementTree as ET
+
+import requests
+
+NS          = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+GZIP_MAGIC  = b"\x1f\x8b"
+MAX_DEPTH   = 3          # sitemap index nesting we are willing to follow
+
+
+@dataclass
+class SitemapEntry:
+    loc:      str
+    lastmod:  Optional[datetime] = None
+    priority: Optional[float]    = None
+
+
+def parse_lastmod(value: Optional[str]) -> Optional[datetime]:
+    """W3C datetime from <lastmod>; date-only and naive values are taken as UTC"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def parse_priority(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def _decompressed(stream: BinaryIO) -> BinaryIO:
+    """Transparently gunzip *.xml.gz payloads (detected by magic bytes, not by name)"""
+    buffered = stream if isinstance(stream, io.BufferedReader) else io.BufferedReader(stream)
+    if buffered.peek(2)[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=buffered)
+    return buffered
+
+
+def open_sitemap(location: str, headers: dict, timeout: float = 30) -> BinaryIO:
+    """Binary stream for an http(s) URL or a local path"""
+    if not location.startswith(("http://", "https://")):
+        return _decompressed(open(location, "rb"))
+    resp = requests.get(location, headers=headers, timeout=timeout, stream=True)
+    resp.raise_for_status()
+    resp.raw.decode_content = True      # undo Content-Encoding, keep .gz bodies as-is
+    return _decompressed(resp.raw)
+
+
+def _text(elem: ET.Element, tag: str) -> Optional[str]:
+    child = elem.find(NS + tag)
+    return child.text.strip() if child is not None and child.text else None
+
+
+def iter_sitemap(location: str, headers: dict, depth: int = 0) -> Iterator[SitemapEntry]:
+    """Yield every <url> of a sitemap, descending into <sitemapindex> children"""
+    yield from _iter_stream(open_sitemap(location, headers), headers, depth)
+
+
+def iter_sitemap_with_fallback(url: str, headers: dict, cached: Optional[str]) -> Iterator[SitemapEntry]:
+    """Stream the live sitemap; fall back to the copy baked into the image if it cannot be opened"""
+    try:
+        stream = open_sitemap(url, headers)
+    except Exception as e:
+        if not (cached and Path(cached).exists()):
+            raise
+        logging.warning(f"Remote sitemap failed ({e}); using cached copy")
+        stream = open_sitemap(cached, headers)
+    yield from _iter_stream(stream, headers, 0)
+
+
+def _iter_stream(stream: BinaryIO, headers: dict, depth: int) -> Iterator[SitemapEntry]:
+    try:
+        context = ET.iterparse(stream, events=("start", "end"))
+        _, root = next(context)
+        for event, elem in context:
+            if event != "end":
+                continue
+            if elem.tag == NS + "url":
+                loc = _text(elem, "loc")
+                if loc:
+                    yield SitemapEntry(loc, parse_lastmod(_text(elem, "lastmod")), parse_priority(_text(elem, "priority")))
+                root.clear()            # drop finished entries, keeps memory O(1)
+            elif elem.tag == NS + "sitemap":
+                child = _text(elem, "loc")
+                root.clear()
+                if not child:
+                    continue
+                if depth >= MAX_DEPTH:
+                    logging.warning(f"[SITEMAP] not following {child}: index nesting deeper than {MAX_DEPTH}")
+                    continue
+                logging.info(f"[SITEMAP] following nested sitemap {child}")
+                try:
+                    yield from iter_sitemap(child, headers, depth + 1)
+                except (requests.RequestException, ET.ParseError, OSError) as e:
+                    logging.error(f"[SITEMAP] failed to read {child}: {e}")
+    finally:
+        stream.close()
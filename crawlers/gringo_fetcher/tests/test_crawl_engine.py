@@ -0,0 +1,100 @@
+"""AsyncCrawler against bench_crawl's local stand-in server"""
+
+import asyncio, threading, time
+from datetime    import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from bench_crawl import make_handler
+from crawl_engine import AsyncCrawler, CrawlTarget
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(latency: float = 0.0, error_rate: float = 0.0) -> str:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(latency, error_rate))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def crawl(targets: list[CrawlTarget], **kwargs) -> tuple[AsyncCrawler, dict]:
+    crawler = AsyncCrawler(user_agent="test-crawler", per_host_delay=0.0, **kwargs)
+
+    async def run():
+        return {result.target.url: result async for result in crawler.crawl(targets)}
+
+    return crawler, asyncio.run(run())
+
+
+def test_fetches_pages_and_their_validators(serve):
+    base = serve()
+    _, results = crawl([CrawlTarget(f"{base}/lt/{n}") for n in range(5)])
+
+    assert len(results) == 5
+    for n in range(5):
+        result = results[f"{base}/lt/{n}"]
+        assert result.status == 200
+        assert f"Article {n}" in result.text
+        assert result.etag == f'"{n}-v1"'
+
+
+def test_conditional_get_turns_unchanged_pages_into_304s(serve):
+    base = serve()
+    url = f"{base}/lt/7"
+    crawler, results = crawl([CrawlTarget(url, etag='"7-v1"'), CrawlTarget(f"{base}/lt/8", etag='"old"')])
+
+    assert results[url].not_modified
+    assert results[url].status == 304
+    assert results[url].text is None
+    assert results[url].etag == '"7-v1"'
+    assert results[f"{base}/lt/8"].status == 200
+    assert (crawler.stats.not_modified, crawler.stats.fetched) == (1, 1)
+
+
+def test_robots_disallowed_paths_are_skipped_without_a_request(serve):
+    base = serve()
+    _, results = crawl([CrawlTarget(f"{base}/private/1"), CrawlTarget(f"{base}/lt/1")])
+
+    assert results[f"{base}/private/1"].skipped == "robots"
+    assert results[f"{base}/private/1"].attempts == 0
+    assert results[f"{base}/lt/1"].ok
+
+    _, results = crawl([CrawlTarget(f"{base}/private/1")], respect_robots=False)
+    assert results[f"{base}/private/1"].ok
+
+
+def test_retry_after_replaces_the_exponential_backoff(serve):
+    # Every page answers 503 with "Retry-After: 0"; without honouring it the
+    # 10s backoff base would make three retries take over a minute
+    base = serve(error_rate=1.0)
+    started = time.monotonic()
+    crawler, results = crawl([CrawlTarget(f"{base}/lt/1")], max_retries=3, backoff_base=10.0)
+
+    result = results[f"{base}/lt/1"]
+    assert time.monotonic() - started < 5
+    assert result.status == 503
+    assert result.attempts == 4
+    assert not result.ok
+    assert (crawler.stats.failed, crawler.stats.retries) == (1, 3)
+
+
+def test_unchanged_lastmod_skips_the_request(serve):
+    base = serve()
+    fetched_at = datetime.now(timezone.utc)
+    _, results = crawl([
+        CrawlTarget(f"{base}/lt/1", lastmod=fetched_at - timedelta(days=1), fetched_at=fetched_at),
+        CrawlTarget(f"{base}/lt/2", lastmod=fetched_at + timedelta(days=1), fetched_at=fetched_at),
+    ])
+
+    assert results[f"{base}/lt/1"].skipped == "lastmod"
+    assert results[f"{base}/lt/2"].ok
@@ -1,19 +1,56 @@
 #!/usr/bin/env python3
 """
 Gringo Parser
-Step 2 → read uncached rows from gringo.raw_pages, parse, embed,
-store in gringo.documents. Triggered by fetcher completion.
+Step 2 → take queued rows of gringo.raw_pages, parse, embed,
+store in gringo.documents.
+
+Work arrives through gringo.parse_jobs, a durable queue the fetcher fills as
+pages land. Workers claim jobs with FOR UPDATE SKIP LOCKED under a lease, so
+several parser replicas can drain it side by side; a job is deleted in the
+same transaction that stores its embeddings and is retried with backoff on
+failure. Redis messages only wake idle workers up early; the queue is also
+polled, so nothing is lost while the parser is down.
+
+Only pages whose content hash differs from the one their document was
+embedded from are processed, and chunks whose text already has an embedding
+(matched by content hash) reuse it instead of calling the API again.
+
+Pages are split into chunks and every chunk gets its own embedding in
+gringo.chunks; the document-level vector is the normalized mean of its chunk
+vectors. Claimed rows are grouped into
+batches bounded by a token budget, embedded by several concurrent
+embed_documents calls and written back with bulk upserts (one transaction
+per batch).
 """
 
-import os, logging, psycopg2, json
+import os, time, random, logging, threading, hashlib, psycopg2, json
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from functools import lru_cache
+from dataclasses import dataclass
+from datetime import datetime
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
+import numpy as np
 import redis
+import tiktoken
 
 CHUNK_SIZE          = 1000
 CHUNK_OVERLAP       = 200
 
+EMBEDDING_MODEL     = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBED_BATCH_TOKENS  = int(os.getenv("EMBED_BATCH_TOKENS", "100000"))  # token budget per embeddings request
+EMBED_BATCH_SIZE    = int(os.getenv("EMBED_BATCH_SIZE", "256"))         # max chunks per embeddings request
+EMBED_CONCURRENCY   = int(os.getenv("EMBED_CONCURRENCY", "4"))          # embeddings requests in flight
+EMBED_MAX_RETRIES   = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+
+PARSE_CLAIM_SIZE    = int(os.getenv("PARSE_CLAIM_SIZE", "64"))          # jobs leased per round trip
+PARSE_LEASE_SECONDS = int(os.getenv("PARSE_LEASE_SECONDS", "600"))      # unacked jobs become due again after this
+PARSE_MAX_ATTEMPTS  = int(os.getenv("PARSE_MAX_ATTEMPTS", "5"))         # then the job is parked as dead
+PARSE_POLL_INTERVAL = float(os.getenv("PARSE_POLL_INTERVAL", "30"))     # idle queue poll, in seconds
+JOB_CHANNELS        = ("gringo:parse_jobs", "gringo:fetcher:done")     # wake-up hints from the fetcher
+INDEX_CHANNEL       = "gringo:documents:updated"                       # tells rag_api's vector index to sync
+
 PROJECT_ROOT    = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 load_dotenv(os.path.join(PROJECT_ROOT, ".env"))
 
@@ -53,85 +90,426 @@ def get_redis():
 		decode_responses=True
 	)
 
-splitter    = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
-embedder    = OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY"))
+# LangChain, openai and tiktoken's BPE ranks are loaded on first use, not at
+# import: an idle parser replica starts (and restarts) in a fraction of the time
+@lru_cache(maxsize=None)
+def get_splitter():
+	from langchain.text_splitter import RecursiveCharacterTextSplitter
+	return RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True)
 
-def parse_once():
-	db = get_db()
-	cur = db.cursor()
+@lru_cache(maxsize=None)
+def get_embedder():
+	from langchain_openai import OpenAIEmbeddings
+	# Retries are handled by embed_with_backoff so that all workers back off together
+	return OpenAIEmbeddings(
+		model=EMBEDDING_MODEL,
+		openai_api_key=os.getenv("OPENAI_API_KEY"),
+		max_retries=0,
+	)
 
-	# First check if we have any raw pages at all
-	cur.execute("SELECT COUNT(*) FROM gringo.raw_pages")
-	total_pages = cur.fetchone()[0]
-	logging.info(f"Total raw pages in database: {total_pages}")
+@lru_cache(maxsize=None)
+def get_encoding():
+	return tiktoken.get_encoding("cl100k_base")
 
-	cur.execute(
-		"""
-		select rp.id, rp.url, rp.relevant_content
-		from gringo.raw_pages rp
-		left join gringo.documents d on rp.id = d.raw_page_id
-		where d.id is null
-		"""
+@lru_cache(maxsize=None)
+def retryable_errors() -> tuple:
+	import openai
+	return (
+		openai.RateLimitError,
+		openai.APIConnectionError,
+		openai.APITimeoutError,
+		openai.InternalServerError,
 	)
-	rows = cur.fetchall()
-	logging.info(f"Found {len(rows)} pages to embed")
-	
-	if len(rows) == 0 and total_pages > 0:
-		logging.warning("No pages to embed but raw_pages table is not empty. This might indicate all pages are already embedded.")
-		# Check if we have any documents
-		cur.execute("SELECT COUNT(*) FROM gringo.documents")
-		doc_count = cur.fetchone()[0]
-		logging.info(f"Total documents in database: {doc_count}")
-
-	for raw_id, url, html in rows:
+
+@dataclass
+class Chunk:
+	ordinal: int
+	content: str
+	char_start: int
+	char_end: int
+	content_hash: str
+	vector: list[float] | None = None
+
+@dataclass
+class PendingPage:
+	raw_id: int
+	url: str
+	title: str
+	text: str
+	content_hash: str
+	chunks: list[Chunk]
+	tokens: int
+	claimed_at: datetime
+
+class Backoff:
+	"""Shared pause: once any worker is rate limited, every worker waits it out"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._until = 0.0
+
+	def wait(self):
+		with self._lock:
+			delay = self._until - time.monotonic()
+		if delay > 0:
+			time.sleep(delay)
+
+	def pause(self, seconds: float):
+		with self._lock:
+			self._until = max(self._until, time.monotonic() + seconds)
+
+backoff = Backoff()
+
+class StageTimer:
+	"""Wall time per pipeline stage, summed over one parse pass across worker threads"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.totals: dict[str, float] = {}
+		self.counts: dict[str, int] = {}
+
+	def reset(self):
+		with self._lock:
+			self.totals.clear()
+			self.counts.clear()
+
+	@contextmanager
+	def stage(self, name: str):
+		started = time.perf_counter()
 		try:
-			# Parse the JSON content from fetcher
-			content_data = json.loads(html)
-			title = content_data.get("title", "")
-			text = content_data.get("content", "")
-			
-			if not text:
-				logging.warning(f"Skip empty content for {url}")
-				continue
-
-			chunks = splitter.split_text(text)
-			vector = embedder.embed_query("\n\n".join(chunks))
-
-			cur.execute(
-				"""
-				insert into gringo.documents(url, title, content, embedding, raw_page_id)
-				values (%s,%s,%s,%s,%s)
-				on conflict(url) do update
-				set title=excluded.title,
-					content=excluded.content,
-					embedding=excluded.embedding,
-					raw_page_id=excluded.raw_page_id,
-					updated_at=current_timestamp
-				""",
-				(url, title, text, vector, raw_id),
+			yield
+		finally:
+			elapsed = time.perf_counter() - started
+			with self._lock:
+				self.totals[name] = self.totals.get(name, 0.0) + elapsed
+				self.counts[name] = self.counts.get(name, 0) + 1
+
+	def summary(self) -> str:
+		with self._lock:
+			return ", ".join(
+				f"{name} {total:.2f}s/{self.counts[name]}" for name, total in self.totals.items()
 			)
+
+timings = StageTimer()
+
+def content_hash(text: str) -> str:
+	return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def retry_delay(error: Exception, attempt: int) -> float:
+	response = getattr(error, "response", None)
+	retry_after = response.headers.get("retry-after") if response is not None else None
+	if retry_after:
+		try:
+			return float(retry_after)
+		except ValueError:
+			pass
+	return min(60.0, 2 ** attempt) * (0.5 + random.random())
+
+def embed_with_backoff(texts: list[str]) -> list[list[float]]:
+	for attempt in range(EMBED_MAX_RETRIES + 1):
+		backoff.wait()
+		try:
+			return get_embedder().embed_documents(texts)
+		except retryable_errors() as e:
+			if attempt == EMBED_MAX_RETRIES:
+				raise
+			delay = retry_delay(e, attempt)
+			logging.warning(f"Embedding request failed ({type(e).__name__}), backing off {delay:.1f}s")
+			backoff.pause(delay)
+
+def claim_jobs(db, limit: int) -> list[tuple]:
+	"""Lease up to `limit` due jobs by pushing their available_at past the lease"""
+	with timings.stage("claim"), db.cursor() as cur:
+		cur.execute(
+			"""
+			with claimed as (
+				update gringo.parse_jobs j
+				set attempts = j.attempts + 1,
+					available_at = current_timestamp + make_interval(secs => %s)
+				where j.raw_page_id in (
+					select raw_page_id
+					from gringo.parse_jobs
+					where not dead and available_at <= current_timestamp
+					order by available_at
+					limit %s
+					for update skip locked
+				)
+				returning j.raw_page_id
+			)
+			select rp.id, rp.url, rp.relevant_content, rp.content_hash,
+				d.id is null or d.content_hash is distinct from rp.content_hash,
+				current_timestamp
+			from claimed c
+			join gringo.raw_pages rp on rp.id = c.raw_page_id
+			left join gringo.documents d on rp.id = d.raw_page_id
+			""",
+			(PARSE_LEASE_SECONDS, limit),
+		)
+		rows = cur.fetchall()
+		db.commit()
+	return rows
+
+def ack_jobs(cur, jobs: list[tuple[int, datetime]]):
+	"""Delete finished jobs, unless the fetcher re-queued the page after they were claimed"""
+	cur.execute(
+		"""
+		delete from gringo.parse_jobs j
+		using unnest(%s::bigint[], %s::timestamptz[]) as done(raw_page_id, claimed_at)
+		where j.raw_page_id = done.raw_page_id
+			and j.enqueued_at <= done.claimed_at
+		""",
+		([raw_id for raw_id, _ in jobs], [claimed_at for _, claimed_at in jobs]),
+	)
+
+def fail_jobs(db, batch: list[PendingPage], error: str):
+	"""Schedule a retry with exponential backoff, or park the job after PARSE_MAX_ATTEMPTS"""
+	with db.cursor() as cur:
+		cur.execute(
+			"""
+			update gringo.parse_jobs j
+			set last_error = %s,
+				dead = j.attempts >= %s,
+				available_at = current_timestamp + make_interval(secs => least(3600, 30 * power(2, j.attempts)))
+			from unnest(%s::bigint[], %s::timestamptz[]) as failed(raw_page_id, claimed_at)
+			where j.raw_page_id = failed.raw_page_id
+				and j.enqueued_at <= failed.claimed_at
+			returning j.raw_page_id, j.dead
+			""",
+			(error[:2000], PARSE_MAX_ATTEMPTS, [p.raw_id for p in batch], [p.claimed_at for p in batch]),
+		)
+		dead = [raw_id for raw_id, is_dead in cur.fetchall() if is_dead]
+	db.commit()
+	if dead:
+		logging.error(f"Gave up on raw pages {dead} after {PARSE_MAX_ATTEMPTS} attempts")
+
+def build_page(raw_id, url, html, raw_hash, claimed_at) -> PendingPage | None:
+	try:
+		# Parse the JSON content from fetcher
+		content_data = json.loads(html)
+	except json.JSONDecodeError as e:
+		logging.error(f"Failed to parse JSON for {url}: {e}")
+		return None
+
+	title = content_data.get("title", "")
+	text = content_data.get("content", "")
+	if not text:
+		logging.warning(f"Skip empty content for {url}")
+		return None
+
+	chunks = split_chunks(text)
+	encoding = get_encoding()
+	tokens = sum(len(encoding.encode(c.content)) for c in chunks)
+	return PendingPage(raw_id, url, title, text, raw_hash or content_hash(html), chunks, tokens, claimed_at)
+
+def iter_claimed_pages(db):
+	"""Claim queued pages a few at a time until nothing is due; jobs needing no work are acked at once"""
+	while rows := claim_jobs(db, PARSE_CLAIM_SIZE):
+		pages, done = [], []
+		for raw_id, url, html, raw_hash, stale, claimed_at in rows:
+			with timings.stage("parse"):
+				page = build_page(raw_id, url, html, raw_hash, claimed_at) if stale else None
+			if page is None:
+				done.append((raw_id, claimed_at))
+			else:
+				pages.append(page)
+		if done:
+			with db.cursor() as cur:
+				ack_jobs(cur, done)
 			db.commit()
-			logging.info(f"Embedded {url}")
-		except json.JSONDecodeError as e:
-			logging.error(f"Failed to parse JSON for {url}: {e}")
-			continue
+		yield from pages
+
+def split_chunks(text: str) -> list[Chunk]:
+	chunks = []
+	for ordinal, doc in enumerate(get_splitter().create_documents([text])):
+		start = doc.metadata.get("start_index", -1)
+		if start < 0:
+			# The splitter could not locate the chunk; fall back to the previous end
+			start = chunks[-1].char_end if chunks else 0
+		chunks.append(Chunk(
+			ordinal, doc.page_content, start, start + len(doc.page_content), content_hash(doc.page_content)
+		))
+	return chunks
+
+def mean_vector(vectors: list[list[float]]) -> list[float]:
+	"""Document-level embedding: normalized mean of the chunk embeddings"""
+	mean = np.mean(np.asarray(vectors, dtype=np.float64), axis=0)
+	norm = np.linalg.norm(mean)
+	return (mean / norm if norm else mean).tolist()
+
+@lru_cache(maxsize=4)
+def vector_template(dimensions: int) -> str:
+	return "[" + ",".join(["%.8g"] * dimensions) + "]"
+
+def vector_literal(vector: list[float]) -> str:
+	"""pgvector text form; much cheaper on both ends than the numeric[] psycopg2 makes of a list"""
+	return vector_template(len(vector)) % tuple(vector)
+
+def attach_reusable_vectors(db, batch: list[PendingPage]) -> int:
+	"""Reuse stored embeddings of chunks whose exact text is already indexed"""
+	hashes = list({c.content_hash for p in batch for c in p.chunks})
+	with db.cursor() as cur:
+		cur.execute(
+			"""
+			select distinct on (content_hash) content_hash, embedding::real[]
+			from gringo.chunks
+			where content_hash = any(%s)
+			""",
+			(hashes,),
+		)
+		known = dict(cur.fetchall())
+	db.commit()
+
+	reused = 0
+	for chunk in (c for p in batch for c in p.chunks):
+		if chunk.content_hash in known:
+			chunk.vector = known[chunk.content_hash]
+			reused += 1
+	return reused
+
+def embed_batch(batch: list[PendingPage]) -> list[list[list[float]]]:
+	"""Embed every chunk without a reusable vector in one request, regrouped per page"""
+	missing = [c for p in batch for c in p.chunks if c.vector is None]
+	if missing:
+		with timings.stage("embed"):
+			vectors = embed_with_backoff([c.content for c in missing])
+		for chunk, vector in zip(missing, vectors):
+			chunk.vector = vector
+	return [[c.vector for c in page.chunks] for page in batch]
+
+def iter_batches(pages):
+	"""Group pages so each embeddings request stays within the token and input limits"""
+	batch, batch_tokens, batch_inputs = [], 0, 0
+	for page in pages:
+		if batch and (batch_tokens + page.tokens > EMBED_BATCH_TOKENS
+				or batch_inputs + len(page.chunks) > EMBED_BATCH_SIZE):
+			yield batch
+			batch, batch_tokens, batch_inputs = [], 0, 0
+		batch.append(page)
+		batch_tokens += page.tokens
+		batch_inputs += len(page.chunks)
+	if batch:
+		yield batch
+
+def write_batch(db, batch: list[PendingPage], chunk_vectors: list[list[list[float]]]):
+	with timings.stage("upsert"), db.cursor() as cur:
+		document_ids = dict(execute_values(
+			cur,
+			"""
+			insert into gringo.documents(url, title, content, embedding, raw_page_id, content_hash)
+			values %s
+			on conflict(url) do update
+			set title=excluded.title,
+				content=excluded.content,
+				embedding=excluded.embedding,
+				raw_page_id=excluded.raw_page_id,
+				content_hash=excluded.content_hash,
+				updated_at=current_timestamp
+			returning url, id
+			""",
+			[
+				(p.url, p.title, p.text, vector_literal(mean_vector(vectors)), p.raw_id, p.content_hash)
+				for p, vectors in zip(batch, chunk_vectors)
+			],
+			template="(%s, %s, %s, %s::vector, %s, %s)",
+			page_size=len(batch),
+			fetch=True,
+		))
+
+		ids = [document_ids[p.url] for p in batch]
+		cur.execute("delete from gringo.chunks where document_id = any(%s)", (ids,))
+		execute_values(
+			cur,
+			"""
+			insert into gringo.chunks(document_id, ordinal, content, char_start, char_end, embedding, content_hash)
+			values %s
+			""",
+			[
+				(document_id, c.ordinal, c.content, c.char_start, c.char_end, vector_literal(vector), c.content_hash)
+				for document_id, page, vectors in zip(ids, batch, chunk_vectors)
+				for c, vector in zip(page.chunks, vectors)
+			],
+			template="(%s, %s, %s, %s, %s, %s::vector, %s)",
+			page_size=1000,
+		)
+		ack_jobs(cur, [(p.raw_id, p.claimed_at) for p in batch])
+		db.commit()
+
+def notify_index(r: redis.Redis):
+	"""Sync hint only: rag_api's vector index also polls updated_at, so a lost message is harmless"""
+	try:
+		r.publish(INDEX_CHANNEL, "1")
+	except redis.RedisError as e:
+		logging.debug(f"{INDEX_CHANNEL} not published: {e}")
+
+def parse_once():
+	"""Drain every job that is currently due"""
+	db = get_db()
+	r = get_redis()
+
+	embedded = failed = reused = 0
+	started = time.monotonic()
+	timings.reset()
+
+	def collect(future, batch):
+		nonlocal embedded, failed
+		try:
+			write_batch(db, batch, future.result())
+			notify_index(r)
+			embedded += len(batch)
+			logging.info(f"Embedded batch of {len(batch)} pages ({embedded} so far)")
 		except Exception as e:
-			logging.error(f"Error processing {url}: {e}")
-			continue
+			db.rollback()
+			failed += len(batch)
+			logging.error(f"Error processing batch starting at {batch[0].url}: {e}")
+			fail_jobs(db, batch, f"{type(e).__name__}: {e}")
+
+	with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as pool:
+		in_flight = {}
+		for batch in iter_batches(iter_claimed_pages(db)):
+			# Bound the number of batches held in memory
+			while len(in_flight) >= EMBED_CONCURRENCY * 2:
+				done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+				for future in done:
+					collect(future, in_flight.pop(future))
+			with timings.stage("reuse"):
+				reused += attach_reusable_vectors(db, batch)
+			in_flight[pool.submit(embed_batch, batch)] = batch
+
+		for future in list(in_flight):
+			collect(future, in_flight.pop(future))
 
-	cur.close()
 	db.close()
-	logging.info("Batch finished ✔")
+	r.close()
+	if embedded or failed:
+		logging.info(
+			f"Batch finished ✔ ({embedded} pages embedded, {reused} chunk embeddings reused, "
+			f"{failed} failed in {time.monotonic() - started:.1f}s)"
+		)
+		logging.info(f"Stage times: {timings.summary()}")
+
+def wait_for_work(pubsub):
+	"""Block until the fetcher hints at new jobs or the poll interval runs out"""
+	message = pubsub.get_message(ignore_subscribe_messages=True, timeout=PARSE_POLL_INTERVAL)
+	# Hints that piled up meanwhile are all served by the next pass
+	while message is not None:
+		message = pubsub.get_message(ignore_subscribe_messages=True, timeout=0)
 
 if __name__ == "__main__":
-	r = get_redis()
-	pubsub = r.pubsub()
-	pubsub.subscribe('gringo:fetcher:done')
-	
-	logging.info("Parser started, waiting for fetcher completion signal...")
-	
-	for message in pubsub.listen():
-		if message['type'] == 'message':
-			logging.info("Received fetcher completion signal, starting parse...")
+	logging.info("Parser started, draining gringo.parse_jobs...")
+	pubsub = None
+
+	while True:
+		try:
 			parse_once()
-			logging.info("Parse complete, waiting for next signal...")
+		except Exception as e:
+			logging.error(f"Parse pass failed: {e}")
+
+		try:
+			if pubsub is None:
+				pubsub = get_redis().pubsub()
+				pubsub.subscribe(*JOB_CHANNELS)
+			wait_for_work(pubsub)
+		except redis.RedisError as e:
+			logging.warning(f"Redis unavailable ({e}), polling the queue every {PARSE_POLL_INTERVAL:.0f}s")
+			pubsub = None
+			time.sleep(PARSE_POLL_INTERVAL)
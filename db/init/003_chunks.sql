@@ -0,0 +1,19 @@
+-- Chunk-level index: one embedding per text chunk of a document.
+-- Retrieval runs over chunks and merges hits back per document.
+create table if not exists gringo.chunks (
+	id          bigserial primary key,
+	document_id bigint not null references gringo.documents(id) on delete cascade,
+	ordinal     int not null,
+	content     text not null,
+	char_start  int not null,
+	char_end    int not null,
+	embedding   vector(1536) not null,
+	created_at  timestamptz default current_timestamp,
+	unique (document_id, ordinal)
+);
+
+-- HNSW does not need training data, so it is safe to create on an empty table
+create index if not exists idx_chunks_embedding on gringo.chunks using hnsw (embedding vector_cosine_ops);
+
+comment on table gringo.chunks is 'Embedded chunks of gringo.documents; the unit of vector retrieval';
+comment on column gringo.chunks.char_start is 'Offset of the chunk in documents.content (characters)';
@@ -0,0 +1,25 @@
+-- Content hashes (sha256 hex of the UTF-8 text) for incremental re-indexing.
+-- raw_pages.content_hash  : hash of relevant_content as last fetched
+-- documents.content_hash  : hash of the raw page content the document was embedded from
+-- chunks.content_hash     : hash of the chunk text, used to reuse embeddings of unchanged chunks
+alter table gringo.raw_pages add column if not exists content_hash text;
+alter table gringo.documents add column if not exists content_hash text;
+alter table gringo.chunks    add column if not exists content_hash text;
+
+update gringo.raw_pages
+set content_hash = encode(sha256(convert_to(relevant_content, 'UTF8')), 'hex')
+where content_hash is null;
+
+update gringo.chunks
+set content_hash = encode(sha256(convert_to(content, 'UTF8')), 'hex')
+where content_hash is null;
+
+-- Documents that are already chunked were embedded from the current raw page
+update gringo.documents d
+set content_hash = rp.content_hash
+from gringo.raw_pages rp
+where rp.id = d.raw_page_id
+	and d.content_hash is null
+	and exists (select 1 from gringo.chunks c where c.document_id = d.id);
+
+create index if not exists idx_chunks_content_hash on gringo.chunks(content_hash);
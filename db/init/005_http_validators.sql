@@ -0,0 +1,4 @@
+-- HTTP cache validators of the last successful fetch, sent back as
+-- If-None-Match / If-Modified-Since so unchanged pages answer 304
+alter table gringo.raw_pages add column if not exists etag text;
+alter table gringo.raw_pages add column if not exists last_modified text;
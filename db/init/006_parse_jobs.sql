@@ -0,0 +1,24 @@
+-- Durable work queue between fetcher and parser.
+-- The fetcher enqueues a raw page whenever it is inserted or its content changes;
+-- parser workers claim jobs with FOR UPDATE SKIP LOCKED, pushing available_at
+-- forward as a lease, and delete them in the same transaction that stores the
+-- embeddings. Failed jobs are retried with backoff and parked as dead after too
+-- many attempts.
+create table if not exists gringo.parse_jobs (
+	raw_page_id  bigint primary key references gringo.raw_pages(id) on delete cascade,
+	enqueued_at  timestamptz not null default current_timestamp,
+	available_at timestamptz not null default current_timestamp,
+	attempts     int not null default 0,
+	last_error   text,
+	dead         boolean not null default false
+);
+create index if not exists idx_parse_jobs_available on gringo.parse_jobs(available_at) where not dead;
+
+-- Pages fetched before the queue existed and not embedded yet
+insert into gringo.parse_jobs(raw_page_id)
+select rp.id
+from gringo.raw_pages rp
+left join gringo.documents d on rp.id = d.raw_page_id
+where d.id is null
+	or d.content_hash is distinct from rp.content_hash
+on conflict (raw_page_id) do nothing;
@@ -0,0 +1,10 @@
+-- Lexical index for hybrid retrieval.
+-- The 'simple' configuration only lowercases and splits on word boundaries:
+-- no stemming or stop words, so Hebrew text, street names and form numbers are
+-- indexed verbatim. The column is generated, so every chunk the parser writes
+-- is indexed without extra work on its side.
+alter table gringo.chunks
+	add column if not exists tsv tsvector
+	generated always as (to_tsvector('simple', content)) stored;
+
+create index if not exists idx_chunks_tsv on gringo.chunks using gin (tsv);
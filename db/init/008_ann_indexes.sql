@@ -0,0 +1,6 @@
+-- The ivfflat index from 002 was built on an empty table: its 100 lists were
+-- trained on no data, so recall is poor once the table fills up. HNSW needs no
+-- training and keeps search latency flat as the corpus grows; use
+-- rag_api/index_maintenance.py to rebuild with parameters sized for the corpus.
+drop index if exists gringo.idx_documents_embedding;
+create index if not exists idx_documents_embedding on gringo.documents using hnsw (embedding vector_cosine_ops);
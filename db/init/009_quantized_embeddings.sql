@@ -0,0 +1,44 @@
+-- Compact embedding storage, needs pgvector >= 0.7 (see the db image in
+-- docker-compose.yml). Embeddings are stored as halfvec: 2 bytes per
+-- dimension instead of 4, which halves the tables and their HNSW indexes for
+-- a precision loss far below the distance between neighbours. Queries keep
+-- sending ::vector literals, pgvector casts them to halfvec implicitly.
+--
+-- A binary-quantized expression index (1 bit per dimension) is added next to
+-- each HNSW index; with BINARY_PREFILTER_FACTOR set, rag_api takes its
+-- candidates from it by Hamming distance and rescores them by cosine distance.
+--
+-- Idempotent, so it can also migrate an existing database by hand:
+--   psql -f db/init/009_quantized_embeddings.sql
+-- Converting a column rewrites its table under an exclusive lock.
+alter extension vector update;
+
+do $$
+declare
+	target record;
+begin
+	for target in
+		select * from (values
+			('gringo.chunks', 'gringo.idx_chunks_embedding'),
+			('gringo.documents', 'gringo.idx_documents_embedding')
+		) t(tbl, idx)
+	loop
+		if (select format_type(atttypid, atttypmod) from pg_attribute
+			where attrelid = target.tbl::regclass and attname = 'embedding') = 'vector(1536)' then
+			-- vector_cosine_ops indexes cannot be rebuilt on halfvec
+			execute format('drop index if exists %s', target.idx);
+			execute format(
+				'alter table %s alter column embedding type halfvec(1536) using embedding::halfvec(1536)',
+				target.tbl
+			);
+		end if;
+	end loop;
+end $$;
+
+create index if not exists idx_chunks_embedding on gringo.chunks using hnsw (embedding halfvec_cosine_ops);
+create index if not exists idx_documents_embedding on gringo.documents using hnsw (embedding halfvec_cosine_ops);
+
+create index if not exists idx_chunks_embedding_bits on gringo.chunks
+	using hnsw ((binary_quantize(embedding)::bit(1536)) bit_hamming_ops);
+create index if not exists idx_documents_embedding_bits on gringo.documents
+	using hnsw ((binary_quantize(embedding)::bit(1536)) bit_hamming_ops);
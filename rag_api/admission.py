@@ -0,0 +1,234 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Token buckets: sustained requests per minute and burst size, per Telegram
+# user and for the whole process. A rate of 0 disables that limit.
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv("RATE_LIMIT_USER_PER_MINUTE", "20"))
+RATE_LIMIT_USER_BURST = int(os.getenv("RATE_LIMIT_USER_BURST", "5"))
+RATE_LIMIT_GLOBAL_PER_MINUTE = float(os.getenv("RATE_LIMIT_GLOBAL_PER_MINUTE", "600"))
+RATE_LIMIT_GLOBAL_BURST = int(os.getenv("RATE_LIMIT_GLOBAL_BURST", "50"))
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "10000"))
+# LLM calls allowed to wait for a slot; beyond that new work is shed with a 503
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "64"))
+# Seconds a call may wait for a slot before it is shed too; 0 waits forever
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+
+# Lower values are served first when LLM slots are contended
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        """Seconds until ``cost`` tokens are available, 0 if they are now"""
+        self._refill(now)
+        missing = min(cost, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, cost: float):
+        self.tokens -= min(cost, self.capacity)
+
+
+class RateLimiter:
+    """Per-user and global token buckets.
+
+    A request is admitted only when both buckets can pay for it, so a refused
+    request costs nothing. A request costing more than a bucket holds (a big
+    batch) drains the full bucket instead of being refused forever. Per-user
+    buckets live in an LRU bounded by ``max_users``; an evicted user simply
+    starts again with a full bucket.
+    """
+
+    def __init__(self, user_per_minute: float, user_burst: int, global_per_minute: float,
+                 global_burst: int, max_users: int):
+        self.user_rate = user_per_minute / 60
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.global_bucket = TokenBucket(global_per_minute / 60, global_burst) if global_per_minute else None
+        self._users: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self.admitted = 0
+        self.limited = 0
+
+    def _user_bucket(self, user_id: str) -> TokenBucket:
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        self._users.move_to_end(user_id)
+        return bucket
+
+    def check(self, user_id: Optional[str], cost: int = 1) -> float:
+        """Admit the request and return 0, or return the seconds to wait before retrying"""
+        now = time.monotonic()
+        buckets = []
+        if user_id and self.user_rate:
+            buckets.append(self._user_bucket(user_id))
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+
+        wait = max((bucket.wait_time(cost, now) for bucket in buckets), default=0.0)
+        if wait > 0:
+            self.limited += 1
+            return wait
+        for bucket in buckets:
+            bucket.take(cost)
+        self.admitted += 1
+        return 0.0
+
+    def stats(self) -> dict:
+        return {
+            "tracked_users": len(self._users),
+            "admitted_total": self.admitted,
+            "rate_limited_total": self.limited,
+        }
+
+
+class Overloaded(Exception):
+    """Raised when the LLM wait queue is full or a waiter hit its deadline"""
+
+
+class PriorityScheduler:
+    """Bounded concurrency with a bounded priority queue in front of it.
+
+    ``slot(priority)`` runs immediately while fewer than ``concurrency`` holders
+    are active; otherwise it waits in a heap ordered by (priority, arrival).
+    When ``max_queue`` callers are already waiting, new ones are shed with
+    ``Overloaded`` right away rather than piling up behind a saturated LLM, and
+    a waiter still queued after ``queue_timeout`` seconds is shed the same way.
+    A released slot is handed straight to the next waiter.
+    """
+
+    def __init__(self, concurrency: int, max_queue: int, queue_timeout: float = 0):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._queued = 0
+        self._waiters = []
+        self._arrivals = itertools.count()
+        self.shed = 0
+        self.enqueued = 0
+        self.timed_out = 0
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_INTERACTIVE):
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: int):
+        if self._active < self.concurrency and not self._queued:
+            self._active += 1
+            return
+        if self._queued >= self.max_queue:
+            self.shed += 1
+            raise Overloaded(f"{self._queued} LLM calls already waiting")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), future))
+        self._queued += 1
+        self.enqueued += 1
+        try:
+            await asyncio.wait_for(future, self.queue_timeout or None)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just before the caller gave up
+                self._release()
+            else:
+                self._queued -= 1
+            raise
+        except asyncio.TimeoutError as e:
+            if future.done() and not future.cancelled():
+                # Handed over right at the deadline; keep the slot
+                return
+            self._queued -= 1
+            self.timed_out += 1
+            raise Overloaded(f"No LLM slot freed up within {self.queue_timeout:g}s") from e
+
+    def _release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._queued -= 1
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "llm_active": self._active,
+            "llm_queued": self._queued,
+            "llm_concurrency": self.concurrency,
+            "llm_max_queue": self.max_queue,
+            "llm_enqueued_total": self.enqueued,
+            "llm_shed_total": self.shed,
+            "llm_queue_timeouts_total": self.timed_out,
+        }
+
+
+class SingleFlight:
+    """Coalesce identical concurrent calls into one.
+
+    The first caller for a key starts the work; callers arriving while it is
+    in flight await the same result (or exception). The work is shielded, so
+    one caller disconnecting does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, work: Callable[[], Awaitable]):
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logger.info("Joined an identical request already in flight")
+        else:
+            task = asyncio.ensure_future(work())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task):
+        self._calls.pop(key, None)
+        # Retrieve the outcome so a failure nobody is waiting for anymore is not reported as unhandled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "coalesced_total": self.coalesced,
+        }
+
+
+rate_limiter = RateLimiter(
+    user_per_minute=RATE_LIMIT_USER_PER_MINUTE,
+    user_burst=RATE_LIMIT_USER_BURST,
+    global_per_minute=RATE_LIMIT_GLOBAL_PER_MINUTE,
+    global_burst=RATE_LIMIT_GLOBAL_BURST,
+    max_users=RATE_LIMIT_MAX_USERS,
+)
+query_flights = SingleFlight()
@@ -0,0 +1,159 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    sources: List[Any]
+    # document id -> updated_at of every source the answer was generated from
+    source_stamps: Dict[int, Optional[datetime]]
+    limit: int
+    stored_at: float
+    # retrieval settings the sources were selected with (mode, weights)
+    retrieval: tuple = ()
+
+
+class AnswerCache:
+    """Semantic cache of generated RAG answers.
+
+    An entry is a candidate for a new query when the cosine similarity of the
+    two query embeddings reaches ``threshold`` and the request asked for the
+    same number of sources with the same retrieval settings. Candidates are
+    only served after the caller has confirmed that none of the source
+    documents changed since the answer was generated (see ``is_fresh``), so
+    re-embedding a page by the parser invalidates every answer built on it.
+    """
+
+    def __init__(self, max_size: int, ttl: float, threshold: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._free_slots = list(range(max_size - 1, -1, -1))
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self, embedding: List[float], limit: int, retrieval: tuple = ()
+    ) -> Optional[tuple]:
+        """Return ``(slot, entry, similarity)`` of the best candidate, if any"""
+        query = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            if not self._entries:
+                return None
+            slots = np.fromiter(
+                self._entries.keys(), dtype=np.int64, count=len(self._entries)
+            )
+            similarities = self._vectors[slots] @ query
+            for i in np.argsort(similarities)[::-1]:
+                similarity = float(similarities[i])
+                if similarity < self.threshold:
+                    break
+                slot = int(slots[i])
+                entry = self._entries[slot]
+                if now - entry.stored_at > self.ttl:
+                    self._evict(slot)
+                    continue
+                if entry.limit != limit or entry.retrieval != retrieval:
+                    continue
+                self._entries.move_to_end(slot)
+                return slot, entry, similarity
+        return None
+
+    @staticmethod
+    def is_fresh(
+        entry: CachedAnswer, current_stamps: Dict[int, Optional[datetime]]
+    ) -> bool:
+        return current_stamps == entry.source_stamps
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def invalidate(self, slot: int):
+        with self._lock:
+            if slot in self._entries:
+                self._evict(slot)
+                self.stale += 1
+
+    def store(self, embedding: List[float], limit: int, answer: str, sources: List[Any],
+              source_stamps: Dict[int, Optional[datetime]], retrieval: tuple = ()):
+        vector = self._normalize(embedding)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros(
+                    (self.max_size, vector.shape[0]), dtype=np.float32
+                )
+            if not self._free_slots:
+                oldest = next(iter(self._entries))
+                self._evict(oldest)
+                self.evictions += 1
+            slot = self._free_slots.pop()
+            self._vectors[slot] = vector
+            self._entries[slot] = CachedAnswer(
+                answer=answer,
+                sources=sources,
+                source_stamps=source_stamps,
+                limit=limit,
+                stored_at=time.monotonic(),
+                retrieval=retrieval,
+            )
+
+    def _evict(self, slot: int):
+        del self._entries[slot]
+        self._vectors[slot] = 0.0
+        self._free_slots.append(slot)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": ANSWER_CACHE_ENABLED,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+answer_cache = AnswerCache(
+    max_size=ANSWER_CACHE_SIZE,
+    ttl=ANSWER_CACHE_TTL,
+    threshold=ANSWER_CACHE_THRESHOLD,
+)
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Retrieval benchmark and recall evaluation for the RAG API.
+
+Optionally loads a synthetic corpus into pgvector (documents and chunks
+embedded with the deterministic fake backend), replays queries against the
+FastAPI app at a given concurrency and reports latency percentiles,
+throughput and recall@k against exact brute-force search over the same
+vectors. Runs offline: EMBEDDING_BACKEND and LLM_BACKEND default to "fake".
+
+    python bench_retrieval.py --load --docs 5000
+    python bench_retrieval.py --queries queries.jsonl --concurrency 16 --requests 2000
+    python bench_retrieval.py --endpoint query --url http://localhost:8000
+    python bench_retrieval.py --engine numpy --set retrieval_mode='"vector"'
+
+Without --url the app runs in-process over httpx's ASGI transport. A remote
+server must also use EMBEDDING_BACKEND=fake for recall to be meaningful.
+--engine picks VECTOR_ENGINE for the in-process app, so pgvector and the
+NumPy replica can be compared on the same corpus and queries.
+queries.jsonl holds one {"query": "...", "limit": 5} object per line; other
+QueryRequest fields (retrieval_mode, ef_search, ...) are passed through.
+Recall is measured against exact vector search, so in hybrid mode it shows
+how far fusion moves results away from pure nearest neighbours.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from itertools import cycle, islice
+from typing import Dict, List, Optional
+
+os.environ.setdefault("EMBEDDING_BACKEND", "fake")
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("EMBEDDING_CACHE_REDIS", "false")
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+# The replay sends no X-User-ID at fake-LLM speed; the global bucket would
+# turn most of it into 429s
+os.environ.setdefault("RATE_LIMIT_GLOBAL_PER_MINUTE", "0")
+os.environ.setdefault("RATE_LIMIT_USER_PER_MINUTE", "0")
+# Measure a warm replica: the in-process app finishes its warm-up before serving
+os.environ.setdefault("STARTUP_MODE", "eager")
+
+import httpx
+import numpy as np
+from psycopg2.extras import execute_values
+
+from db import db_pool
+from fake_backends import fake_embedding
+
+BENCH_URL_PREFIX = "bench://"
+CHUNK_WORDS = 120
+
+
+# ───────────────────────── synthetic corpus ─────────────────────────
+def pseudo_word(rng: random.Random) -> str:
+    syllables = rng.randint(2, 4)
+    return "".join(
+        rng.choice("bcdfghklmnprstvz") + rng.choice("aeiou") for _ in range(syllables)
+    )
+
+
+def synthetic_corpus(docs: int, chunks_per_doc: int, seed: int):
+    """Yield (n, title, chunks); documents of one topic share most of their words"""
+    rng = random.Random(seed)
+    vocabulary = list({pseudo_word(rng) for _ in range(8000)})
+    topics = [rng.sample(vocabulary, 40) for _ in range(max(1, docs // 20))]
+    for n in range(docs):
+        topic = topics[n % len(topics)]
+        chunks = [
+            " ".join(
+                rng.choice(topic) if rng.random() < 0.5 else rng.choice(vocabulary)
+                for _ in range(CHUNK_WORDS)
+            )
+            for _ in range(chunks_per_doc)
+        ]
+        yield n, f"Bench document {n}", chunks
+
+
+def load_corpus(docs: int, chunks_per_doc: int, seed: int, batch_size: int = 500):
+    """Replace any previous benchmark corpus with a fresh synthetic one"""
+    started = time.perf_counter()
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM gringo.documents WHERE url LIKE %s",
+                (BENCH_URL_PREFIX + "%",),
+            )
+
+    corpus = synthetic_corpus(docs, chunks_per_doc, seed)
+    while batch := list(islice(corpus, batch_size)):
+        documents, chunks = [], []
+        for n, title, texts in batch:
+            vectors = np.asarray(
+                [fake_embedding(text) for text in texts], dtype=np.float64
+            )
+            mean = vectors.mean(axis=0)
+            mean /= np.linalg.norm(mean) or 1.0
+            url = f"{BENCH_URL_PREFIX}doc/{n}"
+            documents.append((url, title, " ".join(texts), mean.tolist()))
+            offset = 0
+            for ordinal, (text, vector) in enumerate(zip(texts, vectors, strict=True)):
+                text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                chunks.append((n, ordinal, text, offset, offset + len(text),
+                               vector.tolist(), text_hash))
+                offset += len(text) + 1
+
+        with db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                ids = dict(execute_values(
+                    cur,
+                    """
+                    INSERT INTO gringo.documents(url, title, content, embedding)
+                    VALUES %s
+                    RETURNING url, id
+                    """,
+                    documents,
+                    fetch=True,
+                ))
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO gringo.chunks(document_id, ordinal, content,
+                        char_start, char_end, embedding, content_hash)
+                    VALUES %s
+                    """,
+                    [(ids[f"{BENCH_URL_PREFIX}doc/{n}"], *rest) for n, *rest in chunks],
+                    page_size=1000,
+                )
+                cur.execute("ANALYZE gringo.documents; ANALYZE gringo.chunks")
+        print(f"  loaded {batch[-1][0] + 1}/{docs} documents")
+    elapsed = time.perf_counter() - started
+    print(f"Loaded {docs} documents x {chunks_per_doc} chunks in {elapsed:.1f}s")
+
+
+def synthetic_queries(count: int, limit: int, seed: int) -> List[dict]:
+    """Short word windows cut out of stored benchmark chunks"""
+    rng = random.Random(seed + 1)
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT c.content
+                FROM gringo.chunks c
+                JOIN gringo.documents d ON d.id = c.document_id
+                WHERE d.url LIKE %s
+                ORDER BY random()
+                LIMIT %s
+            """, (BENCH_URL_PREFIX + "%", count))
+            texts = [row[0] for row in cur.fetchall()]
+    if not texts:
+        raise SystemExit(
+            "No benchmark corpus found, run with --load first or pass --queries"
+        )
+    queries = []
+    for text in islice(cycle(texts), count):
+        words = text.split()
+        start = rng.randrange(max(1, len(words) - 8))
+        queries.append({"query": " ".join(words[start:start + 8]), "limit": limit})
+    return queries
+
+
+def read_queries(path: str, limit: int) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        queries = [json.loads(line) for line in f if line.strip()]
+    for query in queries:
+        query.setdefault("limit", limit)
+    return queries
+
+
+# ───────────────────────── exact search ─────────────────────────────
+class ExactIndex:
+    """Brute-force cosine search over every stored vector, the recall reference"""
+
+    def __init__(self, unit: str):
+        self.unit = unit
+        table = "gringo.chunks" if unit == "chunks" else "gringo.documents"
+        owner = "document_id" if unit == "chunks" else "id"
+        with db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {owner}, embedding::real[] FROM {table}")
+                rows = cur.fetchall()
+        self.document_ids, self.owner = np.unique(
+            np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)),
+            return_inverse=True,
+        )
+        matrix = np.asarray([row[1] for row in rows], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.matrix = matrix / np.where(norms == 0, 1, norms)
+        self.size = len(rows)
+
+    def top_k(self, query: str, k: int) -> List[int]:
+        similarities = self.matrix @ np.asarray(fake_embedding(query), dtype=np.float32)
+        # a document ranks by its best chunk, exactly like retrieval.merge_chunks
+        best = np.full(len(self.document_ids), -np.inf, dtype=np.float32)
+        np.maximum.at(best, self.owner, similarities)
+        k = min(k, len(best))
+        top = np.argpartition(-best, k - 1)[:k] if k else []
+        return self.document_ids[top].tolist()
+
+
+# ───────────────────────── replay ───────────────────────────────────
+async def replay(client: httpx.AsyncClient, endpoint: str, queries: List[dict],
+                 concurrency: int) -> List[dict]:
+    path = "/results" if endpoint == "results" else "/query"
+    pending = iter(queries)
+    samples = []
+
+    async def worker():
+        for query in pending:
+            started = time.perf_counter()
+            try:
+                resp = await client.post(path, json=query)
+                status = resp.status_code
+                body = resp.json() if status == 200 else None
+            except httpx.HTTPError as e:
+                status, body = type(e).__name__, None
+            latency = time.perf_counter() - started
+            documents = body if endpoint == "results" else (body or {}).get("sources")
+            samples.append({
+                "query": query,
+                "status": status,
+                "latency": latency,
+                "ids": [doc["id"] for doc in documents or []],
+            })
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples
+
+
+async def run_requests(args, queries: List[dict]) -> tuple:
+    timeout = httpx.Timeout(120.0)
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=timeout) as client:
+            return await measure(client, args, queries)
+
+    import rag_api
+    transport = httpx.ASGITransport(app=rag_api.app)
+    async with rag_api.app.router.lifespan_context(rag_api.app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=timeout
+        ) as client:
+            return await measure(client, args, queries)
+
+
+async def measure(client: httpx.AsyncClient, args, queries: List[dict]) -> tuple:
+    """Send the warm-up queries unmeasured, then time the replay of the rest"""
+    warmup, measured = queries[:args.warmup], queries[args.warmup:]
+    await replay(client, args.endpoint, warmup, args.concurrency)
+    started = time.perf_counter()
+    samples = await replay(client, args.endpoint, measured, args.concurrency)
+    return samples, time.perf_counter() - started
+
+
+# ───────────────────────── report ───────────────────────────────────
+def summarize(samples: List[dict], elapsed: float, exact: Optional[ExactIndex]) -> Dict:
+    ok = [s for s in samples if s["status"] == 200]
+    latencies = np.asarray([s["latency"] for s in ok]) * 1000
+    report = {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+    }
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        report.update(p50_ms=round(p50, 2), p95_ms=round(p95, 2), p99_ms=round(p99, 2),
+                      max_ms=round(float(latencies.max()), 2))
+    if exact is not None and ok:
+        recalls = []
+        for sample in ok:
+            query = sample["query"]
+            expected = set(exact.top_k(query["query"], query["limit"]))
+            if expected:
+                recalls.append(len(expected & set(sample["ids"])) / len(expected))
+        report["recall_at_k"] = round(float(np.mean(recalls)), 4) if recalls else None
+        report["exact_vectors"] = exact.size
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    ap.add_argument("--load", action="store_true",
+                    help="(re)load the synthetic corpus first")
+    ap.add_argument("--docs", type=int, default=2000,
+                    help="synthetic documents to load")
+    ap.add_argument("--chunks-per-doc", type=int, default=4)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--queries",
+                    help="JSONL file of QueryRequest bodies "
+                         "(default: synthetic queries)")
+    ap.add_argument("--requests", type=int, default=500,
+                    help="requests to send, queries are cycled")
+    ap.add_argument("--warmup", type=int, default=20,
+                    help="unmeasured requests sent first")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--limit", type=int, default=5,
+                    help="k, for queries that do not set a limit")
+    ap.add_argument("--endpoint", choices=["results", "query"], default="results")
+    ap.add_argument("--url",
+                    help="benchmark a running server instead of the in-process app")
+    ap.add_argument("--unit", choices=["chunks", "documents"],
+                    default=os.getenv("RETRIEVAL_UNIT", "chunks"),
+                    help="retrieval unit of the server, for the exact reference")
+    ap.add_argument("--engine", choices=["pgvector", "numpy"],
+                    default=os.getenv("VECTOR_ENGINE", "pgvector"),
+                    help="vector search engine of the in-process app")
+    ap.add_argument("--set", action="append", default=[], metavar="FIELD=VALUE",
+                    help="extra QueryRequest field for every query, "
+                         "e.g. --set ef_search=100")
+    ap.add_argument("--no-recall", action="store_true",
+                    help="skip the brute-force reference")
+    ap.add_argument("--output", help="also write the report as JSON to this file")
+    args = ap.parse_args()
+    # Read when rag_api is imported by run_requests
+    os.environ["VECTOR_ENGINE"] = args.engine
+
+    db_pool.open()
+    try:
+        if args.load:
+            load_corpus(args.docs, args.chunks_per_doc, args.seed)
+
+        if args.queries:
+            base = read_queries(args.queries, args.limit)
+        else:
+            base = synthetic_queries(min(args.requests, 1000), args.limit, args.seed)
+        overrides = {
+            key: json.loads(value)
+            for key, value in (item.split("=", 1) for item in args.set)
+        }
+        queries = [
+            {**query, **overrides}
+            for query in islice(cycle(base), args.warmup + args.requests)
+        ]
+
+        exact = None if args.no_recall else ExactIndex(args.unit)
+        samples, elapsed = asyncio.run(run_requests(args, queries))
+        report = summarize(samples, elapsed, exact)
+    finally:
+        db_pool.close()
+
+    print(f"requests    {report['requests']} ({report['errors']} errors)"
+          f" in {report['elapsed_s']:.2f}s"
+          f" → {report['throughput_rps']:.1f} req/s at concurrency {args.concurrency}")
+    if "p50_ms" in report:
+        print(f"latency ms  p50 {report['p50_ms']:.1f}  p95 {report['p95_ms']:.1f}"
+              f"  p99 {report['p99_ms']:.1f}  max {report['max_ms']:.1f}")
+    if report.get("recall_at_k") is not None:
+        print(f"recall@k    {report['recall_at_k']:.4f}"
+              f" (exact search over {report['exact_vectors']} vectors)")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), **report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+logger = logging.getLogger(__name__)
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "5"))
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes free within the acquire timeout"""
+
+
+class PoolClosedError(RuntimeError):
+    """Raised when a connection is asked for before open() or after close()"""
+
+
+class DatabasePool:
+    """Bounded psycopg2 connection pool shared by all request handlers.
+
+    psycopg2's ThreadedConnectionPool raises as soon as it is exhausted, so a
+    semaphore sized to ``max_size`` makes callers wait (up to
+    ``acquire_timeout`` seconds) for a free connection instead. Connections are
+    blocking, so callers are expected to run on a worker thread, never directly
+    on the event loop.
+    """
+
+    def __init__(
+        self, min_size: int, max_size: int, acquire_timeout: float, **connect_kwargs
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool bounds: min={min_size}, max={max_size}")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self._connect_kwargs = connect_kwargs
+        self._pool: Optional[ThreadedConnectionPool] = None
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        # Connections parked in the pool; psycopg2 keeps at most min_size of
+        # them and closes the rest on putconn, which is mirrored here
+        self._idle = 0
+        self._waiting = 0
+        self._acquired_total = 0
+        self._timeouts_total = 0
+        self._discarded_total = 0
+        self._wait_seconds_total = 0.0
+
+    def open(self):
+        if self._pool is not None:
+            return
+        logger.info(f"Opening database pool (min={self.min_size}, max={self.max_size})")
+        self._pool = ThreadedConnectionPool(
+            self.min_size, self.max_size, **self._connect_kwargs
+        )
+        with self._lock:
+            self._idle = self.min_size
+
+    def close(self):
+        if self._pool is None:
+            return
+        logger.info("Closing database pool")
+        self._pool.closeall()
+        self._pool = None
+        with self._lock:
+            self._idle = 0
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for one transaction.
+
+        The transaction is committed when the block exits cleanly and rolled
+        back otherwise; broken connections are dropped from the pool.
+        """
+        if self._pool is None:
+            raise PoolClosedError("Database pool is not open")
+
+        started = time.perf_counter()
+        with self._lock:
+            self._waiting += 1
+        acquired = self._slots.acquire(timeout=self.acquire_timeout)
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._waiting -= 1
+            if not acquired:
+                self._timeouts_total += 1
+            else:
+                self._in_use += 1
+                self._acquired_total += 1
+                self._wait_seconds_total += waited
+        if not acquired:
+            raise PoolTimeoutError(
+                f"No database connection available after {self.acquire_timeout:.1f}s"
+            )
+
+        conn = None
+        discard = False
+        try:
+            conn = self._pool.getconn()
+            with self._lock:
+                self._idle = max(0, self._idle - 1)
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                if conn.closed:
+                    discard = True
+                else:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        discard = True
+                raise
+        finally:
+            if conn is not None:
+                discard = discard or bool(conn.closed)
+                self._pool.putconn(conn, close=discard)
+                with self._lock:
+                    if discard:
+                        self._discarded_total += 1
+                    elif self._idle < self.min_size:
+                        self._idle += 1
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            acquired = self._acquired_total
+            waited = self._wait_seconds_total
+            return {
+                "open": self._pool is not None,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "acquire_timeout": self.acquire_timeout,
+                "in_use": self._in_use,
+                "idle": self._idle,
+                "waiting": self._waiting,
+                "acquired_total": acquired,
+                "timeouts_total": self._timeouts_total,
+                "discarded_total": self._discarded_total,
+                "avg_wait_ms": (waited / acquired * 1000) if acquired else 0.0,
+            }
+
+
+db_pool = DatabasePool(
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+    dbname=os.getenv("POSTGRES_DB"),
+    user=os.getenv("POSTGRES_USER"),
+    password=os.getenv("POSTGRES_PASSWORD"),
+    host=os.getenv("POSTGRES_HOST"),
+    port=os.getenv("POSTGRES_PORT"),
+)
@@ -0,0 +1,201 @@
+import os
+import time
+import logging
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import List, Optional
+
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", str(24 * 3600)))
+EMBEDDING_CACHE_REDIS = os.getenv("EMBEDDING_CACHE_REDIS", "false").lower() == "true"
+EMBEDDING_CACHE_REDIS_TTL = int(os.getenv("EMBEDDING_CACHE_REDIS_TTL", str(7 * 24 * 3600)))
+# Most recently embedded queries tracked in Redis, so a new replica can prime
+# its memory tier with them before taking traffic
+EMBEDDING_CACHE_RECENT = int(os.getenv("EMBEDDING_CACHE_RECENT", "1000"))
+# After a Redis error the shared tier is skipped for this long so a dead Redis
+# never adds a connect timeout to every request
+REDIS_RETRY_AFTER = 30.0
+
+
+def normalize_query(text: str) -> str:
+    """Canonical form used for cache keys: NFKC, case-folded, single-spaced"""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+class EmbeddingCache:
+    """Two-tier query-embedding cache keyed on (model, normalized query).
+
+    The first tier is an in-process LRU bounded by entry count and TTL. The
+    optional second tier is Redis, shared by every rag_api replica; vectors
+    are stored there as packed float32 with a server-side expiry, next to a
+    sorted set of the most recently embedded keys (see prime()).
+    """
+
+    def __init__(self, max_size: int, ttl: float, redis_client: Optional[redis.Redis] = None,
+                 redis_ttl: int = EMBEDDING_CACHE_REDIS_TTL, recent_size: int = EMBEDDING_CACHE_RECENT):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.redis_client = redis_client
+        self.redis_ttl = redis_ttl
+        self.recent_size = recent_size
+        self._entries: "OrderedDict[str, tuple[float, array]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis_down_until = 0.0
+        self.memory_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.redis_errors = 0
+        self.primed = 0
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        digest = hashlib.sha256(normalize_query(text).encode("utf-8")).hexdigest()
+        return f"rag:emb:{model}:{digest}"
+
+    @staticmethod
+    def recent_key(model: str) -> str:
+        return f"rag:emb:recent:{model}"
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = self.make_key(model, text)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, vector = entry
+                if now - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return vector.tolist()
+                del self._entries[key]
+
+        vector = self._redis_get(key)
+        if vector is not None:
+            self._remember(key, vector)
+            with self._lock:
+                self.redis_hits += 1
+            return vector.tolist()
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, model: str, text: str, embedding: List[float]):
+        key = self.make_key(model, text)
+        vector = array("f", embedding)
+        self._remember(key, vector)
+        self._redis_set(model, key, vector)
+
+    def prime(self, model: str, limit: int) -> int:
+        """Copy the vectors of up to ``limit`` recently embedded queries from Redis into memory"""
+        limit = min(limit, self.max_size)
+        if limit <= 0 or not self._redis_available():
+            return 0
+        try:
+            keys = self.redis_client.zrevrange(self.recent_key(model), 0, limit - 1)
+            values = self.redis_client.mget(keys) if keys else []
+        except redis.RedisError as e:
+            self._redis_failed(e)
+            return 0
+        loaded = 0
+        # Oldest first, so the most recent queries end up last to be evicted
+        for key, raw in zip(reversed(keys), reversed(values)):
+            if raw is None:
+                continue
+            vector = array("f")
+            vector.frombytes(raw)
+            self._remember(key.decode(), vector)
+            loaded += 1
+        with self._lock:
+            self.primed += loaded
+        return loaded
+
+    def _remember(self, key: str, vector: array):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _redis_available(self) -> bool:
+        return self.redis_client is not None and time.monotonic() >= self._redis_down_until
+
+    def _redis_failed(self, e: Exception):
+        logger.warning(f"Embedding cache Redis tier unavailable, skipping for {REDIS_RETRY_AFTER:.0f}s: {e}")
+        with self._lock:
+            self.redis_errors += 1
+            self._redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+
+    def _redis_get(self, key: str) -> Optional[array]:
+        if not self._redis_available():
+            return None
+        try:
+            raw = self.redis_client.get(key)
+        except redis.RedisError as e:
+            self._redis_failed(e)
+            return None
+        if raw is None:
+            return None
+        vector = array("f")
+        vector.frombytes(raw)
+        return vector
+
+    def _redis_set(self, model: str, key: str, vector: array):
+        if not self._redis_available():
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.set(key, vector.tobytes(), ex=self.redis_ttl)
+            if self.recent_size:
+                pipe.zadd(self.recent_key(model), {key: time.time()})
+                pipe.zremrangebyrank(self.recent_key(model), 0, -self.recent_size - 1)
+            pipe.execute()
+        except redis.RedisError as e:
+            self._redis_failed(e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.redis_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "redis_enabled": self.redis_client is not None,
+                "memory_hits": self.memory_hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "redis_errors": self.redis_errors,
+                "primed": self.primed,
+                "hit_rate": (self.memory_hits + self.redis_hits) / lookups if lookups else 0.0,
+            }
+
+
+def get_redis():
+    return redis.Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        db=0,
+        socket_timeout=0.5,
+        socket_connect_timeout=0.5,
+        # Fail fast: a cache miss is cheaper than retrying a dead Redis
+        retry=Retry(NoBackoff(), 0),
+    )
+
+
+embedding_cache = EmbeddingCache(
+    max_size=EMBEDDING_CACHE_SIZE,
+    ttl=EMBEDDING_CACHE_TTL,
+    redis_client=get_redis() if EMBEDDING_CACHE_REDIS else None,
+)
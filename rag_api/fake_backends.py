@@ -0,0 +1,86 @@
+"""
+Deterministic offline stand-ins for the OpenAI embedding and chat models.
+
+Selected with EMBEDDING_BACKEND=fake / LLM_BACKEND=fake, so the API, the
+retrieval benchmark and local development run without network access or an
+API key. Fake embeddings are signed hashed bags of words: texts that share
+words are close in cosine space, which is enough to exercise retrieval and
+measure recall, and the same text always maps to the same vector.
+"""
+import hashlib
+import os
+import re
+import time
+from types import SimpleNamespace
+from typing import List, Union
+
+import numpy as np
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+EMBEDDING_DIMENSIONS = 1536  # matches vector(1536) in the schema
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0"))  # seconds per answer
+FAKE_LLM_ANSWER = "This is a fake answer generated without calling a language model."
+
+WORD_RE = re.compile(r"\w+")
+
+
+def fake_embedding(text: str) -> List[float]:
+    vector = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    for word in WORD_RE.findall(text.casefold()):
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        index = int.from_bytes(digest[:4], "little") % EMBEDDING_DIMENSIONS
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+class FakeEmbeddings:
+    """Mirrors ``OpenAI().embeddings.create`` closely enough for rag_api"""
+
+    def create(self, input: Union[str, List[str]], model: str, **kwargs):
+        texts = [input] if isinstance(input, str) else input
+        return SimpleNamespace(
+            data=[
+                SimpleNamespace(index=i, embedding=fake_embedding(text))
+                for i, text in enumerate(texts)
+            ],
+            model=model,
+            usage=SimpleNamespace(prompt_tokens=0, total_tokens=0),
+        )
+
+
+class FakeEmbeddingsClient:
+    def __init__(self):
+        self.embeddings = FakeEmbeddings()
+
+
+class FakeChatModel(FakeListChatModel):
+    """Canned answer after a fixed delay, streamed character by character"""
+
+    latency: float = 0.0
+
+    def _call(self, *args, **kwargs) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        return super()._call(*args, **kwargs)
+
+
+class FakeCondenseModel(FakeChatModel):
+    """Query rewriter stand-in: returns the follow-up question unchanged.
+
+    The condense prompt ends with ``Follow-up question: <question>``, so the
+    last line of the last message after its label is the original question.
+    """
+
+    def _call(self, messages, *args, **kwargs) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        return messages[-1].content.rstrip().rsplit("\n", 1)[-1].split(": ", 1)[-1]
+
+
+def fake_llm() -> FakeChatModel:
+    return FakeChatModel(responses=[FAKE_LLM_ANSWER], latency=FAKE_LLM_LATENCY)
+
+
+def fake_condense_llm() -> FakeCondenseModel:
+    return FakeCondenseModel(responses=[""], latency=FAKE_LLM_LATENCY)
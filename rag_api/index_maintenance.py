@@ -0,0 +1,140 @@
+"""
+Rebuild the pgvector ANN indexes with parameters sized for the current corpus.
+
+    python index_maintenance.py                                  # show the plan only
+    python index_maintenance.py --apply                          # rebuild both indexes as HNSW
+    python index_maintenance.py --apply --method ivfflat --table chunks
+
+New indexes are built CONCURRENTLY under a temporary name and swapped in, so
+searches keep running during a rebuild. The suggested ef_search / probes can
+be set with HNSW_EF_SEARCH / IVFFLAT_PROBES or per request.
+"""
+import os
+import math
+import logging
+import argparse
+from typing import Dict, Tuple
+
+import psycopg2
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger("index_maintenance")
+
+MAINTENANCE_WORK_MEM = os.getenv("INDEX_MAINTENANCE_WORK_MEM", "1GB")
+
+# table name -> (qualified table, index name)
+INDEXES = {
+    "chunks": ("gringo.chunks", "idx_chunks_embedding"),
+    "documents": ("gringo.documents", "idx_documents_embedding"),
+}
+
+
+def connect():
+    return psycopg2.connect(
+        dbname=os.getenv("POSTGRES_DB"),
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST"),
+        port=os.getenv("POSTGRES_PORT"),
+    )
+
+
+def row_count(cur, table: str) -> int:
+    """Planner estimate when the table has been analyzed, exact count otherwise"""
+    cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", (table,))
+    estimate = cur.fetchone()[0]
+    if estimate and estimate > 0:
+        return estimate
+    cur.execute(f"SELECT count(*) FROM {table}")
+    return cur.fetchone()[0]
+
+
+def index_params(method: str, rows: int) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """(build parameters, suggested search settings) following the pgvector guidance"""
+    if method == "ivfflat":
+        # rows / 1000 lists up to 1M rows, sqrt(rows) beyond; probe about sqrt(lists)
+        lists = max(1, rows // 1000) if rows <= 1_000_000 else int(math.sqrt(rows))
+        return {"lists": lists}, {"probes": max(1, int(math.sqrt(lists)))}
+    if rows < 100_000:
+        return {"m": 16, "ef_construction": 64}, {"ef_search": 40}
+    if rows < 1_000_000:
+        return {"m": 16, "ef_construction": 128}, {"ef_search": 100}
+    return {"m": 24, "ef_construction": 200}, {"ef_search": 200}
+
+
+def operator_class(cur, table: str) -> str:
+    """Cosine operator class matching the embedding column (halfvec after db/init/009)"""
+    cur.execute("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attname = 'embedding'
+    """, (table,))
+    column_type = cur.fetchone()[0]
+    return "halfvec_cosine_ops" if column_type.startswith("halfvec") else "vector_cosine_ops"
+
+
+def current_definition(cur, index: str) -> str:
+    cur.execute("SELECT indexdef FROM pg_indexes WHERE schemaname = 'gringo' AND indexname = %s", (index,))
+    row = cur.fetchone()
+    return row[0] if row else "(missing)"
+
+
+def rebuild(conn, table: str, index: str, method: str, params: Dict[str, int]):
+    """Build the new index next to the old one, then swap them in one short transaction"""
+    options = ", ".join(f"{key} = {value}" for key, value in params.items())
+    temp = f"{index}_new"
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("SET maintenance_work_mem = %s", (MAINTENANCE_WORK_MEM,))
+        opclass = operator_class(cur, table)
+        # Leftover of an interrupted run is invalid and would block the rename
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS gringo.{temp}")
+        logger.info(f"Building {temp} on {table} using {method} ({options})...")
+        cur.execute(
+            f"CREATE INDEX CONCURRENTLY {temp} ON {table} "
+            f"USING {method} (embedding {opclass}) WITH ({options})"
+        )
+    conn.autocommit = False
+    with conn.cursor() as cur:
+        cur.execute(f"DROP INDEX IF EXISTS gringo.{index}")
+        cur.execute(f"ALTER INDEX gringo.{temp} RENAME TO {index}")
+        cur.execute(f"ANALYZE {table}")
+    conn.commit()
+    logger.info(f"Swapped in new {index}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--table", choices=[*INDEXES, "all"], default="all")
+    ap.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    ap.add_argument("--apply", action="store_true", help="rebuild the indexes (default: only print the plan)")
+    args = ap.parse_args()
+
+    tables = list(INDEXES) if args.table == "all" else [args.table]
+    conn = connect()
+    try:
+        for name in tables:
+            table, index = INDEXES[name]
+            with conn.cursor() as cur:
+                rows = row_count(cur, table)
+                definition = current_definition(cur, index)
+            conn.commit()
+            params, search = index_params(args.method, rows)
+            logger.info(f"{table}: ~{rows} rows, current index: {definition}")
+            logger.info(f"{table}: planned {args.method} {params}, suggested search settings {search}")
+
+            if not args.apply:
+                continue
+            if args.method == "ivfflat" and rows == 0:
+                # ivfflat clusters are trained on the rows present at build time
+                logger.warning(f"Skipping {table}: ivfflat cannot be trained on an empty table")
+                continue
+            rebuild(conn, table, index, args.method, params)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+from fastapi import Request
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Correlation id of the request being served, set by request_context and
+# attached to every log record; the bot sends its own so both sides match
+REQUEST_ID_HEADER = "X-Request-ID"
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REQUEST_LATENCY = Histogram(
+    "rag_request_duration_seconds",
+    "Time to the response headers of an HTTP request",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_LATENCY = Histogram(
+    "rag_stage_duration_seconds",
+    "Time spent in one stage of the RAG pipeline",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "rag_llm_tokens_total",
+    "Tokens of retrieved context sent to the LLM and of the answers it generated",
+    ["kind"],
+)
+
+# Keys of the /stats dictionaries that only ever grow; every other numeric key is a gauge
+STATS_COUNTERS = {
+    "hits", "misses", "memory_hits", "redis_hits", "evictions", "redis_errors", "stale",
+    "acquired_total", "timeouts_total", "discarded_total",
+    "admitted_total", "rate_limited_total", "llm_enqueued_total", "llm_shed_total",
+    "llm_queue_timeouts_total", "coalesced_total",
+    "syncs_total", "reloads_total", "replaced_rows_total", "sync_errors_total",
+}
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+def install_request_id_logging():
+    """Make %(request_id)s available to the formatters of the root handlers"""
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
+
+
+def new_request_id(incoming: Optional[str]) -> str:
+    """Keep the caller's id when it is a sane token, otherwise mint one"""
+    if incoming and len(incoming) <= 128 and incoming.isprintable():
+        return incoming
+    return uuid.uuid4().hex
+
+
+@contextmanager
+def stage(name: str):
+    """Time a pipeline stage into rag_stage_duration_seconds{stage=name}"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_LATENCY.labels(name).observe(elapsed)
+        logger.debug(f"Stage {name} took {elapsed * 1000:.1f} ms")
+
+
+async def request_context(request: Request, call_next):
+    """HTTP middleware: tag the request with its id and record its latency"""
+    request_id = new_request_id(request.headers.get(REQUEST_ID_HEADER))
+    token = request_id_var.set(request_id)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers[REQUEST_ID_HEADER] = request_id
+        return response
+    finally:
+        # Label by route template, not raw path, so /documents/{id} stays one series
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        REQUEST_LATENCY.labels(request.method, route, str(status)).observe(time.perf_counter() - started)
+        request_id_var.reset(token)
+
+
+class StatsCollector:
+    """Publishes the numbers of /stats (pool, caches, token counter) at scrape time.
+
+    Reading the existing counters when Prometheus scrapes avoids counting the
+    same events twice; keys listed in STATS_COUNTERS become counters, the rest
+    gauges. A counter family drops its ``_total`` suffix, so two keys can map to
+    one metric name; that is refused, since Prometheus rejects such a scrape.
+    """
+
+    def __init__(self, sources: Dict[str, Callable[[], dict]]):
+        self.sources = sources
+
+    def collect(self):
+        emitted = set()
+        for source, stats in self.sources.items():
+            for key, value in stats().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"rag_{source}_{key}"
+                description = f"{key} of {source} (see /stats)"
+                if key in STATS_COUNTERS:
+                    family = CounterMetricFamily(name, description, value=value)
+                else:
+                    family = GaugeMetricFamily(name, description, value=value)
+                names = {family.name} | {sample.name for sample in family.samples}
+                if names & emitted:
+                    raise ValueError(f"/stats key {source}.{key} clashes with metric {family.name}")
+                emitted |= names
+                yield family
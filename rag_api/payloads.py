@@ -0,0 +1,113 @@
+"""
+Lean response payloads for the document lists of /results and /query.
+
+Clients pick the document fields they need and can ask for a ``snippet``: a
+short window of the retrieved content around the query terms, optionally
+with the matches wrapped in highlight marks, instead of the whole content
+(up to MAX_TOKENS_PER_DOC tokens per document). Shaped payloads are plain
+dicts serialized by orjson, skipping pydantic response validation, and
+responses are gzip-compressed when the client accepts it.
+"""
+import os
+import re
+from itertools import islice
+from typing import List, Optional, Sequence, Tuple
+
+import orjson
+from fastapi.responses import JSONResponse
+from starlette.middleware.gzip import GZipMiddleware
+
+DOCUMENT_FIELDS = ("id", "url", "title", "content", "similarity", "updated_at")
+SNIPPET_FIELD = "snippet"
+SNIPPET_CHARS = int(os.getenv("SNIPPET_CHARS", "240"))
+SNIPPET_MAX_TERMS = 16
+SNIPPET_MAX_MATCHES = 256  # matches considered when placing the window
+SNIPPET_SNAP_CHARS = 20  # how far a window edge may move to avoid cutting a word
+ELLIPSIS = "…"
+TERM_RE = re.compile(r"\w{2,}")
+
+# Internal traffic is mostly small JSON: a mid compression level keeps most of
+# the size reduction for a fraction of level 9's CPU
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1000"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON rendered by orjson; UTC datetimes end in Z like pydantic's"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+
+
+def dumps(data) -> str:
+    return orjson.dumps(data, option=orjson.OPT_UTC_Z).decode()
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """GZip for regular responses; SSE streams must reach the client event by event"""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/stream"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+def term_pattern(query: str) -> Optional[re.Pattern]:
+    """Case-insensitive alternation of the query's words, longest first"""
+    terms = sorted({term.lower() for term in TERM_RE.findall(query)}, key=len, reverse=True)
+    if not terms:
+        return None
+    return re.compile("|".join(map(re.escape, terms[:SNIPPET_MAX_TERMS])), re.IGNORECASE)
+
+
+def best_window(matches: List[re.Match], chars: int) -> int:
+    """Start of the window of ``chars`` covering the most distinct terms, then the most matches"""
+    lead = chars // 5  # show a little context before the first match
+    best_start, best_score = 0, (0, 0)
+    end = 0
+    for i, first in enumerate(matches):
+        while end < len(matches) and matches[end].end() <= first.start() - lead + chars:
+            end += 1
+        covered = matches[i:end]
+        score = (len({m.group().lower() for m in covered}), len(covered))
+        if score > best_score:
+            best_start, best_score = max(0, first.start() - lead), score
+    return best_start
+
+
+def snippet(content: str, pattern: Optional[re.Pattern], chars: int,
+            highlight: Optional[Tuple[str, str]] = None) -> str:
+    matches = list(islice(pattern.finditer(content), SNIPPET_MAX_MATCHES)) if pattern else []
+    start = best_window(matches, chars)
+    end = min(len(content), start + chars)
+    if start > 0:
+        space = content.find(" ", start, start + SNIPPET_SNAP_CHARS)
+        start = space + 1 if space != -1 else start
+    if end < len(content):
+        space = content.rfind(" ", end - SNIPPET_SNAP_CHARS, end)
+        end = space if space > start else end
+
+    text = content[start:end]
+    if highlight and pattern:
+        before, after = highlight
+        text = pattern.sub(lambda m: f"{before}{m.group()}{after}", text)
+    # Merged chunks are joined with "\n...\n"; a snippet is a single line
+    text = " ".join(text.split())
+    return (ELLIPSIS if start > 0 else "") + text + (ELLIPSIS if end < len(content) else "")
+
+
+def shape_documents(documents: Sequence, query: str, fields: Optional[Sequence[str]] = None,
+                    snippet_chars: int = SNIPPET_CHARS,
+                    highlight: Optional[Tuple[str, str]] = None) -> List[dict]:
+    """The requested fields of each document, all but the snippet by default"""
+    fields = fields or DOCUMENT_FIELDS
+    pattern = term_pattern(query) if SNIPPET_FIELD in fields else None
+    return [
+        {
+            field: snippet(doc.content, pattern, snippet_chars, highlight) if field == SNIPPET_FIELD
+            else getattr(doc, field)
+            for field in fields
+        }
+        for doc in documents
+    ]
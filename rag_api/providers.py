@@ -0,0 +1,73 @@
+"""
+Lazily constructed clients of the RAG API.
+
+Importing openai and LangChain and building their clients is most of a cold
+start, so none of it happens at import time: each client is a named factory
+in the registry, built once on first use, or ahead of traffic by the warm-up
+(see rag_api.warm_up). Factories import their own dependencies.
+"""
+import sys
+import time
+import logging
+import threading
+from typing import Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def rate_limit_errors() -> tuple:
+    """(openai.RateLimitError,) once openai is loaded; nothing can raise it before.
+
+    Meant for except clauses and isinstance checks, so that handling OpenAI
+    throttling does not import openai by itself.
+    """
+    openai = sys.modules.get("openai")
+    return (openai.RateLimitError,) if openai is not None else ()
+
+
+class Providers:
+    """Registry of named factories, each called at most once"""
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], object]] = {}
+        self._instances: Dict[str, object] = {}
+        self._build_seconds: Dict[str, float] = {}
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory: Callable[[], object]):
+        with self._lock:
+            if name in self._factories:
+                raise ValueError(f"Provider {name!r} is already registered")
+            self._factories[name] = factory
+
+    def get(self, name: str):
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        # One reentrant lock for all providers: factories get() their own dependencies
+        with self._lock:
+            instance = self._instances.get(name)
+            if instance is None:
+                started = time.perf_counter()
+                instance = self._factories[name]()
+                self._build_seconds[name] = time.perf_counter() - started
+                logger.info(f"Built provider {name} in {self._build_seconds[name]:.2f}s")
+                self._instances[name] = instance
+        return instance
+
+    def warm(self, names: Optional[Iterable[str]] = None):
+        for name in names if names is not None else list(self._factories):
+            self.get(name)
+
+    def ready(self) -> bool:
+        return all(name in self._instances for name in self._factories)
+
+    def stats(self) -> dict:
+        return {
+            "registered": len(self._factories),
+            "built": len(self._instances),
+            "build_seconds": dict(self._build_seconds),
+        }
+
+
+providers = Providers()
@@ -1,48 +1,276 @@
 import os
+import re
+import math
+import time
+import asyncio
 import logging
-from typing import List, Optional
-import psycopg2
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Dict, List, Literal, Optional, Tuple
 from psycopg2.extras import RealDictCursor
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from openai import OpenAI
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+import httpx
 import uvicorn
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain.schema.runnable import RunnablePassthrough
-from langchain.schema.output_parser import StrOutputParser
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from db import db_pool, PoolClosedError, PoolTimeoutError
+from embedding_cache import embedding_cache, normalize_query
+from answer_cache import answer_cache, ANSWER_CACHE_ENABLED
+import retrieval
+from vector_index import VECTOR_ENGINE, vector_index
+from providers import providers, rate_limit_errors
+from token_budget import (
+    token_counter, context_budget, pack_context, PackedContext, LLM_MODEL, ANSWER_RESERVE_TOKENS
+)
+from observability import (
+    LLM_TOKENS, StatsCollector, install_request_id_logging, request_context, stage
+)
+from admission import (
+    LLM_QUEUE_SIZE, LLM_QUEUE_TIMEOUT, PRIORITY_BATCH, PRIORITY_INTERACTIVE, Overloaded,
+    PriorityScheduler, query_flights, rate_limiter
+)
+from payloads import (
+    GZIP_LEVEL, GZIP_MIN_SIZE, SNIPPET_CHARS, CompressionMiddleware, FastJSONResponse, dumps,
+    shape_documents
+)
 
 # Configure logging
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
     level=logging.INFO
 )
+install_request_id_logging()
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
+# "openai" or "fake" (deterministic offline stand-ins, see fake_backends.py)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+
+# "lazy": accept connections right away and warm up in the background,
+# /ready answers 200 once that is done; "eager": warm up before serving
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy")
+# Recently embedded queries copied from Redis into the embedding cache on warm-up
+WARMUP_EMBEDDINGS = int(os.getenv("WARMUP_EMBEDDINGS", "500"))
+# A failed lazy warm-up is retried, doubling the wait between attempts up to this many seconds
+WARMUP_RETRY_MAX_DELAY = float(os.getenv("WARMUP_RETRY_MAX_DELAY", "60"))
+
+# Clients are built by the provider registry on first use or on warm-up;
+# only the configuration is checked at import
 api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
+if not api_key and "openai" in (EMBEDDING_BACKEND, LLM_BACKEND):
     raise ValueError("OPENAI_API_KEY environment variable is not set")
 
-client = OpenAI(api_key=api_key)
-llm = ChatOpenAI(model="gpt-3.5-turbo", temperature=0)
-
-# Database connection
-def get_db_connection():
-    return psycopg2.connect(
-        dbname=os.getenv("POSTGRES_DB"),
-        user=os.getenv("POSTGRES_USER"),
-        password=os.getenv("POSTGRES_PASSWORD"),
-        host=os.getenv("POSTGRES_HOST"),
-        port=os.getenv("POSTGRES_PORT")
+def build_embeddings_client():
+    if EMBEDDING_BACKEND == "fake":
+        import fake_backends
+        return fake_backends.FakeEmbeddingsClient()
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
+# Seconds allowed for one answer (or, when streaming, between two tokens)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+# LLM calls in flight per process; further requests queue for a free slot
+# (up to LLM_QUEUE_SIZE for at most LLM_QUEUE_TIMEOUT, then they are shed with a 503)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+# Batch endpoints: questions per request and LLM calls in flight per batch
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "64"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+
+# Conversation history: turns accepted per request, turns and answer tokens
+# used to rewrite a follow-up, and the time allowed for that rewrite
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "20"))
+CONDENSE_MAX_TURNS = int(os.getenv("CONDENSE_MAX_TURNS", "4"))
+CONDENSE_ANSWER_TOKENS = int(os.getenv("CONDENSE_ANSWER_TOKENS", "150"))
+CONDENSE_TIMEOUT = float(os.getenv("CONDENSE_TIMEOUT", "10"))
+
+# One keep-alive connection pool shared by every async LLM call
+llm_http_client = httpx.AsyncClient(
+    timeout=LLM_TIMEOUT,
+    limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY, max_keepalive_connections=LLM_MAX_CONCURRENCY)
+)
+llm_scheduler = PriorityScheduler(LLM_MAX_CONCURRENCY, LLM_QUEUE_SIZE, LLM_QUEUE_TIMEOUT)
+
+def build_llm():
+    if LLM_BACKEND == "fake":
+        import fake_backends
+        return fake_backends.fake_llm()
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model=LLM_MODEL,
+        temperature=0,
+        max_tokens=ANSWER_RESERVE_TOKENS,
+        timeout=LLM_TIMEOUT,
+        http_async_client=llm_http_client
     )
 
+def build_condense_llm():
+    if LLM_BACKEND == "fake":
+        import fake_backends
+        return fake_backends.fake_condense_llm()
+    return providers.get("llm")
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+def warm_up():
+    """Bring the process to full speed: database pool, clients, vector index,
+    query embeddings.
+
+    Steps already done by an earlier, failed attempt are skipped on retry.
+    """
+    started = time.perf_counter()
+    try:
+        db_pool.open()
+        if not providers.ready():
+            providers.warm()
+        token_counter.load()
+        if VECTOR_ENGINE == "numpy":
+            if not vector_index.loaded:
+                vector_index.load()
+            vector_index.start()
+        primed = embedding_cache.prime(EMBEDDING_MODEL, WARMUP_EMBEDDINGS)
+    except Exception:
+        logger.error("Warm-up failed, /ready stays unavailable until it succeeds", exc_info=True)
+        raise
+    logger.info(f"Warm-up done in {time.perf_counter() - started:.2f}s ({primed} query embeddings primed)")
+
+async def keep_warming_up(stopping: asyncio.Event):
+    """Retry a failed warm-up with backoff until it succeeds or the app shuts down"""
+    delay = 1.0
+    while not stopping.is_set():
+        try:
+            await run_in_threadpool(warm_up)
+            return
+        except Exception:
+            logger.warning(f"Retrying warm-up in {delay:.0f}s")
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            delay = min(delay * 2, WARMUP_RETRY_MAX_DELAY)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The shared connection pool is opened once per process by the warm-up, so
+    # in lazy mode an unreachable database does not hold up /health
+    stopping = asyncio.Event()
+    if STARTUP_MODE == "eager":
+        # Fail the startup instead of serving cold
+        app.state.warm_up = asyncio.create_task(run_in_threadpool(warm_up))
+        await app.state.warm_up
+    else:
+        app.state.warm_up = asyncio.create_task(keep_warming_up(stopping))
+    try:
+        yield
+    finally:
+        # Let a warm-up attempt still in progress finish, so nothing starts after shutdown
+        stopping.set()
+        await asyncio.gather(app.state.warm_up, return_exceptions=True)
+        await run_in_threadpool(vector_index.stop)
+        await llm_http_client.aclose()
+        await run_in_threadpool(db_pool.close)
+
 # FastAPI app
-app = FastAPI(title="RAG API", description="API for querying the RAG database")
+app = FastAPI(title="RAG API", description="API for querying the RAG database", lifespan=lifespan)
 
-class QueryRequest(BaseModel):
-    query: str
+USER_ID_HEADER = "X-User-ID"
+RATE_LIMITED_DETAIL = "Too many questions in a short time. Please wait a moment and try again."
+OVERLOADED_DETAIL = "The service is handling too many questions right now. Please try again shortly."
+# Suggested wait when we shed load or OpenAI did not say how long to back off
+OVERLOADED_RETRY_AFTER = 5
+
+def admit(user_id: Optional[str], cost: int = 1):
+    """Apply the per-user and global token buckets; refused requests get a 429"""
+    wait = rate_limiter.check(user_id, cost)
+    if wait:
+        logger.warning(f"Rate limited user {user_id or '-'}, retry in {wait:.1f}s")
+        raise HTTPException(
+            status_code=429,
+            detail=RATE_LIMITED_DETAIL,
+            headers={"Retry-After": str(math.ceil(wait))}
+        )
+
+def overloaded(retry_after: int = OVERLOADED_RETRY_AFTER) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail=OVERLOADED_DETAIL,
+        headers={"Retry-After": str(retry_after)}
+    )
+
+def upstream_retry_after(e: Exception) -> int:
+    try:
+        return math.ceil(float(e.response.headers.get("retry-after")))
+    except (TypeError, ValueError):
+        return OVERLOADED_RETRY_AFTER
+
+async def openai_rate_limited(request: Request, call_next):
+    """OpenAI throttling is our capacity problem, not a server bug: answer 503, not 500.
+
+    A middleware rather than an exception handler, which would need
+    openai.RateLimitError, and so all of openai, at import time.
+    """
+    try:
+        return await call_next(request)
+    except rate_limit_errors() as e:
+        logger.warning(f"OpenAI rate limit reached: {e}")
+        error = overloaded(upstream_retry_after(e))
+        return JSONResponse({"detail": error.detail}, status_code=error.status_code, headers=error.headers)
+
+# Innermost first, so throttled requests are still timed and tagged with their id
+app.middleware("http")(openai_rate_limited)
+app.middleware("http")(request_context)
+app.add_middleware(CompressionMiddleware, minimum_size=GZIP_MIN_SIZE, compresslevel=GZIP_LEVEL)
+
+class RetrievalOptions(BaseModel):
     limit: Optional[int] = 5
+    # Retrieval overrides, unset fields use the server defaults (RETRIEVAL_MODE, HYBRID_*_WEIGHT)
+    retrieval_mode: Optional[Literal["vector", "hybrid"]] = None
+    vector_weight: Optional[float] = Field(default=None, ge=0)
+    lexical_weight: Optional[float] = Field(default=None, ge=0)
+    # ANN recall/latency knobs (HNSW_EF_SEARCH / IVFFLAT_PROBES by default)
+    ef_search: Optional[int] = Field(default=None, ge=1, le=1000)
+    probes: Optional[int] = Field(default=None, ge=1)
+
+    def retrieval_options(self) -> dict:
+        return {
+            "mode": self.retrieval_mode,
+            "vector_weight": self.vector_weight,
+            "lexical_weight": self.lexical_weight,
+            "ef_search": self.ef_search,
+            "probes": self.probes,
+        }
+
+    def retrieval_key(self) -> tuple:
+        """Answers are only reused between requests that retrieve the same way"""
+        return tuple(self.retrieval_options().values())
+
+class ConversationTurn(BaseModel):
+    question: str
+    answer: str = ""
+
+class ResponseOptions(BaseModel):
+    # Document fields to return, all but "snippet" by default. A snippet is the
+    # part of the content around the query terms, a fraction of its size
+    fields: Optional[List[Literal["id", "url", "title", "content", "snippet", "similarity", "updated_at"]]] = None
+    snippet_chars: int = Field(default=SNIPPET_CHARS, ge=40, le=2000)
+    # Marks put around the query terms in snippets, e.g. ["<b>", "</b>"]
+    highlight: Optional[Tuple[str, str]] = None
+
+    def shape(self, query: str, documents: List["DocumentResponse"]) -> List[dict]:
+        return shape_documents(documents, query, self.fields, self.snippet_chars, self.highlight)
+
+class QueryRequest(RetrievalOptions, ResponseOptions):
+    query: str
+    # Earlier turns of the chat, oldest first; a follow-up query is rewritten
+    # into a standalone one before retrieval
+    history: List[ConversationTurn] = Field(default_factory=list, max_length=HISTORY_MAX_TURNS)
+
+class BatchQueryRequest(RetrievalOptions, ResponseOptions):
+    queries: List[str] = Field(min_length=1, max_length=BATCH_MAX_QUERIES)
+
+    def item(self, query: str) -> QueryRequest:
+        return QueryRequest(query=query, **self.model_dump(exclude={"queries"}))
 
 class DocumentResponse(BaseModel):
     id: int
@@ -50,190 +278,640 @@ class DocumentResponse(BaseModel):
     title: Optional[str]
     content: str
     similarity: float
+    updated_at: Optional[datetime] = None
+    snippet: Optional[str] = None
 
 class RAGResponse(BaseModel):
     answer: str
     sources: List[DocumentResponse]
+    cached: bool = False
 
-def get_similar_documents(query: str, limit: int) -> List[DocumentResponse]:
-    try:
-        logger.info(f"Received query request: {query} with limit {limit}")
-        
-        # Get embedding for the query
-        logger.info("Generating embedding for query...")
-        response = client.embeddings.create(
+class BatchResultsItem(BaseModel):
+    query: str
+    results: List[DocumentResponse] = []
+
+class BatchAnswerItem(BaseModel):
+    query: str
+    answer: Optional[str] = None
+    sources: List[DocumentResponse] = []
+    cached: bool = False
+    error: Optional[str] = None
+
+def embed_query(query: str) -> List[float]:
+    """Embed a query, reusing cached vectors for repeated questions"""
+    cached = embedding_cache.get(EMBEDDING_MODEL, query)
+    if cached is not None:
+        logger.debug("Using cached query embedding")
+        return cached
+
+    with stage("embed"):
+        response = providers.get("embeddings_client").embeddings.create(
             input=query,
-            model="text-embedding-3-small"
+            model=EMBEDDING_MODEL
         )
-        query_embedding = response.data[0].embedding
-        logger.info(f"Generated embedding of length: {len(query_embedding)}")
+    query_embedding = response.data[0].embedding
+    embedding_cache.put(EMBEDDING_MODEL, query, query_embedding)
+    return query_embedding
+
+def embed_queries(queries: List[str]) -> List[List[float]]:
+    """Embed many queries with at most one embeddings request, for the uncached ones"""
+    embeddings = [embedding_cache.get(EMBEDDING_MODEL, query) for query in queries]
+    pairs = list(zip(queries, embeddings, strict=True))
+    missing = list(dict.fromkeys(q for q, e in pairs if e is None))
+    if not missing:
+        return embeddings
 
-        # Convert embedding to string format for pgvector
-        embedding_str = "[" + ",".join(map(str, query_embedding)) + "]"
-        logger.info(f"Converted embedding to string format: {embedding_str[:100]}...")
+    logger.info(f"Embedding {len(missing)} of {len(queries)} queries in one request")
+    with stage("embed"):
+        response = providers.get("embeddings_client").embeddings.create(
+            input=missing,
+            model=EMBEDDING_MODEL
+        )
+    data = sorted(response.data, key=lambda d: d.index)
+    fresh = {q: item.embedding for q, item in zip(missing, data, strict=True)}
+    for query, embedding in fresh.items():
+        embedding_cache.put(EMBEDDING_MODEL, query, embedding)
+    return [e if e is not None else fresh[q] for q, e in pairs]
+
+def get_similar_documents(query: str, limit: int, **options) -> List[DocumentResponse]:
+    try:
+        logger.debug(f"Received query request: {query} with limit {limit}")
+        
+        # Get embedding for the query
+        query_embedding = embed_query(query)
+        logger.debug(f"Generated embedding of length: {len(query_embedding)}")
 
         # Query the database
-        logger.info("Querying database for similar documents...")
-        with get_db_connection() as conn:
+        with stage("search"), db_pool.connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                logger.info("Executing similarity search query...")
-                # First check total documents with embeddings
-                cur.execute("SELECT COUNT(*) as count FROM gringo.documents WHERE embedding IS NOT NULL")
-                total_docs = cur.fetchone()['count']
-                logger.info(f"Total documents with embeddings: {total_docs}")
-                
-                # Now execute the similarity search
-                cur.execute("""
-                    SELECT 
-                        id, url, title, content,
-                        1 - (embedding <=> %s::vector) as similarity
-                    FROM gringo.documents
-                    WHERE embedding IS NOT NULL
-                    ORDER BY similarity DESC
-                    LIMIT %s
-                """, (embedding_str, limit))
-                
-                results = cur.fetchall()
-                logger.info(f"Found {len(results)} matching documents")
-                
-                # Process and truncate documents to stay within token limits
-                processed_results = []
-                total_tokens = 0
-                max_tokens_per_doc = 2000  # Limit tokens per document
-                
-                for doc in results:
-                    # Truncate content if too long
-                    content = doc['content']
-                    if len(content.split()) > max_tokens_per_doc:
-                        content = ' '.join(content.split()[:max_tokens_per_doc]) + "..."
-                    
-                    processed_doc = {
-                        'id': doc['id'],
-                        'url': doc['url'],
-                        'title': doc['title'],
-                        'content': content,
-                        'similarity': doc['similarity']
-                    }
-                    processed_results.append(processed_doc)
-                
-                return [DocumentResponse(**doc) for doc in processed_results]
+                # pgvector serves until the replica has been loaded by the warm-up
+                if VECTOR_ENGINE == "numpy" and vector_index.loaded:
+                    results = retrieval.search_index(cur, vector_index, query_embedding, limit, query=query, **options)
+                else:
+                    # Convert embedding to string format for pgvector
+                    results = retrieval.search(cur, retrieval.vector_literal(query_embedding), limit, query=query, **options)
+        return [DocumentResponse(**doc) for doc in results]
+    except rate_limit_errors():
+        raise
+    except (PoolTimeoutError, PoolClosedError) as e:
+        logger.error(f"Database pool unavailable: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Error querying documents: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+def get_similar_documents_batch(queries: List[str], limit: int,
+                                embeddings: Optional[List[List[float]]] = None,
+                                **options) -> List[List[DocumentResponse]]:
+    """Search results for every query with one embeddings request and one SQL round trip"""
+    try:
+        if embeddings is None:
+            embeddings = embed_queries(queries)
+        with stage("search"), db_pool.connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                if VECTOR_ENGINE == "numpy" and vector_index.loaded:
+                    # An in-process scan per query is cheaper than any SQL batching
+                    results = [
+                        retrieval.search_index(cur, vector_index, e, limit, query=q, **options)
+                        for e, q in zip(embeddings, queries, strict=True)
+                    ]
+                else:
+                    results = retrieval.search_batch(
+                        cur, [retrieval.vector_literal(e) for e in embeddings], queries, limit, **options
+                    )
+        logger.info(f"Batch search for {len(queries)} queries returned {sum(map(len, results))} documents")
+        return [[DocumentResponse(**doc) for doc in docs] for docs in results]
+    except rate_limit_errors():
+        raise
+    except (PoolTimeoutError, PoolClosedError) as e:
+        logger.error(f"Database pool unavailable: {e}")
+        raise HTTPException(status_code=503, detail=str(e)) from e
+    except Exception as e:
+        logger.error(f"Error in batch search: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+def fetch_document(document_id: int) -> Optional[dict]:
+    with db_pool.connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT id, url, title, content, updated_at, 1.0 as similarity
+                FROM gringo.documents
+                WHERE id = %s
+            """, (document_id,))
+            return cur.fetchone()
+
+def fetch_document_stamps(document_ids: List[int]) -> Dict[int, Optional[datetime]]:
+    """Current updated_at of each document, used to validate cached answers"""
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, updated_at FROM gringo.documents WHERE id = ANY(%s)",
+                (document_ids,)
+            )
+            return dict(cur.fetchall())
+
+async def lookup_cached_answers(requests: List[QueryRequest],
+                                query_embeddings: List[List[float]]) -> List[Optional[RAGResponse]]:
+    """Serve previous answers to near-identical questions if their sources are unchanged.
+
+    All questions are matched in memory first; the sources of every candidate
+    are then validated together in one DB round trip.
+    """
+    with stage("answer_cache"):
+        candidates = [
+            answer_cache.lookup(embedding, request.limit, request.retrieval_key())
+            for request, embedding in zip(requests, query_embeddings, strict=True)
+        ]
+        document_ids = {doc_id for candidate in candidates if candidate for doc_id in candidate[1].source_stamps}
+        current_stamps = await run_in_threadpool(fetch_document_stamps, list(document_ids)) if document_ids else {}
+
+    answers: List[Optional[RAGResponse]] = []
+    for candidate in candidates:
+        if candidate is None:
+            answer_cache.record_miss()
+            answers.append(None)
+            continue
+        slot, entry, similarity = candidate
+        stamps = {doc_id: current_stamps[doc_id] for doc_id in entry.source_stamps if doc_id in current_stamps}
+        if not answer_cache.is_fresh(entry, stamps):
+            logger.info("Cached answer is stale, sources were re-embedded since it was generated")
+            answer_cache.invalidate(slot)
+            answer_cache.record_miss()
+            answers.append(None)
+            continue
+        answer_cache.record_hit()
+        logger.info(f"Answer cache hit (similarity {similarity:.3f})")
+        answers.append(RAGResponse(answer=entry.answer, sources=entry.sources, cached=True))
+    return answers
+
+async def lookup_cached_answer(request: QueryRequest, query_embedding: List[float]) -> Optional[RAGResponse]:
+    """Serve a previous answer to a near-identical question if its sources are unchanged"""
+    return (await lookup_cached_answers([request], [query_embedding]))[0]
+
+NO_DOCUMENTS_ANSWER = "I couldn't find any relevant information to answer your question."
+
+SYSTEM_PROMPT = """You are a helpful assistant that answers questions based on the provided context.
+        Generate a clear, concise answer in your own words based on the context.
+        Do not directly quote or reference the sources in your answer.
+        If the answer cannot be found in the context, say "I couldn't find enough information to answer that question."
+        IMPORTANT: Always answer in the same language as the question and context. If the context is in Hebrew, answer in Hebrew.
+        Keep your answer focused and to the point."""
+HUMAN_PROMPT = """Context (in {context_language}):
+        {context}
+
+        Question (in {question_language}): {question}"""
+
+QUERY_TOO_LONG = "The query is too long to process. Please try a shorter query."
+
+def build_context(documents: List[DocumentResponse], question: str) -> PackedContext:
+    """Pack the best ranked documents into the model's context budget.
+
+    The budget is what remains of the context window after the prompt, the
+    question and the answer reserve, so the LLM call never overflows it.
+    """
+    with stage("context"):
+        budget = context_budget(SYSTEM_PROMPT + HUMAN_PROMPT + question)
+        packed = pack_context(
+            documents,
+            budget,
+            lambda n, doc: f"Source {n} (URL: {doc.url}):\n"
+        )
+    logger.info(
+        f"Formatted context with {len(packed.documents)} of {len(documents)} sources, "
+        f"{packed.tokens}/{budget} tokens{' (truncated)' if packed.truncated else ''}"
+    )
+    if documents and not packed.documents:
+        raise HTTPException(status_code=400, detail=QUERY_TOO_LONG)
+    return packed
+
+HEBREW_RE = re.compile(r"[\u0590-\u05FF]")
+LLM_TIMEOUT_DETAIL = "The language model did not respond in time. Please try again."
+
+def detect_language(text: str) -> str:
+    return "Hebrew" if HEBREW_RE.search(text) else "English"
+
+def build_rag_chain():
+    """Built once; the context and question are inputs of every invocation"""
+    from langchain.prompts import ChatPromptTemplate
+    from langchain.schema.output_parser import StrOutputParser
+    rag_prompt = ChatPromptTemplate.from_messages([
+        ("system", SYSTEM_PROMPT),
+        ("human", HUMAN_PROMPT)
+    ])
+    return rag_prompt | providers.get("llm") | StrOutputParser()
+
+CONDENSE_SYSTEM_PROMPT = """Rewrite the user's follow-up question as a standalone question that can be understood without the conversation, resolving references to earlier turns.
+        Keep the language of the follow-up question. If it is already standalone, return it unchanged.
+        Reply with the question only."""
+CONDENSE_HUMAN_PROMPT = """Conversation:
+{history}
+
+Follow-up question: {question}"""
+
+def build_condense_chain():
+    from langchain.prompts import ChatPromptTemplate
+    from langchain.schema.output_parser import StrOutputParser
+    return ChatPromptTemplate.from_messages([
+        ("system", CONDENSE_SYSTEM_PROMPT),
+        ("human", CONDENSE_HUMAN_PROMPT)
+    ]) | providers.get("condense_llm") | StrOutputParser()
+
+providers.register("embeddings_client", build_embeddings_client)
+providers.register("llm", build_llm)
+providers.register("condense_llm", build_condense_llm)
+providers.register("rag_chain", build_rag_chain)
+providers.register("condense_chain", build_condense_chain)
+
+def format_history(turns: List[ConversationTurn]) -> str:
+    lines = []
+    for turn in turns[-CONDENSE_MAX_TURNS:]:
+        lines.append(f"User: {turn.question}")
+        if turn.answer:
+            lines.append(f"Assistant: {token_counter.truncate(turn.answer, CONDENSE_ANSWER_TOKENS)}")
+    return "\n".join(lines)
+
+async def resolve_follow_up(request: QueryRequest) -> QueryRequest:
+    """Rewrite a follow-up into a standalone query using the conversation history.
+
+    Retrieval, the answer and the answer cache all work on the rewritten
+    query. If the rewrite fails the original query is used as is.
+    """
+    if not request.history:
+        return request
+
+    async def invoke():
+        async with llm_scheduler.slot(PRIORITY_INTERACTIVE):
+            return await providers.get("condense_chain").ainvoke({
+                "history": format_history(request.history),
+                "question": request.query,
+            })
+
+    try:
+        with stage("condense"):
+            query = (await asyncio.wait_for(invoke(), CONDENSE_TIMEOUT)).strip()
+    except Exception as e:
+        logger.warning(f"Could not condense the conversation, using the query as is: {e!r}")
+        return request
+    if not query:
+        return request
+    logger.info(f"Condensed follow-up into standalone query: {query}")
+    return request.model_copy(update={"query": query, "history": []})
+
+def chain_inputs(context: str, question: str) -> dict:
+    return {
+        "context": context,
+        "context_language": detect_language(context),
+        "question": question,
+        "question_language": detect_language(question),
+    }
+
+async def generate_answer(context: str, question: str, priority: int = PRIORITY_INTERACTIVE) -> str:
+    """Run the chain on the event loop once the LLM scheduler grants a slot.
+
+    LLM_TIMEOUT bounds the call itself; the wait for a slot is bounded by the
+    scheduler's own queue deadline, which sheds the call with a 503.
+    """
+    try:
+        async with llm_scheduler.slot(priority):
+            chain = providers.get("rag_chain")
+            with stage("llm"):
+                return await asyncio.wait_for(
+                    chain.ainvoke(chain_inputs(context, question)), LLM_TIMEOUT
+                )
+    except asyncio.TimeoutError:
+        logger.error(f"LLM call timed out after {LLM_TIMEOUT:.0f}s")
+        raise HTTPException(status_code=504, detail=LLM_TIMEOUT_DETAIL)
+    except Overloaded as e:
+        logger.warning(f"Shedding LLM call: {e}")
+        raise overloaded()
+
+async def stream_answer(context: str, question: str):
+    """Yield answer tokens; LLM_TIMEOUT bounds the wait for each one"""
+    async with llm_scheduler.slot(PRIORITY_INTERACTIVE):
+        tokens = providers.get("rag_chain").astream(chain_inputs(context, question)).__aiter__()
+        try:
+            with stage("llm"):
+                with stage("llm_first_token"):
+                    first = await asyncio.wait_for(tokens.__anext__(), LLM_TIMEOUT)
+                yield first
+                while True:
+                    try:
+                        yield await asyncio.wait_for(tokens.__anext__(), LLM_TIMEOUT)
+                    except StopAsyncIteration:
+                        return
+        except StopAsyncIteration:
+            return
+        finally:
+            await tokens.aclose()
+
+def record_token_usage(packed: PackedContext, answer: str):
+    LLM_TOKENS.labels("context").inc(packed.tokens)
+    LLM_TOKENS.labels("completion").inc(token_counter.count(answer))
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {dumps(data)}\n\n"
+
 @app.get("/health")
 async def health_check():
+    """Liveness: the process is up and serving, possibly not at full speed yet"""
     return {"status": "healthy"}
 
+def readiness_checks() -> Dict[str, bool]:
+    warm_up = getattr(app.state, "warm_up", None)
+    return {
+        "db_pool": db_pool.stats()["open"],
+        "providers": providers.ready(),
+        "vector_index": VECTOR_ENGINE != "numpy" or vector_index.loaded,
+        "warm_up": warm_up is not None and warm_up.done() and warm_up.exception() is None,
+    }
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: clients built, pools open, index loaded and caches primed"""
+    checks = readiness_checks()
+    ready = all(checks.values())
+    return JSONResponse({"status": "ready" if ready else "warming_up", "checks": checks},
+                        status_code=200 if ready else 503)
+
+def admission_stats() -> dict:
+    return {**rate_limiter.stats(), **llm_scheduler.stats(), **query_flights.stats()}
+
+REGISTRY.register(StatsCollector({
+    "db_pool": db_pool.stats,
+    "embedding_cache": embedding_cache.stats,
+    "answer_cache": answer_cache.stats,
+    "token_counts": token_counter.stats,
+    "admission": admission_stats,
+    "vector_index": vector_index.stats,
+    "providers": providers.stats,
+}))
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint: request and stage latencies, cache and token counters"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/stats")
+async def get_stats():
+    """Runtime metrics for the shared resources of this process"""
+    return {
+        "db_pool": db_pool.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "token_counts": token_counter.stats(),
+        "admission": admission_stats(),
+        "vector_index": vector_index.stats(),
+        "providers": providers.stats(),
+    }
+
 @app.post("/results", response_model=List[DocumentResponse])
 async def get_results(request: QueryRequest):
     """Endpoint to get raw similarity search results"""
-    return get_similar_documents(request.query, request.limit)
+    request = await resolve_follow_up(request)
+    documents = await run_in_threadpool(
+        get_similar_documents, request.query, request.limit, **request.retrieval_options()
+    )
+    # Shaped dicts go straight to orjson; response_model only documents the schema
+    return FastJSONResponse(request.shape(request.query, documents))
+
+async def answer_from_documents(request: QueryRequest, documents: List[DocumentResponse],
+                                query_embedding: Optional[List[float]],
+                                priority: int = PRIORITY_INTERACTIVE) -> RAGResponse:
+    """Generate, and cache, the answer to one question from its retrieved documents"""
+    if not documents:
+        logger.warning("No relevant documents found for query")
+        return RAGResponse(
+            answer=NO_DOCUMENTS_ANSWER,
+            sources=[]
+        )
+
+    # Only the sources that fit the token budget are sent and cited
+    packed = build_context(documents, request.query)
+    documents = packed.documents
+
+    # Generate answer
+    logger.debug("Generating answer using RAG chain...")
+    answer = await generate_answer(packed.text, request.query, priority)
+    logger.debug(f"Generated answer: {answer}")
+    record_token_usage(packed, answer)
+
+    if ANSWER_CACHE_ENABLED:
+        answer_cache.store(
+            query_embedding,
+            request.limit,
+            answer,
+            documents,
+            {doc.id: doc.updated_at for doc in documents},
+            request.retrieval_key()
+        )
+
+    return RAGResponse(
+        answer=answer,
+        sources=documents
+    )
+
+async def retrieve_and_answer(request: QueryRequest, query_embedding: Optional[List[float]]) -> RAGResponse:
+    documents = await run_in_threadpool(
+        get_similar_documents, request.query, request.limit, **request.retrieval_options()
+    )
+    logger.info(f"Retrieved {len(documents)} relevant documents")
+    return await answer_from_documents(request, documents, query_embedding)
+
+def answer_payload(request: QueryRequest, response: RAGResponse) -> dict:
+    return {
+        "answer": response.answer,
+        "sources": request.shape(request.query, response.sources),
+        "cached": response.cached,
+    }
 
 @app.post("/query", response_model=RAGResponse)
-async def query_documents(request: QueryRequest):
+async def query_documents(request: QueryRequest,
+                          user_id: Optional[str] = Header(default=None, alias=USER_ID_HEADER)):
     """Endpoint that uses RAG to generate an answer based on the retrieved documents"""
+    admit(user_id)
     try:
         logger.info(f"Starting RAG pipeline for query: {request.query}")
-        
-        # Get similar documents
-        documents = get_similar_documents(request.query, request.limit)
-        logger.info(f"Retrieved {len(documents)} relevant documents")
-        
-        if not documents:
-            logger.warning("No relevant documents found for query")
-            return RAGResponse(
-                answer="I couldn't find any relevant information to answer your question.",
-                sources=[]
+        request = await resolve_follow_up(request)
+
+        query_embedding = None
+        if ANSWER_CACHE_ENABLED:
+            query_embedding = await run_in_threadpool(embed_query, request.query)
+            cached = await lookup_cached_answer(request, query_embedding)
+            if cached is not None:
+                return FastJSONResponse(answer_payload(request, cached))
+
+        # Identical questions in flight at the same time share one retrieval and answer
+        key = (normalize_query(request.query), request.limit, request.retrieval_key())
+        response = await query_flights.do(key, lambda: retrieve_and_answer(request, query_embedding))
+        return FastJSONResponse(answer_payload(request, response))
+    except (HTTPException, *rate_limit_errors()):
+        raise
+    except Exception as e:
+        logger.error(f"Error in RAG pipeline: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+@app.post("/results/batch", response_model=List[BatchResultsItem])
+async def get_results_batch(request: BatchQueryRequest):
+    """Raw similarity search results for many queries at once"""
+    results = await run_in_threadpool(
+        get_similar_documents_batch, request.queries, request.limit, **request.retrieval_options()
+    )
+    return FastJSONResponse([
+        {"query": query, "results": request.shape(query, docs)}
+        for query, docs in zip(request.queries, results, strict=True)
+    ])
+
+@app.post("/query/batch", response_model=List[BatchAnswerItem])
+async def query_documents_batch(request: BatchQueryRequest,
+                                user_id: Optional[str] = Header(default=None, alias=USER_ID_HEADER)):
+    """RAG answers for many questions; a failed question is reported in its item only.
+
+    Queries are embedded in one request, answer-cache hits are validated in
+    one SQL round trip and the remaining queries retrieved in another;
+    at most BATCH_LLM_CONCURRENCY answers of the batch are generated at once,
+    behind interactive questions when LLM slots are contended.
+    """
+    admit(user_id, cost=len(request.queries))
+    try:
+        logger.info(f"Starting batch RAG pipeline for {len(request.queries)} queries")
+        items = [request.item(query) for query in request.queries]
+        embeddings = await run_in_threadpool(embed_queries, request.queries)
+
+        answers: List[object] = [None] * len(items)
+        if ANSWER_CACHE_ENABLED:
+            answers = await lookup_cached_answers(items, embeddings)
+
+        pending = [i for i, answer in enumerate(answers) if answer is None]
+        if pending:
+            documents = await run_in_threadpool(
+                get_similar_documents_batch,
+                [request.queries[i] for i in pending],
+                request.limit,
+                [embeddings[i] for i in pending],
+                **request.retrieval_options()
             )
+            slots = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
 
-        # Format documents for context, ensuring we stay within token limits
-        context_parts = []
-        total_tokens = 0
-        max_context_tokens = 8000  # Conservative limit for context
-        
-        for doc in documents:
-            doc_tokens = len(doc.content.split())
-            if total_tokens + doc_tokens > max_context_tokens:
-                # Truncate the document if adding it would exceed the limit
-                remaining_tokens = max_context_tokens - total_tokens
-                if remaining_tokens > 0:
-                    truncated_content = ' '.join(doc.content.split()[:remaining_tokens]) + "..."
-                    context_parts.append(f"Source {len(context_parts)+1} (URL: {doc.url}):\n{truncated_content}")
-                break
-            else:
-                context_parts.append(f"Source {len(context_parts)+1} (URL: {doc.url}):\n{doc.content}")
-                total_tokens += doc_tokens
-
-        context = "\n\n".join(context_parts)
-        logger.info(f"Formatted context with {len(context_parts)} sources, total tokens: {total_tokens}")
-
-        # Create RAG prompt with explicit language handling
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """You are a helpful assistant that answers questions based on the provided context.
-            Generate a clear, concise answer in your own words based on the context.
-            Do not directly quote or reference the sources in your answer.
-            If the answer cannot be found in the context, say "I couldn't find enough information to answer that question."
-            IMPORTANT: Always answer in the same language as the question and context. If the context is in Hebrew, answer in Hebrew.
-            Keep your answer focused and to the point."""),
-            ("human", """Context (in {context_language}):
-            {context}
-
-            Question (in {question_language}): {question}""")
-        ])
-
-        # Create RAG chain
-        chain = (
-            {
-                "context": lambda _: context,
-                "context_language": lambda _: "Hebrew" if any('\u0590' <= c <= '\u05FF' for c in context) else "English",
-                "question_language": lambda x: "Hebrew" if any('\u0590' <= c <= '\u05FF' for c in x) else "English",
-                "question": RunnablePassthrough()
-            }
-            | prompt
-            | llm
-            | StrOutputParser()
-        )
+            async def answer_item(i: int, docs: List[DocumentResponse]) -> RAGResponse:
+                async with slots:
+                    return await answer_from_documents(items[i], docs, embeddings[i], PRIORITY_BATCH)
+
+            outcomes = await asyncio.gather(
+                *(answer_item(i, d) for i, d in zip(pending, documents, strict=True)),
+                return_exceptions=True
+            )
+            for i, outcome in zip(pending, outcomes, strict=True):
+                answers[i] = outcome
+    except (HTTPException, *rate_limit_errors()):
+        raise
+    except Exception as e:
+        logger.error(f"Error in batch RAG pipeline: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    response = []
+    for item, answer in zip(items, answers, strict=True):
+        if isinstance(answer, RAGResponse):
+            response.append({"query": item.query, **answer_payload(item, answer), "error": None})
+            continue
+        if isinstance(answer, HTTPException):
+            error = answer.detail
+        elif isinstance(answer, rate_limit_errors()):
+            error = OVERLOADED_DETAIL
+        else:
+            logger.error(f"Error answering batch query {item.query!r}: {answer}")
+            error = str(answer)
+        response.append(BatchAnswerItem(query=item.query, error=error).model_dump())
+    return FastJSONResponse(response)
+
+@app.post("/query/stream")
+async def stream_query(request: QueryRequest,
+                       user_id: Optional[str] = Header(default=None, alias=USER_ID_HEADER)):
+    """Stream the RAG answer as Server-Sent Events.
 
-        # Generate answer
-        logger.info("Generating answer using RAG chain...")
+    Emits one ``sources`` event with the retrieved documents, then ``token``
+    events as the LLM generates, and a final ``done`` event carrying the full
+    answer (or an ``error`` event if generation fails mid-stream).
+    """
+    admit(user_id)
+    logger.info(f"Starting streaming RAG pipeline for query: {request.query}")
+    request = await resolve_follow_up(request)
+    cached = None
+    if ANSWER_CACHE_ENABLED:
+        query_embedding = await run_in_threadpool(embed_query, request.query)
+        cached = await lookup_cached_answer(request, query_embedding)
+
+    # Retrieval errors surface as regular HTTP errors, before the stream starts
+    documents = cached.sources if cached else await run_in_threadpool(
+        get_similar_documents, request.query, request.limit, **request.retrieval_options()
+    )
+    packed = None
+    if cached is None and documents:
+        packed = build_context(documents, request.query)
+        documents = packed.documents
+
+    async def events():
+        yield sse_event("sources", request.shape(request.query, documents))
+
+        if cached is not None:
+            yield sse_event("token", {"text": cached.answer})
+            yield sse_event("done", {"answer": cached.answer, "cached": True})
+            return
+        if not documents:
+            yield sse_event("token", {"text": NO_DOCUMENTS_ANSWER})
+            yield sse_event("done", {"answer": NO_DOCUMENTS_ANSWER, "cached": False})
+            return
+
+        parts = []
         try:
-            answer = chain.invoke(request.query)
-            logger.info(f"Generated answer: {answer}")
+            async for token in stream_answer(packed.text, request.query):
+                if token:
+                    parts.append(token)
+                    yield sse_event("token", {"text": token})
+        except asyncio.TimeoutError:
+            logger.error(f"LLM stream stalled for {LLM_TIMEOUT:.0f}s")
+            yield sse_event("error", {"detail": LLM_TIMEOUT_DETAIL})
+            return
+        except (Overloaded, *rate_limit_errors()) as e:
+            logger.warning(f"Shedding streamed answer: {e}")
+            yield sse_event("error", {"detail": OVERLOADED_DETAIL})
+            return
         except Exception as e:
-            if "context_length_exceeded" in str(e):
-                logger.error("Token limit exceeded, retrying with reduced context")
-                # If we hit the token limit, try with fewer documents
-                if len(documents) > 1:
-                    return await query_documents(QueryRequest(query=request.query, limit=len(documents)-1))
-                else:
-                    raise HTTPException(status_code=400, detail="The query is too long to process. Please try a shorter query.")
-            raise
-        
-        return RAGResponse(
-            answer=answer,
-            sources=documents
-        )
-    except Exception as e:
-        logger.error(f"Error in RAG pipeline: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
+            logger.error(f"Error while streaming answer: {str(e)}", exc_info=True)
+            yield sse_event("error", {"detail": str(e)})
+            return
+
+        answer = "".join(parts)
+        record_token_usage(packed, answer)
+        if ANSWER_CACHE_ENABLED:
+            answer_cache.store(
+                query_embedding,
+                request.limit,
+                answer,
+                documents,
+                {doc.id: doc.updated_at for doc in documents},
+                request.retrieval_key()
+            )
+        yield sse_event("done", {"answer": answer, "cached": False})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.get("/documents/{document_id}", response_model=DocumentResponse)
 async def get_document(document_id: int):
     try:
-        with get_db_connection() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT id, url, title, content, 1.0 as similarity
-                    FROM gringo.documents
-                    WHERE id = %s
-                """, (document_id,))
-                
-                result = cur.fetchone()
-                if not result:
-                    raise HTTPException(status_code=404, detail="Document not found")
-                
+        result = await run_in_threadpool(fetch_document, document_id)
+        if not result:
+            raise HTTPException(status_code=404, detail="Document not found")
+
         return DocumentResponse(**result)
+    except HTTPException:
+        raise
+    except (PoolTimeoutError, PoolClosedError) as e:
+        logger.error(f"Database pool unavailable: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Error fetching document: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,493 @@
+import logging
+import os
+from functools import lru_cache
+from typing import List, Optional
+
+from token_budget import token_counter
+
+logger = logging.getLogger(__name__)
+
+# "chunks" searches gringo.chunks and merges hits per document,
+# "documents" searches the page-level vectors in gringo.documents
+RETRIEVAL_UNIT = os.getenv("RETRIEVAL_UNIT", "chunks")
+# How many chunk candidates to fetch per requested document before dedup
+CHUNK_CANDIDATES_PER_DOC = int(os.getenv("CHUNK_CANDIDATES_PER_DOC", "4"))
+MAX_CHUNKS_PER_DOC = int(os.getenv("MAX_CHUNKS_PER_DOC", "3"))
+MAX_TOKENS_PER_DOC = 2000  # Limit tokens per document
+
+# "hybrid" fuses vector and full-text rankings of chunks,
+# "vector" is embeddings only
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", "1.0"))
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "1.0"))
+# Reciprocal rank fusion constant: score = sum(weight / (RRF_K + rank))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# ANN search knobs, 0 keeps the server defaults (hnsw.ef_search=40,
+# ivfflat.probes=1). Higher values trade latency for recall; requests can
+# override both.
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "0"))
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", "0"))
+HNSW_DEFAULT_EF_SEARCH = 40
+HNSW_MAX_EF_SEARCH = 1000
+
+# Binary-quantized pre-filter: take factor x candidates by Hamming distance over
+# the 1-bit index of db/init/009 (pgvector >= 0.7), then rescore them by cosine
+# distance on the stored embeddings. 0 searches the full-precision index
+# directly.
+BINARY_PREFILTER_FACTOR = int(os.getenv("BINARY_PREFILTER_FACTOR", "0"))
+EMBEDDING_DIMENSIONS = 1536  # matches the bit(1536) expression indexes
+# Significant digits sent per component: float32 carries ~7, halfvec ~3
+VECTOR_LITERAL_DIGITS = 8
+
+# Second half of a hybrid query, shared by the pgvector and NumPy engines:
+# expects a vector_hits(id, rank) CTE before it and yields fused(id, score)
+LEXICAL_FUSION_CTES = """
+        lexical_hits AS (
+            SELECT id, row_number() OVER (ORDER BY score DESC) AS rank
+            FROM (
+                SELECT c.id, ts_rank_cd(c.tsv, q) AS score
+                FROM gringo.chunks c, websearch_to_tsquery('simple', %(query)s) q
+                WHERE c.tsv @@ q
+                ORDER BY score DESC
+                LIMIT %(candidates)s
+            ) l
+        ),
+        fused AS (
+            SELECT id, sum(score) AS score
+            FROM (
+                SELECT id, %(vector_weight)s / (%(rrf_k)s + rank) AS score
+                FROM vector_hits
+                UNION ALL
+                SELECT id, %(lexical_weight)s / (%(rrf_k)s + rank) AS score
+                FROM lexical_hits
+            ) ranked
+            GROUP BY id
+        )
+"""
+
+
+def vector_literal(embedding: List[float]) -> str:
+    """Text form of a vector accepted by pgvector's ::vector cast.
+
+    psycopg2 only sends text parameters, so this is on the hot path: one
+    %-format over a cached template is several times faster than str() per
+    component and its output is a third shorter.
+    """
+    return vector_template(len(embedding)) % tuple(embedding)
+
+
+@lru_cache(maxsize=4)
+def vector_template(dimensions: int) -> str:
+    return "[" + ",".join([f"%.{VECTOR_LITERAL_DIGITS}g"] * dimensions) + "]"
+
+
+def nearest_sql(table: str, embedding: str, limit: str) -> str:
+    """Subquery yielding (id, distance) of the rows of ``table`` nearest to
+    ``embedding``.
+
+    ``embedding`` and ``limit`` are SQL expressions, placeholders or columns
+    of an enclosing lateral join. Ordering by the distance expression itself
+    (not an alias) is what lets the planner walk the ANN index instead of
+    sorting every row.
+    """
+    if not BINARY_PREFILTER_FACTOR:
+        return f"""
+            SELECT t.id, t.embedding <=> {embedding} AS distance
+            FROM {table} t
+            ORDER BY t.embedding <=> {embedding}
+            LIMIT {limit}"""
+    return f"""
+            SELECT b.id, b.embedding <=> {embedding} AS distance
+            FROM (
+                SELECT t.id, t.embedding
+                FROM {table} t
+                ORDER BY binary_quantize(t.embedding)::bit({EMBEDDING_DIMENSIONS})
+                    <~> binary_quantize({embedding})
+                LIMIT {BINARY_PREFILTER_FACTOR} * {limit}
+            ) b
+            ORDER BY distance
+            LIMIT {limit}"""
+
+
+def apply_search_params(cur, candidates: int, ef_search: Optional[int] = None,
+                        probes: Optional[int] = None):
+    """Tune the ANN indexes for the current transaction only.
+
+    An HNSW scan returns at most ef_search rows, so it is raised to the number
+    of candidates requested; otherwise large limits would silently come back
+    short. The binary pre-filter scans factor times more candidates.
+    """
+    candidates *= BINARY_PREFILTER_FACTOR or 1
+    ef_search = ef_search or HNSW_EF_SEARCH or HNSW_DEFAULT_EF_SEARCH
+    ef_search = min(max(ef_search, candidates), HNSW_MAX_EF_SEARCH)
+    probes = probes or IVFFLAT_PROBES
+
+    settings = []
+    if ef_search != HNSW_DEFAULT_EF_SEARCH:
+        settings += ['hnsw.ef_search', str(ef_search)]
+    if probes:
+        settings += ['ivfflat.probes', str(probes)]
+    if settings:
+        cur.execute(
+            "SELECT " + ", ".join(["set_config(%s, %s, true)"] * (len(settings) // 2)),
+            settings
+        )
+
+
+def search_documents(cur, embedding_str: str, limit: int,
+                     ef_search: Optional[int] = None,
+                     probes: Optional[int] = None) -> List[dict]:
+    """Whole-page search over gringo.documents, truncating long pages"""
+    apply_search_params(cur, limit, ef_search, probes)
+    nearest = nearest_sql("gringo.documents", "%(embedding)s::vector", "%(limit)s")
+    cur.execute(f"""
+        SELECT
+            d.id, d.url, d.title, d.content, d.updated_at,
+            1 - n.distance as similarity
+        FROM ({nearest}
+        ) n
+        JOIN gringo.documents d ON d.id = n.id
+        ORDER BY n.distance
+    """, {'embedding': embedding_str, 'limit': limit})
+
+    results = cur.fetchall()
+    logger.info(f"Found {len(results)} matching documents")
+    return truncate_documents(results)
+
+
+def truncate_documents(results: List[dict]) -> List[dict]:
+    # Process and truncate documents to stay within token limits
+    processed_results = []
+    for doc in results:
+        processed_results.append({
+            'id': doc['id'],
+            'url': doc['url'],
+            'title': doc['title'],
+            'content': token_counter.truncate(doc['content'], MAX_TOKENS_PER_DOC),
+            'similarity': doc['similarity'],
+            'updated_at': doc['updated_at']
+        })
+    return processed_results
+
+
+def search_chunks(cur, embedding_str: str, limit: int,
+                  ef_search: Optional[int] = None,
+                  probes: Optional[int] = None) -> List[dict]:
+    """Chunk-level search; each document's content is only its best matching
+    chunks"""
+    candidates = limit * CHUNK_CANDIDATES_PER_DOC
+    apply_search_params(cur, candidates, ef_search, probes)
+    nearest = nearest_sql("gringo.chunks", "%(embedding)s::vector", "%(candidates)s")
+    cur.execute(f"""
+        SELECT
+            c.document_id, c.ordinal, c.content, c.char_start, c.char_end,
+            d.url, d.title, d.updated_at,
+            1 - n.distance as similarity
+        FROM ({nearest}
+        ) n
+        JOIN gringo.chunks c ON c.id = n.id
+        JOIN gringo.documents d ON d.id = c.document_id
+        ORDER BY n.distance
+    """, {'embedding': embedding_str, 'candidates': candidates})
+
+    rows = cur.fetchall()
+    logger.info(f"Found {len(rows)} matching chunks")
+    return merge_chunks(rows, limit)
+
+
+def search_hybrid(cur, embedding_str: str, query: str, limit: int,
+                  vector_weight: float, lexical_weight: float,
+                  ef_search: Optional[int] = None,
+                  probes: Optional[int] = None) -> List[dict]:
+    """Chunk-level search fusing vector and full-text rankings in one round trip.
+
+    Each side contributes its own top candidates; a chunk's score is the
+    weighted reciprocal rank fusion of its positions in both lists, so exact
+    term matches the embedding misses can still make it into the top-k.
+    """
+    candidates = limit * CHUNK_CANDIDATES_PER_DOC
+    apply_search_params(cur, candidates, ef_search, probes)
+    nearest = nearest_sql("gringo.chunks", "%(embedding)s::vector", "%(candidates)s")
+    cur.execute(f"""
+        WITH vector_hits AS (
+            SELECT id, row_number() OVER (ORDER BY distance) AS rank
+            FROM ({nearest}
+            ) v
+        ),{LEXICAL_FUSION_CTES}
+        SELECT
+            c.document_id, c.ordinal, c.content, c.char_start, c.char_end,
+            d.url, d.title, d.updated_at,
+            1 - (c.embedding <=> %(embedding)s::vector) as similarity,
+            f.score
+        FROM fused f
+        JOIN gringo.chunks c ON c.id = f.id
+        JOIN gringo.documents d ON d.id = c.document_id
+        ORDER BY f.score DESC
+    """, {
+        'embedding': embedding_str,
+        'query': query,
+        'candidates': candidates,
+        'vector_weight': vector_weight,
+        'lexical_weight': lexical_weight,
+        'rrf_k': RRF_K,
+    })
+
+    rows = cur.fetchall()
+    logger.info(f"Found {len(rows)} matching chunks (hybrid)")
+    return merge_chunks(rows, limit, rank_key='score')
+
+
+def merge_chunks(rows: List[dict], limit: int,
+                 rank_key: str = 'similarity') -> List[dict]:
+    """Group chunk hits per document, ranked by each document's best chunk.
+
+    Up to MAX_CHUNKS_PER_DOC of the best chunks are kept per document and
+    stitched back together in page order; overlapping neighbours (the
+    splitter's chunk overlap) are joined without repeating the shared text.
+    """
+    by_document = {}
+    for row in rows:
+        hits = by_document.setdefault(row['document_id'], [])
+        if len(hits) < MAX_CHUNKS_PER_DOC:
+            hits.append(row)
+
+    documents = []
+    for hits in by_document.values():
+        best = max(hits, key=lambda h: h[rank_key])
+        parts = []
+        previous_end = None
+        for hit in sorted(hits, key=lambda h: h['char_start']):
+            content = hit['content']
+            if previous_end is not None and hit['char_start'] < previous_end:
+                content = content[previous_end - hit['char_start']:]
+            elif previous_end is not None:
+                parts.append("\n...\n")
+            parts.append(content)
+            previous_end = max(previous_end or 0, hit['char_end'])
+
+        documents.append({
+            'id': best['document_id'],
+            'url': best['url'],
+            'title': best['title'],
+            'content': "".join(parts),
+            'similarity': best['similarity'],
+            'updated_at': best['updated_at'],
+            'rank': best[rank_key]
+        })
+
+    documents.sort(key=lambda doc: doc.pop('rank'), reverse=True)
+    return documents[:limit]
+
+
+def group_by_query(rows: List[dict], count: int) -> List[List[dict]]:
+    """Split the rows of a batched search by their 1-based query ordinal"""
+    groups = [[] for _ in range(count)]
+    for row in rows:
+        groups[row['ord'] - 1].append(row)
+    return groups
+
+
+def search_documents_batch(cur, embedding_strs: List[str],
+                           limit: int) -> List[List[dict]]:
+    nearest = nearest_sql("gringo.documents", "q.embedding::vector", "%(limit)s")
+    cur.execute(f"""
+        SELECT q.ord, d.id, d.url, d.title, d.content, d.updated_at,
+            1 - n.distance as similarity
+        FROM unnest(%(embeddings)s::text[]) WITH ORDINALITY AS q(embedding, ord)
+        CROSS JOIN LATERAL ({nearest}
+        ) n
+        JOIN gringo.documents d ON d.id = n.id
+        ORDER BY q.ord, n.distance
+    """, {'embeddings': embedding_strs, 'limit': limit})
+    return [
+        truncate_documents(rows)
+        for rows in group_by_query(cur.fetchall(), len(embedding_strs))
+    ]
+
+
+def search_chunks_batch(cur, embedding_strs: List[str],
+                        limit: int) -> List[List[dict]]:
+    nearest = nearest_sql("gringo.chunks", "q.embedding::vector", "%(candidates)s")
+    cur.execute(f"""
+        SELECT q.ord, c.document_id, c.ordinal, c.content, c.char_start, c.char_end,
+            d.url, d.title, d.updated_at,
+            1 - h.distance as similarity
+        FROM unnest(%(embeddings)s::text[]) WITH ORDINALITY AS q(embedding, ord)
+        CROSS JOIN LATERAL ({nearest}
+        ) h
+        JOIN gringo.chunks c ON c.id = h.id
+        JOIN gringo.documents d ON d.id = c.document_id
+        ORDER BY q.ord, h.distance
+    """, {
+        'embeddings': embedding_strs,
+        'candidates': limit * CHUNK_CANDIDATES_PER_DOC,
+    })
+    return [
+        merge_chunks(rows, limit)
+        for rows in group_by_query(cur.fetchall(), len(embedding_strs))
+    ]
+
+
+def search_hybrid_batch(cur, embedding_strs: List[str], queries: List[str],
+                        limit: int, vector_weight: float,
+                        lexical_weight: float) -> List[List[dict]]:
+    """search_hybrid for many queries at once, fused per query inside a lateral
+    join"""
+    nearest = nearest_sql("gringo.chunks", "q.embedding::vector", "%(candidates)s")
+    cur.execute(f"""
+        SELECT q.ord, c.document_id, c.ordinal, c.content, c.char_start, c.char_end,
+            d.url, d.title, d.updated_at,
+            1 - (c.embedding <=> q.embedding::vector) as similarity,
+            f.score
+        FROM unnest(%(embeddings)s::text[], %(queries)s::text[])
+            WITH ORDINALITY AS q(embedding, query, ord)
+        CROSS JOIN LATERAL (
+            SELECT id, sum(score) AS score
+            FROM (
+                SELECT id, %(vector_weight)s
+                    / (%(rrf_k)s + row_number() OVER (ORDER BY distance)) AS score
+                FROM ({nearest}
+                ) v
+                UNION ALL
+                SELECT id, %(lexical_weight)s
+                    / (%(rrf_k)s + row_number() OVER (ORDER BY rank DESC)) AS score
+                FROM (
+                    SELECT c.id,
+                        ts_rank_cd(c.tsv, websearch_to_tsquery('simple', q.query))
+                            AS rank
+                    FROM gringo.chunks c
+                    WHERE c.tsv @@ websearch_to_tsquery('simple', q.query)
+                    ORDER BY rank DESC
+                    LIMIT %(candidates)s
+                ) l
+            ) ranked
+            GROUP BY id
+        ) f
+        JOIN gringo.chunks c ON c.id = f.id
+        JOIN gringo.documents d ON d.id = c.document_id
+        ORDER BY q.ord, f.score DESC
+    """, {
+        'embeddings': embedding_strs,
+        'queries': queries,
+        'candidates': limit * CHUNK_CANDIDATES_PER_DOC,
+        'vector_weight': vector_weight,
+        'lexical_weight': lexical_weight,
+        'rrf_k': RRF_K,
+    })
+    return [
+        merge_chunks(rows, limit, rank_key='score')
+        for rows in group_by_query(cur.fetchall(), len(embedding_strs))
+    ]
+
+
+def search_batch(cur, embedding_strs: List[str], queries: List[str], limit: int,
+                 mode: Optional[str] = None, vector_weight: Optional[float] = None,
+                 lexical_weight: Optional[float] = None,
+                 ef_search: Optional[int] = None,
+                 probes: Optional[int] = None) -> List[List[dict]]:
+    """Results of ``search`` for every query, in a single round trip"""
+    if RETRIEVAL_UNIT == "documents":
+        apply_search_params(cur, limit, ef_search, probes)
+        return search_documents_batch(cur, embedding_strs, limit)
+    apply_search_params(cur, limit * CHUNK_CANDIDATES_PER_DOC, ef_search, probes)
+    if (mode or RETRIEVAL_MODE) == "hybrid":
+        return search_hybrid_batch(
+            cur, embedding_strs, queries, limit,
+            HYBRID_VECTOR_WEIGHT if vector_weight is None else vector_weight,
+            HYBRID_LEXICAL_WEIGHT if lexical_weight is None else lexical_weight,
+        )
+    return search_chunks_batch(cur, embedding_strs, limit)
+
+
+def search_index(cur, index, embedding: List[float], limit: int,
+                 query: Optional[str] = None, mode: Optional[str] = None,
+                 vector_weight: Optional[float] = None,
+                 lexical_weight: Optional[float] = None,
+                 **_ann_params) -> List[dict]:
+    """``search`` with the nearest neighbours taken from a NumPy ``VectorIndex``.
+
+    Postgres only reads the rows of the hits (and runs the full-text side of
+    hybrid search); the ANN knobs do not apply to an exact in-process scan.
+    """
+    if index.unit == "documents":
+        ids, similarities = index.top_k(embedding, limit)
+        cur.execute("""
+            SELECT id, url, title, content, updated_at
+            FROM gringo.documents
+            WHERE id = ANY(%s)
+        """, (ids,))
+        rows = {row['id']: row for row in cur.fetchall()}
+        return truncate_documents([
+            {**rows[id], 'similarity': similarity}
+            for id, similarity in zip(ids, similarities, strict=True) if id in rows
+        ])
+
+    candidates = limit * CHUNK_CANDIDATES_PER_DOC
+    ids, similarities = index.top_k(embedding, candidates)
+    similarity = dict(zip(ids, similarities, strict=True))
+    if (mode or RETRIEVAL_MODE) == "hybrid" and query:
+        cur.execute(f"""
+            WITH vector_hits AS (
+                SELECT id, rank
+                FROM unnest(%(ids)s::bigint[]) WITH ORDINALITY AS v(id, rank)
+            ),{LEXICAL_FUSION_CTES}
+            SELECT
+                c.id, c.document_id, c.ordinal, c.content, c.char_start, c.char_end,
+                d.url, d.title, d.updated_at,
+                f.score
+            FROM fused f
+            JOIN gringo.chunks c ON c.id = f.id
+            JOIN gringo.documents d ON d.id = c.document_id
+            ORDER BY f.score DESC
+        """, {
+            'ids': ids,
+            'query': query,
+            'candidates': candidates,
+            'vector_weight':
+                HYBRID_VECTOR_WEIGHT if vector_weight is None else vector_weight,
+            'lexical_weight':
+                HYBRID_LEXICAL_WEIGHT if lexical_weight is None else lexical_weight,
+            'rrf_k': RRF_K,
+        })
+        rows = cur.fetchall()
+        # Lexical-only hits are outside the vector top-k, score them separately
+        lexical_only = [row['id'] for row in rows if row['id'] not in similarity]
+        if lexical_only:
+            lexical_similarities = index.similarities(embedding, lexical_only)
+            similarity.update(zip(lexical_only, lexical_similarities, strict=True))
+        for row in rows:
+            row['similarity'] = similarity[row['id']]
+        logger.info(f"Found {len(rows)} matching chunks (hybrid, numpy)")
+        return merge_chunks(rows, limit, rank_key='score')
+
+    cur.execute("""
+        SELECT
+            c.id, c.document_id, c.ordinal, c.content, c.char_start, c.char_end,
+            d.url, d.title, d.updated_at
+        FROM gringo.chunks c
+        JOIN gringo.documents d ON d.id = c.document_id
+        WHERE c.id = ANY(%s)
+    """, (ids,))
+    rows = cur.fetchall()
+    for row in rows:
+        row['similarity'] = similarity[row['id']]
+    rows.sort(key=lambda row: row['similarity'], reverse=True)
+    logger.info(f"Found {len(rows)} matching chunks (numpy)")
+    return merge_chunks(rows, limit)
+
+
+def search(cur, embedding_str: str, limit: int, query: Optional[str] = None,
+           mode: Optional[str] = None, vector_weight: Optional[float] = None,
+           lexical_weight: Optional[float] = None, ef_search: Optional[int] = None,
+           probes: Optional[int] = None) -> List[dict]:
+    if RETRIEVAL_UNIT == "documents":
+        return search_documents(cur, embedding_str, limit, ef_search, probes)
+    if (mode or RETRIEVAL_MODE) == "hybrid" and query:
+        return search_hybrid(
+            cur, embedding_str, query, limit,
+            HYBRID_VECTOR_WEIGHT if vector_weight is None else vector_weight,
+            HYBRID_LEXICAL_WEIGHT if lexical_weight is None else lexical_weight,
+            ef_search, probes,
+        )
+    return search_chunks(cur, embedding_str, limit, ef_search, probes)
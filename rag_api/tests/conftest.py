@@ -0,0 +1,28 @@
+import os
+
+import pytest
+import tiktoken
+
+# rag_api reads its configuration at import: run offline, without Redis
+os.environ.setdefault("EMBEDDING_BACKEND", "fake")
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("EMBEDDING_CACHE_REDIS", "false")
+
+import token_budget  # noqa: E402
+
+# One token per byte: counts are easy to reason about and nothing is downloaded
+BYTE_ENCODING = tiktoken.Encoding(
+    name="test_bytes",
+    pat_str=r"[\s\S]",
+    mergeable_ranks={bytes([i]): i for i in range(256)},
+    special_tokens={},
+)
+
+
+@pytest.fixture
+def byte_tokens(monkeypatch):
+    """Make token_budget count one token per byte, with a fresh count cache"""
+    monkeypatch.setattr(token_budget, "get_encoding", lambda model: BYTE_ENCODING)
+    counter = token_budget.TokenCounter("test", max_size=1000)
+    monkeypatch.setattr(token_budget, "token_counter", counter)
+    return counter
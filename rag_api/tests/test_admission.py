@@ -0,0 +1,206 @@
+import asyncio
+
+import pytest
+
+import admission
+from admission import Overloaded, PriorityScheduler, RateLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(admission.time, "monotonic", fake)
+    return fake
+
+
+def test_token_bucket_refills_at_rate_up_to_capacity():
+    bucket = TokenBucket(rate=2.0, capacity=4)
+    start = bucket.updated
+    for _ in range(4):
+        assert bucket.wait_time(1, start) == 0.0
+        bucket.take(1)
+
+    assert bucket.wait_time(1, start) == pytest.approx(0.5)
+    assert bucket.wait_time(1, start + 0.5) == 0.0
+    # A long idle period does not bank more than a full bucket
+    bucket.wait_time(0, start + 60)
+    assert bucket.tokens == 4
+
+
+def test_token_bucket_over_capacity_cost_drains_full_bucket():
+    bucket = TokenBucket(rate=1.0, capacity=3)
+    start = bucket.updated
+    assert bucket.wait_time(10, start) == 0.0
+    bucket.take(10)
+    assert bucket.tokens == 0
+
+    # The next big request waits for a full bucket, not for 10 tokens
+    assert bucket.wait_time(10, start) == pytest.approx(3.0)
+
+
+def test_rate_limiter_limits_per_user(clock):
+    limiter = RateLimiter(60, 2, global_per_minute=0, global_burst=0, max_users=10)
+    assert limiter.check("alice") == 0.0
+    assert limiter.check("alice") == 0.0
+    assert limiter.check("alice") == pytest.approx(1.0)
+    assert limiter.check("bob") == 0.0
+
+    clock.now += 1
+    assert limiter.check("alice") == 0.0
+    assert limiter.stats() == {
+        "tracked_users": 2,
+        "admitted_total": 4,
+        "rate_limited_total": 1,
+    }
+
+
+def test_rate_limiter_refusal_costs_nothing(clock):
+    limiter = RateLimiter(60, 5, global_per_minute=60, global_burst=1, max_users=10)
+    assert limiter.check("alice") == 0.0
+    # Refused by the global bucket, so alice's bucket is not charged either
+    assert limiter.check("alice") > 0
+    assert limiter._users["alice"].tokens == 4
+
+
+def test_rate_limiter_evicts_least_recently_used_user(clock):
+    limiter = RateLimiter(60, 1, global_per_minute=0, global_burst=0, max_users=2)
+    assert limiter.check("alice") == 0.0
+    assert limiter.check("bob") == 0.0
+    assert limiter.check("alice") > 0  # alice is now the most recent
+    assert limiter.check("carol") == 0.0
+
+    assert list(limiter._users) == ["alice", "carol"]
+    # bob was evicted and starts again with a full bucket
+    assert limiter.check("bob") == 0.0
+    assert list(limiter._users) == ["carol", "bob"]
+
+
+async def hold(scheduler: PriorityScheduler, priority: int, release: asyncio.Event,
+               order: list, name: str):
+    async with scheduler.slot(priority):
+        order.append(name)
+        await release.wait()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_scheduler_sheds_when_queue_is_full():
+    async def scenario():
+        scheduler = PriorityScheduler(concurrency=1, max_queue=2)
+        release, order = asyncio.Event(), []
+        tasks = [
+            asyncio.create_task(hold(scheduler, 0, release, order, name))
+            for name in ("running", "queued-1", "queued-2")
+        ]
+        await settle()
+
+        with pytest.raises(Overloaded):
+            await scheduler._acquire(0)
+        assert scheduler.stats()["llm_shed_total"] == 1
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert order == ["running", "queued-1", "queued-2"]
+        stats = scheduler.stats()
+        assert (stats["llm_active"], stats["llm_queued"]) == (0, 0)
+        assert stats["llm_enqueued_total"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_serves_higher_priority_first():
+    async def scenario():
+        scheduler = PriorityScheduler(concurrency=1, max_queue=10)
+        release, order = asyncio.Event(), []
+        tasks = [asyncio.create_task(hold(scheduler, 0, release, order, "running"))]
+        await settle()
+        for priority, name in [(1, "batch-1"), (0, "interactive"), (1, "batch-2")]:
+            task = hold(scheduler, priority, release, order, name)
+            tasks.append(asyncio.create_task(task))
+            await settle()
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert order == ["running", "interactive", "batch-1", "batch-2"]
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_cancel_while_queued_frees_queue_place():
+    async def scenario():
+        scheduler = PriorityScheduler(concurrency=1, max_queue=1)
+        release, order = asyncio.Event(), []
+        running = asyncio.create_task(hold(scheduler, 0, release, order, "running"))
+        await settle()
+        waiter = asyncio.create_task(hold(scheduler, 0, release, order, "cancelled"))
+        await settle()
+        assert scheduler.stats()["llm_queued"] == 1
+
+        waiter.cancel()
+        await settle()
+        assert scheduler.stats()["llm_queued"] == 0
+        late = asyncio.create_task(hold(scheduler, 0, release, order, "late"))
+        await settle()
+
+        release.set()
+        await asyncio.gather(running, late)
+        assert order == ["running", "late"]
+        assert scheduler.stats()["llm_active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_cancel_after_handover_returns_slot():
+    async def scenario():
+        scheduler = PriorityScheduler(concurrency=1, max_queue=10)
+        release, order = asyncio.Event(), []
+        await scheduler._acquire(0)
+        waiter = asyncio.create_task(hold(scheduler, 0, release, order, "cancelled"))
+        other = asyncio.create_task(hold(scheduler, 0, release, order, "other"))
+        await settle()
+
+        # Hand the slot to the waiter, then cancel it before it gets to run
+        scheduler._release()
+        waiter.cancel()
+        await settle()
+        assert waiter.cancelled()
+
+        # The slot went on to the next waiter rather than leaking
+        release.set()
+        await other
+        assert order == ["other"]
+        stats = scheduler.stats()
+        assert (stats["llm_active"], stats["llm_queued"]) == (0, 0)
+
+    asyncio.run(scenario())
+
+
+def test_scheduler_sheds_waiter_past_queue_timeout():
+    async def scenario():
+        scheduler = PriorityScheduler(concurrency=1, max_queue=10, queue_timeout=0.01)
+        await scheduler._acquire(0)
+
+        with pytest.raises(Overloaded):
+            await scheduler._acquire(0)
+        stats = scheduler.stats()
+        assert stats["llm_queue_timeouts_total"] == 1
+        assert stats["llm_queued"] == 0
+
+        # The expired waiter is skipped when the slot is released
+        scheduler._release()
+        assert scheduler.stats()["llm_active"] == 0
+        await scheduler._acquire(0)
+        assert scheduler.stats()["llm_active"] == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import rag_api
+import token_budget
+from token_budget import MESSAGE_OVERHEAD_TOKENS, pack_context
+
+
+def doc(name: str, length: int) -> SimpleNamespace:
+    return SimpleNamespace(url=f"https://example.com/{name}", content=name[0] * length)
+
+
+def header(n: int, _doc) -> str:
+    return f"[{n}] "  # 4 tokens
+
+
+def test_byte_encoding_counts_and_truncates(byte_tokens):
+    assert byte_tokens.count("hello") == 5
+    assert byte_tokens.truncate("hello world", 5) == "hello..."
+    assert byte_tokens.truncate("hello", 5) == "hello"
+
+
+def test_context_budget_leaves_room_for_prompt_and_answer(byte_tokens, monkeypatch):
+    monkeypatch.setattr(token_budget, "LLM_MODEL", "gpt-4")
+    monkeypatch.setattr(token_budget, "ANSWER_RESERVE_TOKENS", 1000)
+    monkeypatch.setattr(token_budget, "MAX_CONTEXT_TOKENS", 100_000)
+
+    budget = token_budget.context_budget("x" * 192)
+
+    assert budget == 8192 - 1000 - MESSAGE_OVERHEAD_TOKENS - 192
+
+
+def test_context_budget_is_capped(byte_tokens, monkeypatch):
+    monkeypatch.setattr(token_budget, "MAX_CONTEXT_TOKENS", 500)
+    assert token_budget.context_budget("short prompt") == 500
+
+
+def test_whole_documents_are_packed_in_rank_order(byte_tokens):
+    a, b = doc("a", 100), doc("b", 50)
+
+    packed = pack_context([a, b], 1000, header)
+
+    assert packed.documents == [a, b]
+    assert packed.text == f"[1] {a.content}\n\n[2] {b.content}"
+    assert packed.tokens == len(packed.text)
+    assert not packed.truncated
+
+
+def test_first_document_that_does_not_fit_is_cut_when_enough_room_remains(byte_tokens):
+    a, b, c = doc("a", 100), doc("b", 500), doc("c", 10)
+
+    packed = pack_context([a, b, c], 300, header)
+
+    # a takes 104 tokens, b gets what is left after its separator and header
+    remaining = 300 - 104 - 2 - 4
+    assert remaining >= token_budget.MIN_PARTIAL_SOURCE_TOKENS
+    assert packed.documents == [a, b]
+    assert packed.text == f"[1] {a.content}\n\n[2] {'b' * (remaining - 1)}..."
+    assert packed.tokens == 300
+    assert packed.truncated
+
+
+def test_too_small_a_remainder_drops_the_document_and_stops(byte_tokens):
+    a, b, c = doc("a", 100), doc("b", 500), doc("c", 10)
+
+    # 90 tokens would be left for b: below MIN_PARTIAL_SOURCE_TOKENS
+    packed = pack_context([a, b, c], 200, header)
+
+    assert packed.documents == [a]
+    assert packed.text == f"[1] {a.content}"
+    assert packed.tokens == 104
+    assert packed.truncated
+
+
+def test_nothing_fits_into_a_negative_budget(byte_tokens):
+    packed = pack_context([doc("a", 10)], -5, header)
+
+    assert packed.documents == []
+    assert packed.text == ""
+    assert packed.truncated
+
+
+def test_build_context_rejects_a_question_that_leaves_no_room(byte_tokens):
+    window = token_budget.CONTEXT_WINDOWS.get(token_budget.LLM_MODEL, 8192)
+    with pytest.raises(HTTPException) as error:
+        rag_api.build_context([doc("a", 10)], "?" * window)
+
+    assert error.value.status_code == 400
+    assert error.value.detail == rag_api.QUERY_TOO_LONG
+
+
+def test_build_context_packs_when_the_question_fits(byte_tokens):
+    packed = rag_api.build_context([doc("a", 10)], "What is a?")
+
+    assert packed.text.endswith("a" * 10)
+    assert not packed.truncated
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Callable, List
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-3.5-turbo")
+# Upper bound on retrieved context per prompt, below the model window to keep
+# cost in check
+MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "8000"))
+# Tokens kept free for the answer; also passed to the LLM as max_tokens
+ANSWER_RESERVE_TOKENS = int(os.getenv("ANSWER_RESERVE_TOKENS", "1024"))
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "20000"))
+# Chat framing of the system and human messages plus a safety margin
+MESSAGE_OVERHEAD_TOKENS = 16
+# A source cut down below this is left out rather than sent as a fragment
+MIN_PARTIAL_SOURCE_TOKENS = 100
+SOURCE_SEPARATOR = "\n\n"
+
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TokenCounter:
+    """Tokenizer-accurate token counts with an LRU cache keyed on the text digest.
+
+    Retrieved pages and chunks come back for many different questions, so
+    their counts are computed once; hashing a text is far cheaper than
+    tokenizing it again.
+    """
+
+    def __init__(self, model: str, max_size: int):
+        self.model = model
+        self.max_size = max_size
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        return get_encoding(self.model)
+
+    def load(self):
+        """Read the tokenizer's BPE ranks now rather than on the first count"""
+        get_encoding(self.model)
+
+    def encode(self, text: str) -> List[int]:
+        return self.encoding.encode(text, disallowed_special=())
+
+    def count(self, text: str) -> int:
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return count
+            self.misses += 1
+
+        count = len(self.encode(text))
+        with self._lock:
+            self._counts[key] = count
+            while len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+        return count
+
+    def truncate(self, text: str, max_tokens: int, suffix: str = "...") -> str:
+        """``text`` cut to at most ``max_tokens`` tokens (suffix not included)"""
+        if self.count(text) <= max_tokens:
+            return text
+        return self.encoding.decode(self.encode(text)[:max_tokens]) + suffix
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "model": self.model,
+                "size": len(self._counts),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+token_counter = TokenCounter(LLM_MODEL, TOKEN_COUNT_CACHE_SIZE)
+
+
+def context_budget(fixed_text: str) -> int:
+    """Tokens left for retrieved context once the prompt, question and answer
+    are accounted for"""
+    window = CONTEXT_WINDOWS.get(LLM_MODEL, DEFAULT_CONTEXT_WINDOW)
+    reserved = ANSWER_RESERVE_TOKENS + MESSAGE_OVERHEAD_TOKENS
+    available = window - reserved - token_counter.count(fixed_text)
+    return min(MAX_CONTEXT_TOKENS, available)
+
+
+@dataclass
+class PackedContext:
+    text: str
+    tokens: int
+    # sources that made it into the context, in rank order
+    documents: List[Any] = field(default_factory=list)
+    truncated: bool = False
+
+
+def pack_context(
+    documents: List[Any], budget: int, header: Callable[[int, Any], str]
+) -> PackedContext:
+    """Fill ``budget`` with the best ranked documents first.
+
+    Each document is ``header(n, doc)`` followed by ``doc.content``. The first
+    document that does not fit whole is cut at a token boundary, provided a
+    useful part of it fits, and packing stops there.
+    """
+    parts, included, used = [], [], 0
+    truncated = False
+    separator_tokens = token_counter.count(SOURCE_SEPARATOR)
+    for doc in documents:
+        prefix = header(len(parts) + 1, doc)
+        overhead = token_counter.count(prefix) + (separator_tokens if parts else 0)
+        remaining = budget - used - overhead
+        content_tokens = token_counter.count(doc.content)
+        if content_tokens <= remaining:
+            parts.append(prefix + doc.content)
+            included.append(doc)
+            used += overhead + content_tokens
+            continue
+        if remaining >= MIN_PARTIAL_SOURCE_TOKENS:
+            parts.append(prefix + token_counter.truncate(doc.content, remaining - 1))
+            included.append(doc)
+            used += overhead + remaining
+        truncated = True
+        break
+
+    return PackedContext(SOURCE_SEPARATOR.join(parts), used, included, truncated)
@@ -0,0 +1,332 @@
+"""
+In-process NumPy replica of the embeddings, an alternative to searching in
+pgvector (VECTOR_ENGINE=numpy).
+
+At startup every vector of the retrieval unit's table (gringo.chunks or
+gringo.documents) is loaded into one contiguous, unit-normalized matrix;
+a query is then a single matrix-vector product plus argpartition, and only
+the rows of the hits are read from Postgres. A background thread keeps the
+replica current: documents whose updated_at moved past the watermark get
+their rows replaced, either every VECTOR_INDEX_SYNC_INTERVAL seconds or as
+soon as the parser announces new embeddings on Redis. Readers never block:
+every sync builds a new snapshot and swaps it in with one assignment.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import numpy as np
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+from db import db_pool
+from retrieval import RETRIEVAL_UNIT
+
+logger = logging.getLogger(__name__)
+
+# "pgvector" searches in Postgres, "numpy" searches this replica
+VECTOR_ENGINE = os.getenv("VECTOR_ENGINE", "pgvector")
+# float16 halves the memory of the replica at some CPU cost per query
+VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "float32")
+VECTOR_INDEX_SYNC_INTERVAL = float(os.getenv("VECTOR_INDEX_SYNC_INTERVAL", "30"))
+# updated_at is the parser's transaction start time, so a batch may commit
+# with a timestamp older than rows already seen; this much is always re-read
+VECTOR_INDEX_SYNC_OVERLAP = float(os.getenv("VECTOR_INDEX_SYNC_OVERLAP", "300"))
+# Deleted documents are invisible to incremental sync, full reloads drop them
+VECTOR_INDEX_RELOAD_INTERVAL = float(
+    os.getenv("VECTOR_INDEX_RELOAD_INTERVAL", "3600")
+)
+# Published by the parser after it stores a batch of embeddings
+VECTOR_INDEX_CHANNEL = "gringo:documents:updated"
+
+LOAD_BATCH_ROWS = 2000
+SCORE_BLOCK_ROWS = 65536  # float16 rows upcast at a time when scoring
+
+ROWS_SQL = {
+    "chunks": "SELECT c.id, c.document_id, c.embedding::real[] FROM gringo.chunks c",
+    "documents": (
+        "SELECT d.id, d.id, d.embedding::real[] FROM gringo.documents d"
+        " WHERE d.embedding IS NOT NULL"
+    ),
+}
+OWNER_FILTER = {
+    "chunks": " WHERE c.document_id = ANY(%s)",
+    "documents": " AND d.id = ANY(%s)",
+}
+
+
+class Snapshot(NamedTuple):
+    ids: np.ndarray     # sorted row ids (chunk or document ids)
+    owners: np.ndarray  # document id of every row
+    matrix: np.ndarray  # unit-normalized embeddings, row i belongs to ids[i]
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class VectorIndex:
+    def __init__(self, unit: str, dtype: str):
+        self.unit = unit
+        self.dtype = np.dtype(dtype)
+        self._snapshot = self._build(
+            np.empty(0, np.int64), np.empty(0, np.int64), np.empty((0, 0), np.float32)
+        )
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.watermark: Optional[datetime] = None
+        # (id, updated_at) of documents inside the overlap window already
+        # replicated
+        self._recent: Set[Tuple[int, datetime]] = set()
+        self.loaded_at = 0.0
+        self.synced_at = 0.0
+        self.syncs = 0
+        self.reloads = 0
+        self.replaced_rows = 0
+        self.sync_errors = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at > 0
+
+    # ───────────────────────── queries ─────────────────────────
+    def _scores(self, matrix: np.ndarray, embedding: Sequence[float]) -> np.ndarray:
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        if matrix.dtype == np.float32:
+            return matrix @ query
+        scores = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), SCORE_BLOCK_ROWS):
+            block = matrix[start:start + SCORE_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+        return scores
+
+    def top_k(
+        self, embedding: Sequence[float], k: int
+    ) -> Tuple[List[int], List[float]]:
+        """Ids and cosine similarities of the k nearest rows, best first"""
+        snapshot = self._snapshot
+        k = min(k, len(snapshot.ids))
+        if k <= 0:
+            return [], []
+        scores = self._scores(snapshot.matrix, embedding)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return snapshot.ids[top].tolist(), scores[top].tolist()
+
+    def similarities(
+        self, embedding: Sequence[float], ids: Sequence[int]
+    ) -> List[float]:
+        """Cosine similarity to specific rows; rows not replicated yet score 0"""
+        snapshot = self._snapshot
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(snapshot.ids, ids)
+        found = positions < len(snapshot.ids)
+        found[found] = snapshot.ids[positions[found]] == ids[found]
+        result = np.zeros(len(ids), dtype=np.float32)
+        if found.any():
+            result[found] = self._scores(snapshot.matrix[positions[found]], embedding)
+        return result.tolist()
+
+    # ───────────────────────── loading ─────────────────────────
+    def _build(
+        self, ids: np.ndarray, owners: np.ndarray, matrix: np.ndarray
+    ) -> Snapshot:
+        order = np.argsort(ids, kind="stable")
+        matrix = np.ascontiguousarray(matrix[order], dtype=self.dtype)
+        return Snapshot(ids[order], owners[order], matrix)
+
+    def _fetch_rows(
+        self, conn, owners: Optional[List[int]] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        sql = ROWS_SQL[self.unit]
+        if owners is not None:
+            sql += OWNER_FILTER[self.unit]
+        ids, row_owners, blocks = [], [], []
+        # A named cursor streams the table instead of materializing it
+        # client-side
+        with conn.cursor(name="vector_index_rows") as cur:
+            cur.itersize = LOAD_BATCH_ROWS
+            cur.execute(sql, (owners,) if owners is not None else None)
+            while rows := cur.fetchmany(LOAD_BATCH_ROWS):
+                ids.extend(row[0] for row in rows)
+                row_owners.extend(row[1] for row in rows)
+                vectors = np.asarray([row[2] for row in rows], dtype=np.float32)
+                blocks.append(normalize_rows(vectors))
+        if blocks:
+            matrix = np.concatenate(blocks)
+        else:
+            matrix = np.empty((0, self._snapshot.matrix.shape[1]), np.float32)
+        return (
+            np.asarray(ids, dtype=np.int64),
+            np.asarray(row_owners, dtype=np.int64),
+            matrix,
+        )
+
+    def _updated_since(
+        self, conn, watermark: datetime
+    ) -> List[Tuple[int, datetime]]:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, updated_at FROM gringo.documents WHERE updated_at > %s",
+                (watermark - timedelta(seconds=VECTOR_INDEX_SYNC_OVERLAP),)
+            )
+            return cur.fetchall()
+
+    def load(self):
+        """Replace the replica with a full copy of the table"""
+        started = time.perf_counter()
+        with self._write_lock, db_pool.connection() as conn:
+            with conn.cursor() as cur:
+                # Read before the rows: anything updated meanwhile is re-read
+                # by the next sync
+                cur.execute("SELECT max(updated_at) FROM gringo.documents")
+                watermark = cur.fetchone()[0]
+            recent = set()
+            if watermark is not None:
+                recent = set(self._updated_since(conn, watermark))
+            ids, owners, matrix = self._fetch_rows(conn)
+            self._snapshot = self._build(ids, owners, matrix)
+            self.watermark = watermark
+            self._recent = recent
+            self.loaded_at = self.synced_at = time.monotonic()
+            self.reloads += 1
+        logger.info(
+            f"Loaded {len(ids)} {self.unit} vectors into the NumPy index "
+            f"({self._snapshot.matrix.nbytes / 1e6:.1f} MB {self.dtype}) "
+            f"in {time.perf_counter() - started:.2f}s"
+        )
+
+    def sync(self) -> int:
+        """Replace the rows of documents updated since the watermark.
+
+        Returns the number of rows replaced.
+        """
+        if self.watermark is None:
+            self.load()
+            return len(self._snapshot.ids)
+
+        with self._write_lock, db_pool.connection() as conn:
+            window = self._updated_since(conn, self.watermark)
+            changed = [row for row in window if row not in self._recent]
+            self.synced_at = time.monotonic()
+            self.syncs += 1
+            if not changed:
+                return 0
+
+            documents = [document_id for document_id, _ in changed]
+            ids, owners, matrix = self._fetch_rows(conn, documents)
+            snapshot = self._snapshot
+            keep = ~np.isin(snapshot.owners, documents)
+            if len(snapshot.matrix) and matrix.shape[1] != snapshot.matrix.shape[1]:
+                raise ValueError(
+                    f"Embedding size changed from {snapshot.matrix.shape[1]} "
+                    f"to {matrix.shape[1]}"
+                )
+            if len(snapshot.matrix):
+                kept = snapshot.matrix[keep]
+                matrix = np.concatenate([kept, matrix.astype(self.dtype)])
+            self._snapshot = self._build(
+                np.concatenate([snapshot.ids[keep], ids]),
+                np.concatenate([snapshot.owners[keep], owners]),
+                matrix,
+            )
+            latest = max(updated_at for _, updated_at in changed)
+            self.watermark = max(self.watermark, latest)
+            self._recent = set(window)
+            self.replaced_rows += len(ids)
+        logger.debug(
+            f"Vector index synced {len(documents)} documents ({len(ids)} rows)"
+        )
+        return len(ids)
+
+    # ───────────────────────── background sync ─────────────────
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="vector-index-sync", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _wait(self, pubsub):
+        """Sleep until the next interval, the parser's hint or shutdown,
+        whichever comes first"""
+        deadline = time.monotonic() + VECTOR_INDEX_SYNC_INTERVAL
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            if pubsub is None:
+                self._stop.wait(min(1.0, deadline - time.monotonic()))
+                continue
+            if pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0):
+                # Hints that piled up meanwhile are all served by one sync
+                while pubsub.get_message(ignore_subscribe_messages=True, timeout=0):
+                    pass
+                return
+
+    def _run(self):
+        pubsub = None
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() - self.loaded_at >= VECTOR_INDEX_RELOAD_INTERVAL:
+                    self.load()
+                else:
+                    self.sync()
+            except Exception as e:
+                self.sync_errors += 1
+                logger.error(f"Vector index sync failed: {e}")
+
+            try:
+                if pubsub is None:
+                    pubsub = get_redis().pubsub()
+                    pubsub.subscribe(VECTOR_INDEX_CHANNEL)
+                self._wait(pubsub)
+            except redis.RedisError as e:
+                logger.debug(
+                    f"Vector index notifications unavailable, polling instead: {e}"
+                )
+                pubsub = None
+                self._wait(None)
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        return {
+            "engine": VECTOR_ENGINE,
+            "unit": self.unit,
+            "dtype": str(self.dtype),
+            "rows": len(snapshot.ids),
+            "bytes": snapshot.matrix.nbytes,
+            "seconds_since_sync": (
+                time.monotonic() - self.synced_at if self.synced_at else None
+            ),
+            "syncs_total": self.syncs,
+            "reloads_total": self.reloads,
+            "replaced_rows_total": self.replaced_rows,
+            "sync_errors_total": self.sync_errors,
+        }
+
+
+def get_redis():
+    return redis.Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        db=0,
+        socket_connect_timeout=2,
+        # A failed connection falls back to polling at once instead of retrying
+        retry=Retry(NoBackoff(), 0),
+    )
+
+
+vector_index = VectorIndex(RETRIEVAL_UNIT, VECTOR_INDEX_DTYPE)